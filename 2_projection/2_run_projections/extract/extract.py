@@ -0,0 +1,403 @@
+'''
+Single-pass extraction of GCM-weighted means and quantiles from the raw Monte Carlo projection output.
+
+`extract_mortality_impacts.sh` and `extract_benefits.sh` run `quantiles.py` from the `prospectus-tools` repository once
+for each SSP, RCP, IAM, age group and scenario, and each run scans the whole Monte Carlo tree and re-reads the
+fulladapt, incadapt, noadapt, histclim and costs files it combines. Here the tree is walked once: each file of a target
+directory (batch/rcp/gcm/iam/ssp) is read once, all the requested scenarios that use it are computed from it, and the
+means and quantiles of every SSP, RCP, IAM, age group and scenario are then written to the same `edfcsv` and
+`valuescsv` files as the shell scripts, that `2_projection/1_utils/impacts.R` reads:
+
+    {output_dir}/{rcp}/{iam}/{ssp}/{rcp}-{ssp}-{age}-{scn}-{iam}-{spatial}-{units}-{format}.csv
+
+Scenarios are signed sums of the projection output files, as the arguments of `quantiles.py` in the shell scripts
+(e.g. incbenefits = incadapt - histclim - noadapt). The `rebased` column is read from the impacts files and the
+`costs_ub` column from the costs files.
+
+All the target directories of an extraction are held in memory, as n_targets x years x regions values per output,
+so extracting all years of the impact region-level files should be done for few outputs at a time.
+
+Usage, with the settings of `extract_mortality.yml`:
+
+    python extract.py extract_mortality.yml --ssp SSP3 --rcp rcp85 rcp45 --iam low high --age combined \
+        --scenario fulladaptcosts incbenefits climbenefits --units rates levels --format edfcsv valuescsv
+'''
+
+import os
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+import yaml
+from joblib import Parallel, delayed
+
+BASENAME = 'Agespec_interaction_GMFD_POLY-4_TINV_CYA_NW_w1'
+
+# suffix of the projection output file of each adaptation scenario
+FILE_SUFFIXES = {
+    'fulladapt': '',
+    'incadapt': '-incadapt',
+    'noadapt': '-noadapt',
+    'histclim': '-histclim',
+    'costs': '-costs',
+}
+
+# column read from each file, 'rebased' otherwise
+FILE_COLUMNS = {'costs': 'costs_ub'}
+
+# scenario -> signed projection output files, as the arguments of quantiles.py in the extract scripts
+SCENARIOS = {
+    'noadapt': [('noadapt', 1)],
+    'incadapt': [('incadapt', 1), ('histclim', -1)],
+    'fulladapt': [('fulladapt', 1), ('histclim', -1)],
+    'costs': [('costs', 1)],
+    'fulladaptcosts': [('fulladapt', 1), ('histclim', -1), ('costs', 1)],
+    # incbenefits = incadapt - noadapt
+    'incbenefits': [('incadapt', 1), ('histclim', -1), ('noadapt', -1)],
+    # climbenefits = fulladapt - incadapt, the histclim terms of extract_benefits.sh cancel out
+    'climbenefits': [('fulladapt', 1), ('incadapt', -1)],
+}
+
+AGES = ['young', 'older', 'oldest', 'combined']
+
+FORMATS = ['edfcsv', 'valuescsv']
+
+
+def impacts_path(targetdir, age, scn_file, spatial='aggregated', units='rates', basename=BASENAME):
+    '''Path of a projection output file of a target directory.
+
+    Parameters
+    ----------
+    targetdir: Monte Carlo target directory, {results_root}/batch{i}/{rcp}/{gcm}/{iam}/{ssp}
+    age: age group. young, older, oldest or combined.
+    scn_file: adaptation scenario of the file, see FILE_SUFFIXES.
+    spatial: 'aggregated' or 'ir_level'.
+    units: 'rates' or 'levels'.
+    basename: name of the projection output files without suffixes.
+
+    Returns
+    -------
+    str
+    '''
+    suffix = FILE_SUFFIXES[scn_file]
+    suffix += '-aggregated' if spatial == 'aggregated' else ''
+    suffix += '-levels' if units == 'levels' else ''
+    return f'{targetdir}/{basename}-{age}{suffix}.nc4'
+
+
+def find_targets(results_root, ssps, rcps, iams, only_models='all'):
+    '''Lists the Monte Carlo target directories of the requested SSPs, RCPs and IAMs.
+
+    Parameters
+    ----------
+    results_root: root folder of the raw Monte Carlo output, with batch{i}/{rcp}/{gcm}/{iam}/{ssp} target directories.
+    ssps, rcps, iams: list of str
+    only_models: 'all' or list of GCMs to include, as `only-models` in the extract config.
+
+    Returns
+    -------
+    DataFrame with one row per target directory, and batch, rcp, gcm, iam, ssp and path columns.
+    '''
+    rows = []
+    for path in sorted(glob.glob(f'{results_root}/batch*/*/*/*/*')):
+        batch, rcp, gcm, iam, ssp = os.path.relpath(path, results_root).split(os.sep)
+        if rcp in rcps and iam in iams and ssp in ssps and (only_models == 'all' or gcm in only_models):
+            rows.append(dict(batch=batch, rcp=rcp, gcm=gcm, iam=iam, ssp=ssp, path=path))
+    return pd.DataFrame(rows, columns=['batch', 'rcp', 'gcm', 'iam', 'ssp', 'path'])
+
+
+def _read(path, column, years):
+    with xr.open_dataset(path) as ds:
+        da = ds[column]
+        if years is not None:
+            da = da.sel(year=years)
+        regions = ds.regions.values
+        if regions.dtype.kind == 'S':
+            regions = np.char.decode(regions, 'utf-8')
+        return xr.DataArray(
+            da.transpose('year', 'region').values, dims=['year', 'region'],
+            coords={'year': da.year.values, 'region': regions.astype(str)})
+
+
+def read_target(targetdir, ages, scenarios, spatial='aggregated', units='rates', years=None, basename=BASENAME):
+    '''Computes all the requested scenarios of a target directory, reading each projection output file once.
+
+    Parameters
+    ----------
+    targetdir: Monte Carlo target directory.
+    ages: list of age groups.
+    scenarios: list of scenarios, see SCENARIOS.
+    spatial, units, basename: see impacts_path().
+    years: list of years to extract, or None for all years.
+
+    Returns
+    -------
+    dict of (age, scenario) -> (year x region) DataArray. Scenarios missing one of their files are left out.
+    '''
+    out = {}
+    for age in ages:
+        files = {}
+        for scn_file in {f for scn in scenarios for f, _ in SCENARIOS[scn]}:
+            path = impacts_path(targetdir, age, scn_file, spatial, units, basename)
+            if os.path.isfile(path):
+                files[scn_file] = _read(path, FILE_COLUMNS.get(scn_file, 'rebased'), years)
+            else:
+                print(f'missing {path}')
+
+        for scn in scenarios:
+            terms = SCENARIOS[scn]
+            if all(f in files for f, _ in terms):
+                out[(age, scn)] = sum(sign * files[f] for f, sign in terms)
+    return out
+
+
+def quantile_name(q):
+    '''Column name of a quantile, e.g. 0.05 -> 'q05', 0.5 -> 'q50', as in the extracted files.'''
+    return 'q' + str(q).split('.')[1].ljust(2, '0')
+
+
+def weighted_mean(values, weights):
+    '''Weighted mean over the first axis, ignoring missing values.
+
+    Parameters
+    ----------
+    values: (target x ...) array.
+    weights: (target,) array of weights.
+
+    Returns
+    -------
+    np.array
+    '''
+    w = np.where(np.isnan(values), 0., weights.reshape((-1,) + (1,) * (values.ndim - 1)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nansum(values * w, axis=0) / w.sum(axis=0)
+
+
+def weighted_quantiles(values, weights, quantiles):
+    '''Weighted quantiles over the first axis, ignoring missing values.
+
+    Vectorized over the other axes. Follows the definition of
+    `statsmodels.stats.weightstats.DescrStatsW.quantile` (SAS definition 5, averaging the two values around an exact
+    hit of the cumulative weights), which 3_valuation/2_calculate_damages uses for the damages.
+
+    Parameters
+    ----------
+    values: (target x ...) array.
+    weights: (target,) array of weights.
+    quantiles: list of float between 0 and 1.
+
+    Returns
+    -------
+    (quantile x ...) np.array
+    '''
+    order = np.argsort(values, axis=0)  # missing values last
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    w = np.where(np.isnan(sorted_values), 0., weights[order])
+    cweights = np.cumsum(w, axis=0)
+    total = cweights[-1]
+    n = (~np.isnan(sorted_values)).sum(axis=0)
+
+    out = np.full((len(quantiles),) + values.shape[1:], np.nan)
+    for k, q in enumerate(quantiles):
+        target = q * total
+        # first index at which the cumulative weight reaches the target
+        ii = np.minimum((cweights < target).sum(axis=0), np.maximum(n - 1, 0))[None]
+        result = np.take_along_axis(sorted_values, ii, axis=0)[0]
+        hit = (np.abs(target - np.take_along_axis(cweights, ii, axis=0)[0]) < 1e-10) & (ii[0] < n - 1)
+        following = np.take_along_axis(sorted_values, np.minimum(ii + 1, len(values) - 1), axis=0)[0]
+        out[k] = np.where(hit, (result + following) / 2, result)
+        out[k][n == 0] = np.nan
+    return out
+
+
+def load_gcm_weights(gcm_weights, rcp=None):
+    '''Loads the climate model weights.
+
+    Parameters
+    ----------
+    gcm_weights: path of a CSV with gcm and weight columns (and optionally rcp), e.g.
+        {DB}/2_projection/5_climate_data/gcm_weights.csv, or None for equal weights.
+    rcp: RCP of the weights, if the CSV has an rcp column.
+
+    Returns
+    -------
+    pd.Series of weights indexed by gcm, or None.
+    '''
+    if gcm_weights is None:
+        return None
+    weights = pd.read_csv(gcm_weights)
+    if 'rcp' in weights.columns and rcp is not None:
+        weights = weights[weights.rcp == rcp]
+    return weights.set_index('gcm')['weight']
+
+
+def summarize(targets, values, evalqvals, fmt):
+    '''Collapses the values of the target directories to an extracted file.
+
+    Parameters
+    ----------
+    targets: DataFrame of the target directories, as returned by find_targets(), with a weight column.
+    values: list of (year x region) DataArrays, one per row of `targets`.
+    evalqvals: list of 'mean' and quantiles, as in the extract config.
+    fmt: 'edfcsv' for means and quantiles, 'valuescsv' for the values of all the target directories.
+
+    Returns
+    -------
+    DataFrame with region and year columns.
+    '''
+    stacked = xr.concat(values, dim='target', join='outer')
+    years, regions = stacked.year.values, stacked.region.values
+    index = pd.MultiIndex.from_product([regions, years], names=['region', 'year'])
+    array = stacked.transpose('target', 'region', 'year').values.reshape(len(values), -1)
+
+    if fmt == 'valuescsv':
+        frames = []
+        for (_, target), row in zip(targets.iterrows(), array):
+            df = pd.DataFrame({'batch': target.batch, 'gcm': target.gcm, 'weight': target.weight, 'value': row},
+                index=index)
+            frames.append(df)
+        return pd.concat(frames).reset_index()
+
+    weights = targets.weight.values.astype(float)
+    columns = {}
+    quantiles = [q for q in evalqvals if q != 'mean']
+    if 'mean' in evalqvals:
+        columns['mean'] = weighted_mean(array, weights)
+    if quantiles:
+        for q, col in zip(quantiles, weighted_quantiles(array, weights, [float(q) for q in quantiles])):
+            columns[quantile_name(q)] = col
+    return pd.DataFrame(columns, index=index).reset_index()
+
+
+def output_path(output_dir, rcp, iam, ssp, age, scn, spatial, units, fmt):
+    '''Path of an extracted file, as read by `get_mortality_impacts` in 2_projection/1_utils/impacts.R.'''
+    return f'{output_dir}/{rcp}/{iam}/{ssp}/{rcp}-{ssp}-{age}-{scn}-{iam}-{spatial}-{units}-{fmt}.csv'
+
+
+def extract(
+    results_root,
+    output_dir,
+    ssps=['SSP3'],
+    rcps=['rcp85'],
+    iams=['low'],
+    ages=['combined'],
+    scenarios=['fulladaptcosts'],
+    spatial='aggregated',
+    units=['rates'],
+    formats=['edfcsv'],
+    evalqvals=['mean', .25, .75],
+    years=None,
+    only_models='all',
+    gcm_weights=None,
+    do_gcmweights=True,
+    basename=BASENAME,
+    n_jobs=1):
+    '''Extracts the means and quantiles of all the requested combinations in one walk of the Monte Carlo tree.
+
+    Parameters
+    ----------
+    results_root: root folder of the raw Monte Carlo output.
+    output_dir: root folder of the extracted files, e.g. {DB}/2_projection/3_impacts/main_specification/extracted/montecarlo
+    ssps, rcps, iams, ages: lists of SSPs, RCPs, IAMs and age groups.
+    scenarios: list of scenarios, see SCENARIOS.
+    spatial: 'aggregated' or 'ir_level'.
+    units: list of 'rates' and 'levels'.
+    formats: list of 'edfcsv' (means and quantiles) and 'valuescsv' (values of each batch and gcm).
+    evalqvals: 'mean' and quantiles to compute, as in the extract config.
+    years: list of years to extract, or None for all years.
+    only_models: 'all' or list of GCMs to include.
+    gcm_weights: path of the climate model weights CSV, see load_gcm_weights(). Required unless `do_gcmweights`
+        is False.
+    do_gcmweights: if False, the climate models are weighted equally, as with `do-gcmweights: no` in the extract
+        config of quantiles.py.
+    basename: name of the projection output files without suffixes.
+    n_jobs: number of processes reading the target directories.
+
+    Returns
+    -------
+    list of str, paths of the extracted files written.
+    '''
+    if not do_gcmweights:
+        gcm_weights = None
+    elif gcm_weights is None:
+        raise ValueError('gcm_weights is required, unless do_gcmweights is False')
+    elif not os.path.isfile(gcm_weights):
+        raise FileNotFoundError(f'climate model weights {gcm_weights} not found')
+
+    targets = find_targets(results_root, ssps, rcps, iams, only_models)
+    print(f'{len(targets)} target directories')
+
+    paths = []
+    for unit in units:
+        with Parallel(n_jobs=n_jobs) as parallelize:
+            results = parallelize(
+                delayed(read_target)(path, ages, scenarios, spatial, unit, years, basename)
+                for path in targets.path)
+
+        for (ssp, rcp, iam), group in targets.groupby(['ssp', 'rcp', 'iam']):
+            weights = load_gcm_weights(gcm_weights, rcp)
+            group = group.assign(weight=1. if weights is None else group.gcm.map(weights).values)
+            if group.weight.isnull().any():
+                raise ValueError(f'no weights for {", ".join(group.gcm[group.weight.isnull()].unique())}')
+
+            for age in ages:
+                for scn in scenarios:
+                    found = [i for i in group.index if (age, scn) in results[i]]
+                    if not found:
+                        print(f'no output for {rcp}-{ssp}-{age}-{scn}-{iam}')
+                        continue
+                    values = [results[i][(age, scn)] for i in found]
+                    for fmt in formats:
+                        path = output_path(output_dir, rcp, iam, ssp, age, scn, spatial, unit, fmt)
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        summarize(group.loc[found], values, evalqvals, fmt).to_csv(path, index=False)
+                        print(f'Extracted {path}')
+                        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('config', help='extract config, e.g. extract_mortality.yml')
+    parser.add_argument('--results-root', default=f'{os.getenv("DB")}/2_projection/3_impacts/main_specification/raw/montecarlo')
+    parser.add_argument('--output-dir', default=f'{os.getenv("DB")}/2_projection/3_impacts/main_specification/extracted/montecarlo')
+    parser.add_argument('--ssp', nargs='+', default=['SSP3'])
+    parser.add_argument('--rcp', nargs='+', default=['rcp85'])
+    parser.add_argument('--iam', nargs='+', default=['low'])
+    parser.add_argument('--age', nargs='+', default=['combined'], choices=AGES)
+    parser.add_argument('--scenario', nargs='+', default=['fulladaptcosts'], choices=list(SCENARIOS))
+    parser.add_argument('--spatial', default='aggregated', choices=['aggregated', 'ir_level'])
+    parser.add_argument('--units', nargs='+', default=['rates'], choices=['rates', 'levels'])
+    parser.add_argument('--format', nargs='+', default=['edfcsv'], choices=FORMATS)
+    parser.add_argument('--gcm-weights', default=f'{os.getenv("DB")}/2_projection/5_climate_data/gcm_weights.csv',
+        help='climate model weights CSV, not used if the config sets `do-gcmweights: no`')
+    parser.add_argument('--basename', default=BASENAME)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+
+    extract(
+        args.results_root,
+        args.output_dir,
+        ssps=args.ssp,
+        rcps=args.rcp,
+        iams=args.iam,
+        ages=args.age,
+        scenarios=args.scenario,
+        spatial=args.spatial,
+        units=args.units,
+        formats=args.format,
+        evalqvals=config.get('evalqvals', ['mean']),
+        years=config.get('years'),
+        only_models=config.get('only-models', 'all'),
+        gcm_weights=args.gcm_weights,
+        do_gcmweights=config.get('do-gcmweights', True),
+        basename=args.basename,
+        n_jobs=args.n_jobs)
+
+
+if __name__ == '__main__':
+    main()
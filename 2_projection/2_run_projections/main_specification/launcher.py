@@ -0,0 +1,300 @@
+'''
+Work-queue launcher for the Monte Carlo projection generate and aggregate jobs.
+
+`mortality_montecarlo.sh generate N` starts N identical `python -m generate.generate` processes, which share the
+Monte Carlo target directories between them, and discards their output. Here the runs are split into jobs, one per
+RCP, SSP, IAM (and optionally climate model) combination, passed to `impact-calculations` as the `only-rcp`,
+`only-ssp`, `only-iam` and `only-models` config options, so that no two processes work on the same target
+directories. The jobs are run by a bounded pool of local processes:
+
+- the output of each attempt of a job is written to its own log file,
+- each finished attempt is appended to a ledger, so that a rerun of the same command skips the jobs already done,
+- failed jobs are retried up to `retries` times, and listed at the end of the run,
+- after each job, the number of jobs done, failed and running, the throughput and the ETA are printed.
+
+At most one worker per job is busy: without --models, a run has one job per RCP, SSP and IAM combination, e.g.
+2 x 3 x 2 = 12 jobs for the three SSPs below, and more workers only help with --models.
+
+Usage, in the `impact-env` environment (the jobs are run from `$REPO/impact-calculations`, see --cwd):
+
+    python $REPO/carleton_mortality_2022/2_projection/2_run_projections/main_specification/launcher.py generate \
+        --workers 12 --rcp rcp45 rcp85 --ssp SSP2 SSP3 SSP4 --iam low high
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import itertools
+import subprocess
+import concurrent.futures
+import yaml
+
+CONFIGS = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'configs')
+
+STAGES = {
+    'generate': ('generate.generate', os.path.join(CONFIGS, 'mortality-generate-montecarlo.yml')),
+    'aggregate': ('generate.aggregate', os.path.join(CONFIGS, 'mortality-aggregate.yml')),
+}
+
+RCPS = ['rcp45', 'rcp85']
+SSPS = ['SSP1', 'SSP2', 'SSP3', 'SSP4', 'SSP5']
+IAMS = ['low', 'high']
+
+
+def load_config(path):
+    '''Reads a projection config, replacing the {DB} and {REPO} placeholders by the environment variables.
+
+    Parameters
+    ----------
+    path: path of the yml config.
+
+    Returns
+    -------
+    dict
+    '''
+    with open(path) as f:
+        text = f.read()
+    for var in ['DB', 'REPO']:
+        text = text.replace('{' + var + '}', os.getenv(var, '{' + var + '}'))
+    return yaml.safe_load(text)
+
+
+def build_jobs(config, rcps=None, ssps=None, iams=None, models=None):
+    '''Lists the jobs of a run, one per RCP, SSP, IAM and climate model combination.
+
+    Parameters
+    ----------
+    config: projection config, as returned by load_config(). Its `only-rcp`, `only-ssp`, `only-iam` and
+        `only-models` options, if any, are the defaults of the lists below.
+    rcps, ssps, iams: lists of RCPs, SSPs and IAMs, or None for the config options or all of them.
+    models: list of climate models, each run as a separate job, or None to run all the models in each job.
+
+    Returns
+    -------
+    list of dict, with the name of the job and its config options.
+    '''
+    def values(given, key, default):
+        if given is not None:
+            return list(given)
+        value = config.get(key, default)
+        return [value] if isinstance(value, str) else list(value)
+
+    dims = [
+        ('only-rcp', values(rcps, 'only-rcp', RCPS)),
+        ('only-ssp', values(ssps, 'only-ssp', SSPS)),
+        ('only-iam', values(iams, 'only-iam', IAMS)),
+    ]
+    if models is not None or 'only-models' in config:
+        dims.append(('only-models', values(models, 'only-models', [])))
+
+    jobs = []
+    for combination in itertools.product(*[v for _, v in dims]):
+        options = dict(zip([k for k, _ in dims], combination))
+        jobs.append(dict(name='-'.join(combination), options=options))
+    return jobs
+
+
+def job_command(stage, config_path, outputdir, options, csvvfile=None):
+    '''Command line of a job.
+
+    Parameters
+    ----------
+    stage: 'generate' or 'aggregate'.
+    config_path: path of the projection config.
+    outputdir: Monte Carlo output directory.
+    options: config options of the job, see build_jobs().
+    csvvfile: CSVV file of the generate stage.
+
+    Returns
+    -------
+    list of str
+    '''
+    command = [sys.executable, '-m', STAGES[stage][0], config_path, f'--outputdir={outputdir}']
+    if stage == 'generate' and csvvfile is not None:
+        command.append(f'--csvvfile={csvvfile}')
+    command += [f'--{k}={v}' for k, v in options.items()]
+    return command
+
+
+def read_ledger(path):
+    '''Reads the ledger of a run.
+
+    Parameters
+    ----------
+    path: ledger file, one JSON record per line.
+
+    Returns
+    -------
+    dict of job name -> last record of the job.
+    '''
+    last = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    last[record['job']] = record
+    return last
+
+
+def _append(path, record):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def run_job(job, command, logdir, attempt, cwd=None):
+    '''Runs a job, writing its output to a log file.
+
+    Parameters
+    ----------
+    job: job, see build_jobs().
+    command: command line, see job_command().
+    logdir: folder of the log files.
+    attempt: attempt number of the job, in the name of the log file.
+    cwd: working directory of the job.
+
+    Returns
+    -------
+    dict record of the attempt, with the job name, status ('done' or 'failed'), return code, times and log file.
+    '''
+    log = os.path.join(logdir, f'{job["name"]}.attempt{attempt}.log')
+    start = time.time()
+    with open(log, 'w') as f:
+        f.write(' '.join(command) + '\n\n')
+        f.flush()
+        returncode = subprocess.call(command, stdout=f, stderr=subprocess.STDOUT, cwd=cwd)
+    return dict(
+        job=job['name'], status='done' if returncode == 0 else 'failed', returncode=returncode, attempt=attempt,
+        started=datetime.datetime.fromtimestamp(start).isoformat(), seconds=time.time() - start, log=log)
+
+
+def _format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def run_queue(jobs, stage, config_path, outputdir, csvvfile=None, workers=1, retries=2, ledger=None, logdir=None,
+    cwd=None):
+    '''Runs the jobs not done yet in a bounded pool of processes.
+
+    Parameters
+    ----------
+    jobs: list of jobs, see build_jobs().
+    stage: 'generate' or 'aggregate'.
+    config_path: path of the projection config.
+    outputdir: Monte Carlo output directory.
+    csvvfile: CSVV file of the generate stage.
+    workers: number of jobs run at the same time.
+    retries: number of times a failed job is run again.
+    ledger: ledger file. Defaults to {outputdir}/launcher/{stage}-ledger.jsonl
+    logdir: folder of the log files. Defaults to {outputdir}/launcher/logs/{stage}
+    cwd: working directory of the jobs, the impact-calculations repository.
+
+    Returns
+    -------
+    list of str, names of the jobs that failed all their attempts.
+    '''
+    ledger = ledger or os.path.join(outputdir, 'launcher', f'{stage}-ledger.jsonl')
+    logdir = logdir or os.path.join(outputdir, 'launcher', 'logs', stage)
+    os.makedirs(os.path.dirname(os.path.abspath(ledger)), exist_ok=True)
+    os.makedirs(logdir, exist_ok=True)
+
+    previous = read_ledger(ledger)
+    todo = [job for job in jobs if previous.get(job['name'], {}).get('status') != 'done']
+    print(f'{len(jobs)} jobs, {len(jobs) - len(todo)} already done, {len(todo)} to run on {workers} workers')
+    if not todo:
+        return []
+
+    # attempts of each job, numbered across runs, and tries of each job in this run
+    attempts = {job['name']: previous.get(job['name'], {}).get('attempt', 0) for job in todo}
+    tries = {job['name']: 0 for job in todo}
+    n_done, failed = 0, []
+    running = {}
+    start = time.time()
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        def submit(job):
+            attempts[job['name']] += 1
+            tries[job['name']] += 1
+            command = job_command(stage, config_path, outputdir, job['options'], csvvfile)
+            future = executor.submit(run_job, job, command, logdir, attempts[job['name']], cwd)
+            running[future] = job
+
+        for job in todo:
+            submit(job)
+
+        while running:
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                record = future.result()
+                _append(ledger, record)
+
+                if record['status'] == 'done':
+                    n_done += 1
+                    message = 'done'
+                elif tries[job['name']] <= retries:
+                    message = f'failed with code {record["returncode"]}, retrying, see {record["log"]}'
+                    submit(job)
+                else:
+                    failed.append(job['name'])
+                    message = f'failed with code {record["returncode"]}, see {record["log"]}'
+
+                elapsed = time.time() - start
+                remaining = len(todo) - n_done - len(failed)
+                rate = n_done / elapsed
+                eta = _format_seconds(remaining / rate) if rate else '-'
+                print(
+                    f'[{datetime.datetime.now():%Y-%m-%d %H:%M:%S}] {job["name"]} {message} '
+                    f'({_format_seconds(record["seconds"])}) | {n_done}/{len(todo)} done, {len(failed)} failed, '
+                    f'{len(running)} running | {3600 * rate:.1f} jobs/hour, ETA {eta}')
+                sys.stdout.flush()
+
+    if failed:
+        print(f'{len(failed)} jobs failed: {", ".join(failed)}. Run the same command again to retry them.')
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('stage', choices=list(STAGES))
+    parser.add_argument('--config', default=None, help='projection config, the main specification config by default')
+    parser.add_argument('--outputdir', default=f'{os.getenv("REPO")}/montecarlo/',
+        help='Monte Carlo output directory, $REPO/montecarlo/ by default, as in mortality_montecarlo.sh')
+    parser.add_argument('--csvvfile', default=f'{os.getenv("DB")}/1_estimation/2_csvv/Agespec_interaction_response.csvv')
+    parser.add_argument('--rcp', nargs='+', default=None)
+    parser.add_argument('--ssp', nargs='+', default=None)
+    parser.add_argument('--iam', nargs='+', default=None)
+    parser.add_argument('--models', nargs='+', default=None, help='climate models, each run as a separate job')
+    parser.add_argument('--workers', type=int, default=1, help='number of jobs run at the same time')
+    parser.add_argument('--retries', type=int, default=2, help='number of times a failed job is run again')
+    parser.add_argument('--ledger', default=None)
+    parser.add_argument('--logdir', default=None)
+    parser.add_argument('--cwd', default=f'{os.getenv("REPO")}/impact-calculations', help='impact-calculations repository')
+    parser.add_argument('--dry-run', action='store_true', help='only print the commands of the jobs not done yet')
+    args = parser.parse_args(argv)
+
+    config_path = args.config or STAGES[args.stage][1]
+    config = load_config(config_path)
+    outputdir = args.outputdir
+    jobs = build_jobs(config, args.rcp, args.ssp, args.iam, args.models)
+
+    if args.dry_run:
+        done = read_ledger(args.ledger or os.path.join(outputdir, 'launcher', f'{args.stage}-ledger.jsonl'))
+        for job in jobs:
+            if done.get(job['name'], {}).get('status') != 'done':
+                print(' '.join(job_command(args.stage, config_path, outputdir, job['options'], args.csvvfile)))
+        return
+
+    failed = run_queue(
+        jobs, args.stage, config_path, outputdir, csvvfile=args.csvvfile, workers=args.workers, retries=args.retries,
+        ledger=args.ledger, logdir=args.logdir, cwd=args.cwd)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,8 +15,13 @@ import xarray as xr
 from joblib import Parallel, delayed
 import itertools
 import time
+from columnar import read_table
+from regions import load_region_registry
 
 
+# economic modeling scenarios keys as found in the income data, and their names in the VSL outputs
+MODDICT = {'high' : 'OECD Env-Growth', 'low' : 'IIASA GDP'}
+
 
 # helper function
 def group_wavg(df, valuecol, weightcol, bycols):
@@ -113,7 +118,7 @@ def load_fed_data(data_path) :
 
     # Load Fed gdppc and GDP deflator.
     file_fed = os.path.join(data_path, '3_valuation/inputs/adjustments/fed_income_inflation.csv')
-    fed = pd.read_csv(file_fed).set_index('year')
+    fed = read_table(file_fed, columns=['year', 'gdppc', 'gdpdef']).set_index('year')
     fed_gdppc = fed['gdppc'].to_dict()
     fed_gdpdef = fed['gdpdef'].to_dict()
 
@@ -124,7 +129,7 @@ def load_fed_data(data_path) :
 
     return(income_2019, inflation_adj_2019)
 
-def load_income(file, isofiles=None):
+def load_income(file, isofiles=None, registry=None):
    
     """ Load income data by impact region, with the values varying by impact region or iso level. 
 
@@ -136,6 +141,9 @@ def load_income(file, isofiles=None):
         dict containing absolute paths for each economic model key ('low, 'high') pointing 
         to datasets containing iso level gdppc values. Should have a weird format : [variable ssp iam iso year 0]
         where 0 is the value variable. 
+    registry: regions.RegionRegistry or None
+        if passed, impact regions are returned as their integer ids in `registry`, and the country level data is matched 
+        to them by integer country id. 
 
     Returns 
     --------
@@ -145,11 +153,17 @@ def load_income(file, isofiles=None):
     """
 
     irdata = xr.open_dataset(file)['gdppc'].to_dataframe().reset_index()        
+    if registry is not None:
+        irdata['region'] = registry.region_ids(irdata.region)
     if isofiles is None:
         return irdata
     else:
-        irdata['iso'] = irdata.region.apply(lambda x: x[:3])
-        isodata = pd.concat([pd.read_csv(isofiles['high']),pd.read_csv(isofiles['low'])])
+        isodata = pd.concat([read_table(isofiles[m], columns=['0', 'iam', 'year', 'iso']) for m in ['high', 'low']])
+        if registry is not None:
+            irdata['iso'] = registry.iso_of(irdata.region)
+            isodata['iso'] = registry.iso_ids(isodata.iso)
+        else:
+            irdata['iso'] = irdata.region.apply(lambda x: x[:3])
         isodata = isodata.rename(columns={'0':'gdppc', 'iam':'model'})
         isodata = isodata[['gdppc', 'model', 'year', 'iso']]
         iriso = irdata[['model','region','year','ssp','iso']].merge(isodata, how='left', on=('iso', 'year','model')).drop(columns='iso')
@@ -198,7 +212,7 @@ def load_lifeexp(file, dfir):
     ------- 
     pandas data frame with ['iso','year','ssp'] and life expectancy variables calulated as produced by life_expectancy_mt(). 
     '''
-    dfe = pd.read_csv(file)
+    dfe = read_table(file)
     dfe.rename(columns={'region':'iso','scenario':'ssp'}, inplace=True)
     dfe = append_2100_lifeexpect(dfe, dfir)
     dfe = dfe.append(get_missing_lifeexpect(dfe, dfir), sort = False)
@@ -224,7 +238,24 @@ def load_irlist(file):
 
     return dfir
 
-def load_interpolated_pop_lifeexp(data_path, ssp):
+def interpolated_pop_lifeexp_path(data_path, ssp):
+
+    '''
+    Parameters 
+    ---------
+    data_path : str
+        location of mortality repository data folder.
+    ssp : str
+        socioecon model. 
+
+    Returns 
+    ------- 
+    str, the path to the netcdf4 file storing the year-by-year interpolated population and life expectancy data of `ssp`. 
+    '''
+
+    return os.path.join(data_path,f'3_valuation/inputs/interpolated_pop_exp/interpolated_pop_exp_{ssp}.nc4')
+
+def load_interpolated_pop_lifeexp(data_path, ssp, dfir=None, dfe=None):
 
     '''
     population and life expectancy data are provided for chunks of 5 years. This function loads this data source linearly interpolated (that is, year-by-year)
@@ -237,6 +268,11 @@ def load_interpolated_pop_lifeexp(data_path, ssp):
         saved there. 
     ssp : str
         socioecon model. 
+    dfir : pandas data frame or None
+        ir list as returned by load_irlist(). Loaded from the `data_path` if None and the interpolation needs to be done. 
+    dfe : pandas data frame or None
+        life expectancy data as returned by load_lifeexp(). Loaded from the `data_path` if None and the interpolation needs to be done. 
+        Passing `dfir` and `dfe` allows to load them once when interpolating several SSPs. 
 
     Returns 
     ------- 
@@ -244,23 +280,25 @@ def load_interpolated_pop_lifeexp(data_path, ssp):
 
     '''
 
-    interpolated_data = os.path.join(data_path,f'3_valuation/inputs/interpolated_pop_exp/interpolated_pop_exp_{ssp}.nc4')
+    interpolated_data = interpolated_pop_lifeexp_path(data_path, ssp)
     if os.path.exists(interpolated_data):
         df = xr.open_dataset(interpolated_data).to_dataframe()
         df = df.reset_index()
         return df 
     else:
         # load IR list
-        print('loading ir list data...')
-        dfir = load_irlist(os.path.join(data_path, f'2_projection/1_regions/hierarchy.csv'))
+        if dfir is None:
+            print('loading ir list data...')
+            dfir = load_irlist(os.path.join(data_path, f'2_projection/1_regions/hierarchy.csv'))
 
         # Load pop
         print('loading and concatenating pop data...')
         pop = load_population(os.path.join(data_path, f'2_projection/2_econ_vars/{ssp}.nc4'))
         
         # Load life expectancy
-        print('loading life expectancy data...')
-        dfe = load_lifeexp(os.path.join(data_path, '3_valuation/inputs/exp/raw/life_expectancy_mt.csv'), dfir)
+        if dfe is None:
+            print('loading life expectancy data...')
+            dfe = load_lifeexp(os.path.join(data_path, '3_valuation/inputs/exp/raw/life_expectancy_mt.csv'), dfir)
 
         # merge age share data
         print('Merging population and life expectancy data...')
@@ -274,7 +312,7 @@ def load_interpolated_pop_lifeexp(data_path, ssp):
         df.drop(columns=['Unnamed: 0'], errors='ignore')
         dt = df.set_index(['region', 'year', 'ssp'])
         dtnc = dt.to_xarray()
-        dtnc.to_netcdf(os.path.join(data_path,f'3_valuation/inputs/interpolated_pop_exp/interpolated_pop_exp_{ssp}.nc4'))
+        dtnc.to_netcdf(interpolated_data)
 
         return df 
 
@@ -305,12 +343,35 @@ def standard_vsl(vsl_epa, life_expectancy, file_cpi, base_year, base_epa):
 
 
     vsl = {} 
-    cpi = pd.read_csv(file_cpi).set_index('Year')['Annual'].to_dict()
+    cpi = read_table(file_cpi, columns=['Year', 'Annual']).set_index('Year')['Annual'].to_dict()
     vsl['epa'] = vsl_epa * cpi[base_year] / cpi[base_epa]
     vsl['vly_epa'] = vsl['epa'] / life_expectancy
 
     return vsl
 
+def load_vsl_parameters(data_path):
+
+    '''
+    Loads the scalar parameters of the VSL computations, that is, the baseline US VSL and VLY values, the income level used for 
+    income scaling and the inflation adjustment. See make_iryear_vsl() for a description of each parameter source.
+
+    Parameters 
+    ---------
+    data_path : str
+        location of mortality repository data folder.
+
+    Returns 
+    ------- 
+    dict with 'vsl' (as returned by standard_vsl()), 'baseline_income' and 'inflation_adjustment' entries, 
+    matching the arguments of iryear_vsl(). 
+    '''
+
+    vsl = standard_vsl(vsl_epa=9900000., life_expectancy=47.2, file_cpi=os.path.join(data_path, '3_valuation/inputs/adjustments/USA_CPI_1990_2016.csv'), base_year=2005, base_epa=2011)
+    # 2019 incomes from Fed for income scaling VSL.
+    income_2019, inflation_adj_2019 = load_fed_data(data_path)
+
+    return dict(vsl=vsl, baseline_income=income_2019, inflation_adjustment=inflation_adj_2019)
+
 def iryear_vsl(socioecon, vsl, baseline_income, inflation_adjustment, moddict):
 
     """ applies standard VSL and VLY values to region-year-ssp-iam entries in order to retrieve VSL and VLY values that vary over space and time. 
@@ -405,59 +466,99 @@ def make_iryear_vsl(ssp, data_path, outputpath=None):
     'region', 'model', 'year'. 
     """
 
+    return make_iryear_vsl_all_ssp(ssp_list=[ssp], data_path=data_path, outputpath=outputpath)
+
+def make_iryear_vsl_all_ssp(ssp_list, data_path, outputpath=None):
+    """ Same as make_iryear_vsl() but for several SSPs at once. 
+
+    The inputs that are shared across SSPs (impact regions list, life expectancy, CPI and Fed data) are loaded once, and the VSL, country income VSL 
+    and life expectancy data are computed in a single pass with 'ssp' as a dimension, instead of running make_iryear_vsl() in one process per SSP, each
+    holding its own copy of the shared inputs. The output files are still written per SSP. 
+
+    Parameters
+    ----------
+    ssp_list: list of SSP scenarios for which to calculate VSLs.
+    data_path: location of mortality repository data folder.
+    outputpath: None or location where to save within the `data_path`
+
+    Returns
+    --------
+    tuple with three xarray datasets : vsl data, vsl data with country income, life expectancy data. Dimensions are 
+    'ssp', 'region', 'model', 'year'. 
+    """
+
     tic = time.time()
 
-    moddict = {'high' : 'OECD Env-Growth', 'low' : 'IIASA GDP'}
+    moddict = MODDICT
+
+    # impact regions are handled as integer ids until the outputs are built
+    registry = load_region_registry(data_path)
     
-    # load the two baseline US VSL and VLY values into a dictionary 
+    # load the two baseline US VSL and VLY values, the 2019 income and inflation adjustment
     print('loading baseline US VSL and VLY values...')
-    vsl = standard_vsl(vsl_epa=9900000., life_expectancy=47.2, file_cpi=os.path.join(data_path, '3_valuation/inputs/adjustments/USA_CPI_1990_2016.csv'), base_year=2005, base_epa=2011)
+    parameters = load_vsl_parameters(data_path)
+
+    # the IR list and the life expectancy data are only needed to interpolate, and are the same for all SSPs
+    dfir, dfe = None, None
+    if not all(os.path.exists(interpolated_pop_lifeexp_path(data_path, ssp)) for ssp in ssp_list):
+        print('loading ir list and life expectancy data...')
+        dfir = load_irlist(os.path.join(data_path, f'2_projection/1_regions/hierarchy.csv'))
+        dfe = load_lifeexp(os.path.join(data_path, '3_valuation/inputs/exp/raw/life_expectancy_mt.csv'), dfir)
 
     # loading interpolated population and life expectancy data 
     print('loading interpolated pop and life exp data')
-    df = load_interpolated_pop_lifeexp(data_path, ssp)
+    df = pd.concat([load_interpolated_pop_lifeexp(data_path, ssp, dfir=dfir, dfe=dfe) for ssp in ssp_list], sort=False)
+    df['region'] = registry.region_ids(df.region)
+    del dfir, dfe
 
     # loading income data
     print('Loading income data...')
-    income = load_income(os.path.join(data_path, f'2_projection/2_econ_vars/{ssp}.nc4'))
-    income_iso = load_income(os.path.join(data_path, f'2_projection/2_econ_vars/{ssp}.nc4'), isofiles={'low': os.path.join(data_path, f'2_projection/2_econ_vars/iso_gdppc_low_{ssp}.csv'),
-     'high' : os.path.join(data_path, f'2_projection/2_econ_vars/iso_gdppc_high_{ssp}.csv')})
+    income = pd.concat([load_income(os.path.join(data_path, f'2_projection/2_econ_vars/{ssp}.nc4'), registry=registry) for ssp in ssp_list], sort=False)
+    income_iso = pd.concat([load_income(os.path.join(data_path, f'2_projection/2_econ_vars/{ssp}.nc4'), isofiles={'low': os.path.join(data_path, f'2_projection/2_econ_vars/iso_gdppc_low_{ssp}.csv'),
+     'high' : os.path.join(data_path, f'2_projection/2_econ_vars/iso_gdppc_high_{ssp}.csv')}, registry=registry) for ssp in ssp_list], sort=False)
     
     # merging with pop and life exp
     print('Merging population, life expectancy and income ...')
     df_ir_income = df.merge(income, how='inner', on=['year', 'region', 'ssp'], validate ='1:m')
     df_iso_income = df.merge(income_iso, how='inner', on=['year', 'region', 'ssp'], validate ='1:m')
+    del df, income, income_iso
 
     
     print('inputs loaded. Calculating life values per region and year...')
     # performing computations with vsl using downscaled income scaling
-    # parameters: 2019 incomes from Fed for income scaling VSL.
-    income_2019, inflation_adj_2019 = load_fed_data(data_path)
     print('Calculating VSL for each iryear with IR income ....')
-    vsl_ds = iryear_vsl(socioecon=df_ir_income, vsl=vsl, baseline_income=income_2019, inflation_adjustment=inflation_adj_2019, moddict=moddict)
+    vsl_ds = iryear_vsl(socioecon=df_ir_income, moddict=moddict, **parameters)
     # performing computations with vsl using country level income scaling 
     print('Calculating VSL for each iryear with country income ....')
-    vsl_ds_iso_income = iryear_vsl(socioecon=df_iso_income, vsl=vsl, baseline_income=income_2019, inflation_adjustment=inflation_adj_2019, moddict=moddict)
+    vsl_ds_iso_income = iryear_vsl(socioecon=df_iso_income, moddict=moddict, **parameters)
+    del df_iso_income
 
     exp_cols = ['expectancy_young', 'expectancy_older', 
         'expectancy_oldest', 'expectancy_25_29_mt']
     df_ir_income = df_ir_income.replace({'model': moddict}).set_index(['ssp', 'region', 'model', 'year'])
     exp_ds = df_ir_income[exp_cols].to_xarray() # using whichever of the two
+    del df_ir_income
+
+    # back to impact region keys
+    vsl_ds = registry.decode(vsl_ds)
+    vsl_ds_iso_income = registry.decode(vsl_ds_iso_income)
+    exp_ds = registry.decode(exp_ds)
 
     if outputpath:
         print('writing the data ....')
-        # Export values to NetCDF.
-        (vsl_ds.squeeze()
-            .to_netcdf(
-                os.path.join(data_path, outputpath, f'vsl/{ssp}.nc4')))
+        # Export values to NetCDF, one file per SSP.
+        for ssp in ssp_list:
+            (vsl_ds.sel(ssp=[ssp]).squeeze()
+                .to_netcdf(
+                    os.path.join(data_path, outputpath, f'vsl/{ssp}.nc4')))
 
-        (vsl_ds_iso_income.squeeze()
-            .to_netcdf(
-                os.path.join(data_path, outputpath, f'vsl/{ssp}_iso_income.nc4')))
+            (vsl_ds_iso_income.sel(ssp=[ssp]).squeeze()
+                .to_netcdf(
+                    os.path.join(data_path, outputpath, f'vsl/{ssp}_iso_income.nc4')))
 
-        (exp_ds.squeeze()
-            .to_netcdf(
-                os.path.join(data_path, outputpath, f'exp/{ssp}.nc4'))) 
+            (exp_ds.sel(ssp=[ssp]).squeeze()
+                .to_netcdf(
+                    os.path.join(data_path, outputpath, f'exp/{ssp}.nc4'))) 
 
 
     toc = time.time()
@@ -465,3 +566,141 @@ def make_iryear_vsl(ssp, data_path, outputpath=None):
 
     return tuple((vsl_ds, vsl_ds_iso_income, exp_ds))
 
+
+class VSLProvider:
+    """ Computes VSL and life expectancy data on demand, as an alternative to the `vsl/{ssp}.nc4`, `vsl/{ssp}_iso_income.nc4` and `exp/{ssp}.nc4` 
+    files written by make_iryear_vsl(). 
+
+    Most of the VSL variables are income or population times a scalar parameter, or a population weighted average of it. Rather than writing them all to disk
+    and reading them back for the valuation, the provider keeps only the income, population and life expectancy inputs, and computes the same variables as 
+    iryear_vsl() for a given (ssp, model) the first time they are requested. Results are memoized per (ssp, model). 
+
+    It can be passed as `vsl_ds` to value_mortality_damages() in 3_valuation/2_calculate_damages/calculate_damages.py. 
+
+    Internally, impact regions are the integer ids of the `regions` registry, sorted by id. The data is returned with impact region 
+    keys unless `encoded=True` is requested. 
+
+    Parameters
+    ----------
+    data_path: str
+        location of mortality repository data folder.
+    moddict: dict
+        translating economic model keywords. 
+    """
+
+    def __init__(self, data_path, moddict=MODDICT):
+
+        self.data_path = data_path
+        self.moddict = moddict
+        self.parameters = load_vsl_parameters(data_path)
+        self.regions = load_region_registry(data_path)
+        self._inputs = {}
+        self._cache = {}
+
+    def _load_inputs(self, ssp, iso_income):
+        """ Loads and merges population, life expectancy and income data for `ssp`, as in make_iryear_vsl_all_ssp(). 
+
+        Returns 
+        -------
+        xarray Dataset with 'model', 'region', 'year' dimensions, where model is the raw economic model keyword and region the impact region id. 
+        """
+
+        key = (ssp, iso_income)
+        if key not in self._inputs:
+
+            df = load_interpolated_pop_lifeexp(self.data_path, ssp)
+            df['region'] = self.regions.region_ids(df.region)
+            econ_file = os.path.join(self.data_path, f'2_projection/2_econ_vars/{ssp}.nc4')
+            if iso_income:
+                income = load_income(econ_file, isofiles={'low': os.path.join(self.data_path, f'2_projection/2_econ_vars/iso_gdppc_low_{ssp}.csv'),
+                    'high' : os.path.join(self.data_path, f'2_projection/2_econ_vars/iso_gdppc_high_{ssp}.csv')}, registry=self.regions)
+            else:
+                income = load_income(econ_file, registry=self.regions)
+
+            df = df.merge(income, how='inner', on=['year', 'region', 'ssp'], validate ='1:m')
+            cols = ['gdppc', 'pop', 'mt_young', 'mt_older', 'mt_oldest', 'expectancy_young', 'expectancy_older', 
+                'expectancy_oldest', 'expectancy_25_29_mt']
+            self._inputs[key] = df.set_index(['model', 'region', 'year'])[cols].to_xarray().sortby('region')
+
+        return self._inputs[key]
+
+    def _output(self, ds, encoded):
+        return ds if encoded else self.regions.decode(ds)
+
+    def vsl(self, ssp, model, iso_income=False, encoded=False):
+        """ VSL data for one SSP and economic model. 
+
+        Parameters
+        ----------
+        ssp: SSP scenario. SSP1 - SSP5
+        model: economic modeling scenario. 'low' or 'high'
+        iso_income: boolean
+            if True, use country level income to scale the VSL. 
+        encoded: boolean
+            if True, regions are returned as their integer ids in `self.regions`. 
+
+        Returns
+        -------
+        xarray Dataset with the same variables as the `vsl/{ssp}.nc4` files and 'region', 'year' dimensions, with 'ssp' and 'model' scalar coordinates. 
+        """
+
+        key = ('vsl', ssp, model, iso_income)
+        if key not in self._cache:
+
+            ds = self._load_inputs(ssp, iso_income).sel(model=model, drop=True)
+            vsl = self.parameters['vsl']
+            inflation_adjustment = self.parameters['inflation_adjustment']
+            ratio = ds.gdppc / self.parameters['baseline_income'] # income ratio for scaling 
+
+            def popavg(da):
+                # equivalent of group_wavg() over regions within each year 
+                return ((da * ds['pop']).sum('region') / ds['pop'].sum('region')).broadcast_like(da)
+
+            out = xr.Dataset()
+            out['vsl_epa_scaled'] = ratio * vsl['epa'] * inflation_adjustment
+            out['vsl_epa_popavg'] = popavg(out['vsl_epa_scaled'])
+            out['vly_epa_scaled'] = ratio * vsl['vly_epa'] * inflation_adjustment
+            out['vly_epa_popavg'] = popavg(out['vly_epa_scaled'])
+            for var in ['mt_young', 'mt_older', 'mt_oldest']:
+                out[var] = ds[var]
+            out['gdp'] = ds.gdppc * ds['pop'] * inflation_adjustment
+            out['pop'] = ds['pop']
+
+            out.coords['ssp'] = ssp
+            out.coords['model'] = self.moddict[model]
+            self._cache[key] = out
+
+        return self._output(self._cache[key], encoded)
+
+    def expectancy(self, ssp, model, encoded=False):
+        """ Remaining life expectancy data for one SSP and economic model. 
+
+        Returns
+        -------
+        xarray Dataset with the same variables as the `exp/{ssp}.nc4` files and 'region', 'year' dimensions, with 'ssp' and 'model' scalar coordinates. 
+        """
+
+        key = ('exp', ssp, model)
+        if key not in self._cache:
+
+            exp_cols = ['expectancy_young', 'expectancy_older', 
+                'expectancy_oldest', 'expectancy_25_29_mt']
+            out = self._load_inputs(ssp, False).sel(model=model, drop=True)[exp_cols]
+            out.coords['ssp'] = ssp
+            out.coords['model'] = self.moddict[model]
+            self._cache[key] = out
+
+        return self._output(self._cache[key], encoded)
+
+    def preload(self, ssp, iso_income=False):
+        """ Computes the VSL and life expectancy data of `ssp` for all economic models, so that copies of the provider sent to 
+        parallel workers don't need to recompute them. 
+        """
+
+        for model in self.moddict:
+            self.vsl(ssp, model)
+            self.expectancy(ssp, model)
+            if iso_income:
+                self.vsl(ssp, model, iso_income=True)
+
+        return self
@@ -0,0 +1,116 @@
+'''
+Columnar ingestion of the large CSV inputs of the valuation code.
+
+The first time a CSV source is read through `read_table`, it is parsed once and stored as a typed Parquet file in a
+`.columnar` folder next to the source. Later reads use the multithreaded Parquet reader and only load the requested
+columns. String columns are returned as objects, as pd.read_csv() does. The Parquet file records the size and
+modification time of its source, and is rebuilt automatically when the source changes.
+
+This requires `pyarrow`, which is part of the `mortalityverse` environment. Without it, or if the cache can't be
+written next to the source, `read_table` falls back to reading the CSV with pandas.
+'''
+
+import os
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+CACHE_DIRNAME = '.columnar'
+
+
+def columnar_path(source):
+    """ Location of the Parquet version of a CSV source.
+
+    Parameters
+    ----------
+    source: str
+        path to a csv file.
+
+    Returns
+    -------
+    str
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(source)), CACHE_DIRNAME, os.path.basename(source) + '.parquet')
+
+def _source_signature(source):
+    stat = os.stat(source)
+    return {b'source_size': str(stat.st_size).encode(), b'source_mtime': str(stat.st_mtime_ns).encode()}
+
+def _is_current(path, signature):
+    if not os.path.exists(path):
+        return False
+    metadata = pq.read_schema(path).metadata or {}
+    return all(metadata.get(k) == v for k, v in signature.items())
+
+def convert_csv(source, path=None):
+    """ Parses a CSV source and writes it to Parquet.
+
+    The file is written to a temporary name and then moved, so that concurrent readers never see a partial file.
+
+    Parameters
+    ----------
+    source: str
+        path to a csv file.
+    path: str or None
+        where to write the Parquet file. Defaults to columnar_path(`source`).
+
+    Returns
+    -------
+    pandas data frame, the parsed CSV.
+    """
+    path = path or columnar_path(source)
+    signature = _source_signature(source)
+    df = pd.read_csv(source)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **signature})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
+
+    return df
+
+def read_table(source, columns=None):
+    """ Reads a CSV source through its Parquet version, creating or refreshing it if needed.
+
+    Parameters
+    ----------
+    source: str
+        path to a csv file.
+    columns: list of str or None
+        columns to read. All if None.
+
+    Returns
+    -------
+    pandas data frame
+    """
+
+    df = None
+    if pa is not None:
+        path = columnar_path(source)
+        try:
+            if _is_current(path, _source_signature(source)):
+                df = pq.read_table(path, columns=columns, use_threads=True).to_pandas()
+            else:
+                df = convert_csv(source, path)
+        except (OSError, pa.ArrowException):
+            df = None
+
+    if df is None:
+        df = pd.read_csv(source, usecols=columns)
+
+    if columns is not None:
+        df = df[columns]
+
+    # string columns of Parquet files written with categoricals are returned as objects too
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+
+    return df
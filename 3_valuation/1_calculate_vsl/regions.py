@@ -0,0 +1,124 @@
+'''
+Canonical registry of impact regions and countries, assigning them stable integer ids.
+
+Impact region keys are long strings that are repeated across millions of rows and used as merge keys or xarray
+coordinates in the valuation code. Using the integer ids of this registry instead saves memory, makes merges cheaper
+and, once datasets share the same region ordering, lets xarray combine them positionally rather than by matching labels.
+
+Region ids are the positions of the terminal impact regions of `hierarchy.csv` sorted by key, and country (ISO) ids
+the positions of the sorted 3-letter prefixes of these keys, so that ids are stable for a given hierarchy.
+'''
+
+import os
+import functools
+import numpy as np
+import pandas as pd
+from columnar import read_table
+
+
+class RegionRegistry:
+    """ Two-way mapping between impact region keys, country ISO codes and their integer ids.
+
+    Parameters
+    ----------
+    regions: list-like of str
+        impact region keys.
+    """
+
+    def __init__(self, regions):
+
+        self.regions = pd.Index(np.sort(np.unique(np.asarray(regions, dtype=object))), name='region')
+        self.isos = pd.Index(np.unique([r[:3] for r in self.regions]), name='iso')
+        # iso id of each region, by region id
+        self.region_iso = self.isos.get_indexer([r[:3] for r in self.regions]).astype(np.int32)
+
+    @classmethod
+    def from_hierarchy(cls, file):
+        """ Builds the registry from the terminal regions of a `hierarchy.csv` file.
+
+        Parameters
+        ----------
+        file: str
+            path to the regions hierarchy csv file, typically `2_projection/1_regions/hierarchy.csv` in the data folder.
+        """
+        dfir = read_table(file, columns=['region-key', 'is_terminal'])
+        return cls(dfir.loc[dfir.is_terminal.astype(bool), 'region-key'].values)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def region_ids(self, keys):
+        """ Impact region keys to ids. Raises a KeyError for unknown keys.
+
+        Returns
+        -------
+        numpy int32 array
+        """
+        ids = self.regions.get_indexer(np.asarray(keys, dtype=object))
+        if (ids < 0).any():
+            unknown = np.asarray(keys, dtype=object)[ids < 0]
+            raise KeyError('unknown impact regions: {}'.format(list(unknown[:5])))
+        return ids.astype(np.int32)
+
+    def region_keys(self, ids):
+        """ Impact region ids to keys.
+
+        Returns
+        -------
+        numpy object array
+        """
+        return self.regions.values[np.asarray(ids)]
+
+    def iso_ids(self, keys):
+        """ ISO codes to ids. Countries without impact regions in the registry get -1.
+
+        Returns
+        -------
+        numpy int32 array
+        """
+        return self.isos.get_indexer(np.asarray(keys, dtype=object)).astype(np.int32)
+
+    def iso_keys(self, ids):
+        """ ISO ids to codes.
+
+        Returns
+        -------
+        numpy object array
+        """
+        return self.isos.values[np.asarray(ids)]
+
+    def iso_of(self, region_ids):
+        """ ISO ids of impact region ids.
+
+        Returns
+        -------
+        numpy int32 array
+        """
+        return self.region_iso[np.asarray(region_ids)]
+
+    def encode(self, obj, dim='region'):
+        """ Replaces the impact region keys of an xarray object's `dim` coordinate with their ids, sorted by id,
+        so that encoded objects covering the same regions share the same region index.
+        """
+        return obj.assign_coords({dim: self.region_ids(obj[dim].values)}).sortby(dim)
+
+    def decode(self, obj, dim='region'):
+        """ Replaces the impact region ids of an xarray object's `dim` coordinate with their keys.
+        """
+        return obj.assign_coords({dim: self.region_keys(obj[dim].values)})
+
+
+@functools.lru_cache(maxsize=None)
+def load_region_registry(data_path):
+    """ Loads the registry of the regions hierarchy in the data folder, once per process.
+
+    Parameters
+    ----------
+    data_path: str
+        location of mortality repository data folder.
+
+    Returns
+    -------
+    RegionRegistry
+    """
+    return RegionRegistry.from_hierarchy(os.path.join(data_path, '2_projection/1_regions/hierarchy.csv'))
@@ -10,7 +10,7 @@ in the data released with the paper. Therefore, the user is not required to run
 '''
 
 from life_expectancy_and_mt import life_expectancy_mt
-from calculate_vsl import make_iryear_vsl
+from calculate_vsl import make_iryear_vsl, make_iryear_vsl_all_ssp
 from joblib import Parallel, delayed
 from itertools import product
 import os 
@@ -19,6 +19,7 @@ DB = os.getenv('DB')
 
 calculate_life_expectancy = True
 calculate_vsl_data = True
+all_ssp_single_pass = True # load shared inputs once and compute all SSPs together rather than one process per SSP
 
 # Calculate remaining life expectancies and the Murphy-Topel adjustment factors.
 if calculate_life_expectancy:
@@ -27,8 +28,11 @@ if calculate_life_expectancy:
 # Calculate income-scaled and population-weighted average VSL/VLY from 
 if calculate_vsl_data:
     ssp_list = ['SSP1', 'SSP2', 'SSP3', 'SSP4', 'SSP5']
-    with Parallel(n_jobs=5) as parallelize:
-        dslist = parallelize(
-            delayed(make_iryear_vsl)(
-                ssp=ssp, data_path=DB, outputpath='3_valuation/inputs') for ssp in ssp_list)
+    if all_ssp_single_pass:
+        make_iryear_vsl_all_ssp(ssp_list=ssp_list, data_path=DB, outputpath='3_valuation/inputs')
+    else:
+        with Parallel(n_jobs=5) as parallelize:
+            dslist = parallelize(
+                delayed(make_iryear_vsl)(
+                    ssp=ssp, data_path=DB, outputpath='3_valuation/inputs') for ssp in ssp_list)
 
@@ -24,6 +24,11 @@ import functools
 import random 
 import gc 
 import time
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../1_calculate_vsl'))
+from calculate_vsl import VSLProvider
+import impacts_cache
 
 def load_inputs(vsl_dir, ssp, iso_income=False): 
     """Loads VSL and remaining life expectancy inputs for valuation
@@ -77,7 +82,9 @@ def open_impacts_nc4(scn, age, indir):
 
     Returns 
     ------- 
-    xarray Dataset with impact values. 
+    xarray Dataset with impact values. If the IMPACTS_CACHE_DIR environment
+    variable is set, the decoded values are cached there, see impacts_cache.py,
+    and the Dataset read from the cache only has the `col` variable.
     """
 
     base='Agespec_interaction_GMFD_POLY-4_TINV_CYA_NW_w1'
@@ -95,13 +102,18 @@ def open_impacts_nc4(scn, age, indir):
         scale = 1/100000.
         col = 'costs_ub'
 
-    ds = (xr.open_dataset(f'{indir}/{base}-{age}{suff}.nc4')
-        .sel(year=slice(2010,2099)))
+    path = f'{indir}/{base}-{age}{suff}.nc4'
 
-    ds['region'] = ds.regions
-    ds[col] = ds[col] * scale
+    def decode():
+        ds = (xr.open_dataset(path)
+            .sel(year=slice(2010,2099)))
 
-    return ds
+        ds['region'] = ds.regions
+        ds[col] = ds[col] * scale
+
+        return ds
+
+    return impacts_cache.load(path, col, scale, (2010, 2099), decode)
 
 
 def value_mortality_damages(
@@ -116,7 +128,8 @@ def value_mortality_damages(
     do_deryugina=False,
     only_variables=None,
     scenario='fulladapt',
-    iso_income=False):
+    iso_income=False,
+    regions=None):
 
     """Calculates monetized damages from formatted projection output.
 
@@ -134,11 +147,12 @@ def value_mortality_damages(
         used to extract data from the `inputdir`, essentially doing the
         opposite of a standard f-string. Example of value: "/batch{}/{}/{}/{}/{}". If applied to 
         "/batch2/rcp85/CCSM4/low/SSP3" it would return the list (2, 'rcp85', 'CCSM4', 'low', 'SSP3').
-    vsl_ds: xarray Dataset or str. 
+    vsl_ds: xarray Dataset, str or VSLProvider. 
         if xarray Dataset, should containing VSL data (see `load_inputs`), or if a str, should point to the directiry necessary to run
-        `load_inputs`.  
+        `load_inputs`. If a VSLProvider (see 3_valuation/1_calculate_vsl/calculate_vsl.py), the VSL and life expectancy data are computed 
+        on demand by the provider rather than read from files. 
     exp_ds: xarray Dataset or None
-        ignored if `vsl_ds` is a str (See `vsl_ds`), otherwise Dataset containing remaining life expectancy data (see
+        ignored if `vsl_ds` is a str or a VSLProvider (See `vsl_ds`), otherwise Dataset containing remaining life expectancy data (see
         `load_inputs`).
     moddict: dict. 
         a dictionary that converts economic modeling scenarios to key-words.
@@ -162,6 +176,10 @@ def value_mortality_damages(
         adaptation scenario. see open_impacts_nc4()
     iso_income : boolean
         deaths are monetized with iso-level-income-VSL while costs are still monetized with ir-level-income-VSL. This difference will appear in the variable attributes. 
+    regions: RegionRegistry or None
+        registry of impact regions, see 3_valuation/1_calculate_vsl/regions.py. If passed, or if `vsl_ds` is a VSLProvider in which case its own 
+        registry is used, impacts and VSL data are indexed by integer region ids and aligned once, so that the valuation arithmetic is positional 
+        rather than matching region labels. Impact region output is returned with region keys in any case. 
 
 
     Returns 
@@ -178,28 +196,48 @@ def value_mortality_damages(
     (batch, rcp, gcm, model, ssp) = list(
         parse.parse(parser.replace('*','{}'),inputdir))
 
-    if isinstance(vsl_ds, str):
-        vsl_dir = vsl_ds
-        vsl_ds, exp_ds = load_inputs(vsl_dir=vsl_dir, ssp=ssp, iso_income=False)
+    if isinstance(vsl_ds, VSLProvider):
+        # the provider returns data already selected for this ssp and model
+        provider = vsl_ds
+        regions = provider.regions
+        vsl_ds = provider.vsl(ssp, model, encoded=True)
+        exp_ds = provider.expectancy(ssp, model, encoded=True)
         if iso_income:
-            vsl_ds_iso_income = load_inputs(vsl_dir=vsl_dir, ssp=ssp, iso_income=True)
+            vsl_ds_iso_income = provider.vsl(ssp, model, iso_income=True, encoded=True)
     else:
-        if iso_income:
-            raise ValueError('cant have vsl_ds passed as dataset and requesting iso_income vsl data')
+        if isinstance(vsl_ds, str):
+            vsl_dir = vsl_ds
+            vsl_ds, exp_ds = load_inputs(vsl_dir=vsl_dir, ssp=ssp, iso_income=False)
+            if iso_income:
+                vsl_ds_iso_income = load_inputs(vsl_dir=vsl_dir, ssp=ssp, iso_income=True)
+        else:
+            if iso_income:
+                raise ValueError('cant have vsl_ds passed as dataset and requesting iso_income vsl data')
     
-    vsl_ds = ( vsl_ds.where(vsl_ds.ssp == ssp, drop=True)
-        .where(vsl_ds.model == moddict[model], drop=True)
-        .squeeze() ) 
+        vsl_ds = ( vsl_ds.where(vsl_ds.ssp == ssp, drop=True)
+            .where(vsl_ds.model == moddict[model], drop=True)
+            .squeeze() ) 
+
+        if iso_income:
+            vsl_ds_iso_income = ( vsl_ds_iso_income.where(vsl_ds_iso_income.ssp == ssp, drop=True)
+                .where(vsl_ds_iso_income.model == moddict[model], drop=True)
+                .squeeze() )
+
+        exp_ds = ( exp_ds.where(exp_ds.ssp == ssp, drop=True)
+            .where(exp_ds.model == moddict[model], drop=True)
+            .squeeze() ) 
+
+        if regions is not None:
+            vsl_ds = regions.encode(vsl_ds)
+            exp_ds = regions.encode(exp_ds)
+            if iso_income:
+                vsl_ds_iso_income = regions.encode(vsl_ds_iso_income)
 
     vsl_dict = {} # allowing for different vsl data for deaths and costs monetization 
     vsl_geog_level_info = {} # same but to document in attributes
 
     if iso_income:
 
-        vsl_ds_iso_income = ( vsl_ds_iso_income.where(vsl_ds_iso_income.ssp == ssp, drop=True)
-            .where(vsl_ds_iso_income.model == moddict[model], drop=True)
-            .squeeze() )
-
         vsl_dict['deaths'] = vsl_ds_iso_income 
         vsl_geog_level_info['deaths'] = 'country-year'
         vsl_dict['costs'] = vsl_ds # costs always monetized with ir level income vsl. 
@@ -212,10 +250,6 @@ def value_mortality_damages(
         vsl_dict['costs'] = vsl_ds 
         vsl_geog_level_info['costs'] = 'IR-year'
 
-    exp_ds = ( exp_ds.where(exp_ds.ssp == ssp, drop=True)
-        .where(exp_ds.model == moddict[model], drop=True)
-        .squeeze() ) 
-
     datasets = []
     for age in age_groups:
 
@@ -236,6 +270,14 @@ def value_mortality_damages(
                 'costs': (('year','region'), ds_c.costs_ub )} ,
             coords = {'year': ds_f.year, 'region': ds_f.region} )
 
+        if regions is not None:
+            impacts = regions.encode(impacts)
+            if age == age_groups[0]:
+                # align the VSL data on the impacts regions once, the other age groups share the same region index
+                vsl_ds = vsl_ds.reindex(region=impacts.region)
+                exp_ds = exp_ds.reindex(region=impacts.region)
+                vsl_dict = {k: v.reindex(region=impacts.region) for k, v in vsl_dict.items()}
+
         for var in ['deaths', 'costs']:
 
 
@@ -293,6 +335,8 @@ def value_mortality_damages(
 
     # Output format depends on impact-region vs global resolution.
     if export_IR:
+        if regions is not None:
+            out = regions.decode(out)
         if export_IR_netcdf4:
             out = out.expand_dims(['gcm','batch','ssp', 'rcp', 'model'])
             out = out.sum(dim='age')
@@ -384,10 +428,11 @@ def concatenate_IR_damages(
     ----------
     mc_root: str
         Root folder of raw Monte Carlo simulation output.
-    vsl_dir:  str
+    vsl_dir:  str or VSLProvider
         Location of VSL-related valuation inputs, including both the VSLs
         themselves (VSL, VLY, and Murphy-Topel) and the remaining life expectancy
-        adjustments that are required for VLY and Murphy-Topel.
+        adjustments that are required for VLY and Murphy-Topel. Alternatively, a 
+        VSLProvider computing them on demand. 
     outputdir: str or None 
         Directory in which to save output CSV file. Also used for the logging directory. If None, doesn't save the final data, and doesn't log, so no side
         effects.
@@ -427,17 +472,26 @@ def concatenate_IR_damages(
         if test:
             paths=random.sample(paths,test)
 
-        if debug: 
-            dslist = []
-            for p in paths:
-                dslist.append(value_mortality_damages(inputdir=p, parser=parser, vsl_ds=vsl_dir, moddict=moddict,
-                    export_IR=True, export_IR_netcdf4=True, only_variables=only_variables,scenario='fulladapt', iso_income=iso_income))
-        else: 
-            with Parallel(n_jobs=n_jobs) as parallelize:
-                dslist = parallelize(
-                    delayed(try_value_mortality_damages)(
-                        logger=logger, inputdir=inputdir, parser=parser, vsl_ds=vsl_dir, moddict=moddict,
-                        export_IR=True, export_IR_netcdf4=True, only_variables=only_variables,scenario='fulladapt', iso_income=iso_income) for inputdir in paths)
+        if isinstance(vsl_dir, VSLProvider):
+            # the VSL and life expectancy data of each ssp are computed once, before the target directories of the ssp 
+            # are sent to the workers with copies of the provider, as in generate_global_damages()
+            ssps = sorted(set(os.path.basename(p) for p in paths))
+            groups = [(vsl_dir.preload(ssp, iso_income=iso_income), [p for p in paths if os.path.basename(p) == ssp]) for ssp in ssps]
+        else:
+            groups = [(vsl_dir, paths)]
+
+        dslist = []
+        for vsl_ds, group in groups:
+            if debug: 
+                for p in group:
+                    dslist.append(value_mortality_damages(inputdir=p, parser=parser, vsl_ds=vsl_ds, moddict=moddict,
+                        export_IR=True, export_IR_netcdf4=True, only_variables=only_variables,scenario='fulladapt', iso_income=iso_income))
+            else: 
+                with Parallel(n_jobs=n_jobs) as parallelize:
+                    dslist += parallelize(
+                        delayed(try_value_mortality_damages)(
+                            logger=logger, inputdir=inputdir, parser=parser, vsl_ds=vsl_ds, moddict=moddict,
+                            export_IR=True, export_IR_netcdf4=True, only_variables=only_variables,scenario='fulladapt', iso_income=iso_income) for inputdir in group)
 
         dslist = list(filter((None).__ne__, dslist))
 
@@ -476,7 +530,8 @@ def generate_global_damages(
     ssp: SSP scenario. SSP1 - SSP5
     vsl_dir:  Location of VSL-related valuation inputs, including both the VSLs
         themselves (VSL, VLY, and Murphy-Topel) and the remaining life expectancy
-        adjustments that are required for VLY and Murphy-Topel.
+        adjustments that are required for VLY and Murphy-Topel. Alternatively, a 
+        VSLProvider computing them on demand. 
     outputdir: Directory in which to save output CSV file.
     suffix: Adds suffix to output file name.
     n_jobs: Number of cores over which to parallelize.
@@ -489,7 +544,10 @@ def generate_global_damages(
     paths = sorted(glob.glob(wpath))
     parser = f"{mc_root}/batch*/*/*/*/*"
 
-    vsl_ds, exp_ds = load_inputs(vsl_dir, ssp)
+    if isinstance(vsl_dir, VSLProvider):
+        vsl_ds, exp_ds = vsl_dir.preload(ssp), None
+    else:
+        vsl_ds, exp_ds = load_inputs(vsl_dir, ssp)
 
     with Parallel(n_jobs=n_jobs) as parallelize:
         dslist = parallelize(
@@ -539,7 +597,8 @@ def generate_IR_damages(
     mc_root: Root folder of raw Monte Carlo simulation output.
     vsl_dir:  Location of VSL-related valuation inputs, including both the VSLs
         themselves (VSL, VLY, and Murphy-Topel) and the remaining life expectancy
-        adjustments that are required for VLY and Murphy-Topel.
+        adjustments that are required for VLY and Murphy-Topel. Alternatively, a 
+        VSLProvider computing them on demand. 
     gcm_weights_dir: directory containing climate model weights, which are used
         to compute the mean or quantile across the distribution of GCMs and
         monte carlo draws.
@@ -562,7 +621,10 @@ def generate_IR_damages(
     paths = sorted(glob.glob(wpath))
     parser = f"{mc_root}/batch*/*/*/*/*"
 
-    vsl_ds, exp_ds = load_inputs(vsl_dir, ssp)
+    if isinstance(vsl_dir, VSLProvider):
+        vsl_ds, exp_ds = vsl_dir.preload(ssp), None
+    else:
+        vsl_ds, exp_ds = load_inputs(vsl_dir, ssp)
 
     with Parallel(n_jobs=n_jobs) as parallelize:
         dslist = parallelize(
@@ -581,7 +643,10 @@ def generate_IR_damages(
     df = xr_weighted_quantile(
         ds, weights, qtile, q_jobs)
 
-    gdp = vsl_ds.sel(model=moddict[iam]).gdp.to_dataframe()
+    if isinstance(vsl_ds, VSLProvider):
+        gdp = vsl_ds.vsl(ssp, iam).gdp.to_dataframe()
+    else:
+        gdp = vsl_ds.sel(model=moddict[iam]).gdp.to_dataframe()
     df = pd.merge(df, gdp, left_index=True, right_index=True)
 
     if not do_deryugina:
@@ -0,0 +1,153 @@
+'''
+Local on-disk cache of the decoded impact arrays read by `open_impacts_nc4`.
+
+`run_damages.py` values the same raw projection files several times: `generate_IR_damages` for each RCP,
+`generate_global_damages` for each SSP and `concatenate_IR_damages` all decompress and rescale the same `.nc4` files
+(and the histclim and costs files once per scenario). With the cache enabled, the array used by the valuation (the
+rebased impacts, or the rescaled adaptation costs) of each file is stored once in an uncompressed `.npz` file with
+its years and regions, and read back from there by the next runs.
+
+The cache is opt-in: it's enabled by setting the IMPACTS_CACHE_DIR environment variable to a local folder (a fast
+local disk, rather than the shared file system of the projection output). Entries are keyed by the path, size and
+modification time of the source file, so that they are not used anymore once the source changes. The total size of
+the folder is capped by IMPACTS_CACHE_MAX_GB (50 by default): the least recently used entries are evicted once it's
+exceeded.
+'''
+
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+
+SUFFIX = '.npz'
+
+
+def cache_dir():
+    """ Folder of the cache, or None if the cache is disabled (the default).
+
+    Returns
+    -------
+    str or None
+    """
+    path = os.getenv('IMPACTS_CACHE_DIR')
+    return os.path.expanduser(path) if path else None
+
+def max_bytes():
+    """ Size cap of the cache.
+
+    Returns
+    -------
+    int, number of bytes, from the IMPACTS_CACHE_MAX_GB environment variable.
+    """
+    return int(float(os.getenv('IMPACTS_CACHE_MAX_GB', '50')) * 1024 ** 3)
+
+def entry_path(source, col, scale, years, directory=None):
+    """ Location of the cache entry of an impacts file.
+
+    Parameters
+    ----------
+    source: str
+        path to a raw projection `.nc4` file.
+    col: str
+        variable of the file.
+    scale: float
+        factor applied to the variable.
+    years: tuple of int
+        first and last years selected.
+    directory: str or None
+        folder of the cache. Defaults to cache_dir().
+
+    Returns
+    -------
+    str
+    """
+    stat = os.stat(source)
+    key = repr((os.path.abspath(source), stat.st_size, stat.st_mtime_ns, col, float(scale), tuple(years)))
+    return os.path.join(directory or cache_dir(), hashlib.sha1(key.encode()).hexdigest() + SUFFIX)
+
+def _read(path, col):
+    with np.load(path) as f:
+        values, year, region = f['values'], f['year'], f['region']
+    return xr.Dataset({col: (('year', 'region'), values)}, coords={'year': year, 'region': region})
+
+def _write(path, ds, col):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # np.savez appends .npz to names that don't end with it
+    tmp = '{}.{}.tmp{}'.format(path[:-len(SUFFIX)], os.getpid(), SUFFIX)
+    da = ds[col].transpose('year', 'region')
+    np.savez(tmp, values=da.values, year=da.year.values, region=da.region.values.astype(str))
+    os.replace(tmp, path)
+
+def evict(directory=None, limit=None):
+    """ Removes the least recently used entries until the cache is below its size cap.
+
+    Parameters
+    ----------
+    directory: str or None
+        folder of the cache. Defaults to cache_dir().
+    limit: int or None
+        size cap in bytes. Defaults to max_bytes().
+    """
+    directory = directory or cache_dir()
+    limit = max_bytes() if limit is None else limit
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith(SUFFIX) and '.tmp' not in name:
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def load(source, col, scale, years, decode):
+    """ Decoded impacts of a raw projection file, read from the cache if it has them.
+
+    Parameters
+    ----------
+    source: str
+        path to a raw projection `.nc4` file.
+    col: str
+        variable of the file.
+    scale: float
+        factor applied to the variable.
+    years: tuple of int
+        first and last years selected.
+    decode: callable
+        called without arguments on a cache miss, returns the xarray Dataset of the file with the rescaled `col`
+        variable along `year` and `region`.
+
+    Returns
+    -------
+    xarray Dataset. Read from the cache, it only has the `col` variable. Without a cache, the result of `decode()`.
+    """
+    directory = cache_dir()
+    if directory is None:
+        return decode()
+
+    path = entry_path(source, col, scale, years, directory)
+    try:
+        ds = _read(path, col)
+        # marks the entry as recently used, for the eviction
+        os.utime(path)
+        return ds
+    except (OSError, ValueError, KeyError):
+        pass
+
+    ds = decode()
+    try:
+        _write(path, ds, col)
+        evict(directory)
+    except OSError:
+        # a full or read-only cache folder doesn't stop the valuation
+        pass
+    return ds
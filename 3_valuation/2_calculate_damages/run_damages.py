@@ -1,5 +1,9 @@
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../1_calculate_vsl'))
 from calculate_damages import generate_IR_damages, generate_global_damages, concatenate_IR_damages
+from calculate_vsl import VSLProvider
 
 DB = os.getenv('DB')
 
@@ -7,11 +11,20 @@ calculate_global = True
 calculate_ir = False
 write_all = False 
 write_all_iso_income = False
+lazy_vsl = False # compute VSL inputs on demand from income and population instead of reading the files written by run_vsl.py
+impacts_cache_dir = None # local folder where the decoded impacts are cached between the runs below, see impacts_cache.py
 
 vsl_dir = f'{DB}/3_valuation/inputs'
 mc_root = f'{cp.DB}/2_projection/3_impacts/main_specification/raw/montecarlo'
 gcm_weights_dir = f'{DB}/2_projection/5_climate_data/gcm_weights.csv'
 
+if lazy_vsl:
+	vsl_dir = VSLProvider(DB)
+
+if impacts_cache_dir is not None:
+	# set before the joblib workers start, so that they inherit it
+	os.environ['IMPACTS_CACHE_DIR'] = impacts_cache_dir
+
 # Global damages for damage functions.
 if calculate_global:
 	outputdir=f'{DB}/3_valuation/global'
@@ -0,0 +1,208 @@
+"""
+--------------------------------------------------------------------------
+Benchmarks of the stages of the SCC pipeline, on synthetic inputs.
+
+For each number of simulations, each stage is run as the ensemble runs
+it, by blocks of simulations, and its time, throughput (simulations per
+second) and peak memory are reported. The peak memory is traced by
+`tracemalloc` in a separate run of the first block, since tracing slows
+down the timed code:
+
+- fair: FAIR control and pulse runs of a block of climate parameters
+  (`ensemble_runner.temperature_anomalies_block`),
+- damages: marginal damages of all the damage function specifications
+  (`ensemble_runner.marginal_damages`),
+- discounting: SCCs of all discount rates (`discounting.compute_scc`),
+- quantiles: quantiles of the SCCs of all the simulations, weighted by
+  the quantile regression weights (`weighted_quantiles`), in one call.
+
+The inputs of each block are generated by `synthetic.py` outside of the
+timed section.
+
+Usage, from the 5_scc folder:
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 100000 --output benchmarks.json
+    python benchmarks/run_benchmarks.py --stages discounting quantiles --central
+
+--------------------------------------------------------------------------
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "functions"))
+
+import synthetic
+import ensemble_runner
+import fair_ensemble
+import discounting
+import weighted_quantiles
+
+STAGES = ["fair", "damages", "discounting", "quantiles"]
+
+SIZES = [1000, 10000, 100000]
+
+# simulations per block, as in full_uncertainty_ensemble.ipynb
+BLOCK_SIZE = 250
+
+
+def _time(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def _peak_memory(func, *args):
+    """
+        Returns:
+        int: peak memory allocated by func(*args), in bytes. Tracing slows down python code a lot, so it's measured
+        separately from the timings
+    """
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def _blocks(n_simulations, block_size):
+    for start in range(0, n_simulations, block_size):
+        yield np.arange(start, min(start + block_size, n_simulations))
+
+
+def _by_blocks(n_simulations, block_size, inputs, func, memory=True):
+    """
+        Runs func(*inputs(block)) for each block of simulations, timing func only.
+
+        Returns:
+        (double, int): total seconds, and peak memory of the first block (None if not `memory`)
+    """
+    blocks = list(_blocks(n_simulations, block_size))
+    peak = _peak_memory(func, *inputs(blocks[0])) if memory else None
+    seconds = sum(_time(func, *inputs(block)) for block in blocks)
+    return seconds, peak
+
+
+def bench_fair(n_simulations, block_size=BLOCK_SIZE, quantilereg=True, memory=True):
+    params = synthetic.climate_parameters(n_simulations)
+    return _by_blocks(
+        n_simulations, block_size, lambda block: (params[block],), ensemble_runner.temperature_anomalies_block, memory
+    )
+
+
+def bench_damages(n_simulations, block_size=BLOCK_SIZE, quantilereg=True, memory=True):
+    spec = synthetic.damage_spec(quantilereg)
+    return _by_blocks(
+        n_simulations,
+        block_size,
+        lambda block: (synthetic.temperature_anomalies(block, seed=int(block[0])), spec),
+        ensemble_runner.marginal_damages,
+        memory,
+    )
+
+
+def bench_discounting(n_simulations, block_size=BLOCK_SIZE, quantilereg=True, memory=True):
+    return _by_blocks(
+        n_simulations,
+        block_size,
+        lambda block: (synthetic.damages(block, quantilereg, seed=int(block[0])),),
+        discounting.compute_scc,
+        memory,
+    )
+
+
+def bench_quantiles(n_simulations, block_size=BLOCK_SIZE, quantilereg=True, memory=True):
+    # SCCs of all the simulations, with the cells of the SCCs of the ensemble
+    spec = synthetic.damage_spec(quantilereg)
+    cells = spec.index.droplevel("pctile").unique() if quantilereg else spec.index
+    shape = [n_simulations, len(cells), len(ensemble_runner.RCPS), len(discounting.DISCOUNT_RATES)]
+    dims = ["simulation", "scenario", "rcp", "discrate"]
+    if quantilereg:
+        shape.insert(1, len(synthetic.PCTILES))
+        dims.insert(1, "pctile")
+
+    rng = np.random.RandomState(0)
+    scc = xr.DataArray(
+        rng.lognormal(3, 1, shape), dims=dims, coords={"simulation": np.arange(n_simulations), "scenario": np.arange(len(cells))}
+    )
+    if quantilereg:
+        scc["pctile"] = synthetic.PCTILES
+        func = lambda: weighted_quantiles.weighted_quantile_xr(
+            scc, [0.01, 0.05, 0.17, 0.25, 0.5, 0.75, 0.83, 0.95, 0.99], weights=weighted_quantiles.get_weights(synthetic.PCTILES)
+        )
+    else:
+        func = lambda: scc.quantile([0.01, 0.05, 0.17, 0.25, 0.5, 0.75, 0.83, 0.95, 0.99], dim="simulation")
+
+    return _time(func), (_peak_memory(func) if memory else None)
+
+
+BENCHMARKS = {
+    "fair": bench_fair,
+    "damages": bench_damages,
+    "discounting": bench_discounting,
+    "quantiles": bench_quantiles,
+}
+
+
+def run_benchmarks(stages=STAGES, sizes=SIZES, block_size=BLOCK_SIZE, quantilereg=True, memory=True):
+    """
+        Parameters:
+        stages (list of str): stages to benchmark, see BENCHMARKS
+        sizes (list of int): numbers of simulations
+        block_size (int): simulations per block, for the stages run by blocks
+        quantilereg (boolean): quantile regression damage functions if true, central damage functions otherwise
+        memory (boolean): if true -> also measure the peak memory, in a separate run of a block (or of the quantiles)
+
+        Returns:
+        DataFrame: one row per stage and number of simulations, with the time, throughput and peak memory
+    """
+    results = []
+    for stage in stages:
+        if stage == "fair" and not fair_ensemble.FAIR_SCM_SUPPORTED:
+            print("fair: skipped, FAIR 1.3.2 requires numpy < 2")
+            continue
+        for n in sizes:
+            seconds, peak = BENCHMARKS[stage](n, block_size, quantilereg, memory)
+            peak_mb = None if peak is None else peak / 1024 ** 2
+            results.append(
+                dict(
+                    stage=stage,
+                    simulations=n,
+                    block_size=block_size,
+                    quantilereg=quantilereg,
+                    seconds=seconds,
+                    simulations_per_second=n / seconds,
+                    peak_memory_mb=peak_mb,
+                )
+            )
+            print("{:12s} {:>8d} simulations: {:8.2f} s, {:10.0f} simulations/s, peak memory {} MB".format(
+                stage, n, seconds, n / seconds, "-" if peak_mb is None else "{:.1f}".format(peak_mb)))
+    return pd.DataFrame(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of simulations")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE, help="simulations per block")
+    parser.add_argument("--central", action="store_true", help="central damage functions instead of the quantile regression ones")
+    parser.add_argument("--no-memory", action="store_true", help="don't measure the peak memory")
+    parser.add_argument("--output", default=None, help="JSON file of the results")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.stages, args.sizes, args.block_size, not args.central, not args.no_memory)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results.to_dict(orient="records"), f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
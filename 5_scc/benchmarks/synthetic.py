@@ -0,0 +1,188 @@
+"""
+--------------------------------------------------------------------------
+Synthetic inputs for the SCC pipeline.
+
+The notebooks and `functions/` modules read damage function coefficients
+from the CSVs of `4_damage_function` and climate parameters from the
+netCDFs of `functions/climate/parameters`. The functions here generate
+inputs of the same layout, with random values of plausible magnitude,
+so that the pipeline stages can be run and benchmarked without them:
+
+- damage function coefficients with the index and coefficient columns
+  of the CSVs written by `estimate_damage_functions.do`,
+- (simulation x 4) tcr, ecs, d2, tau4 climate parameters,
+- temperature anomalies and damages with the layout of the outputs of
+  `ensemble_runner.py`.
+
+Usage, from the 5_scc folder, to write synthetic coefficient CSVs that
+`ensemble_runner.py --input-dir` reads:
+
+    python benchmarks/synthetic.py /tmp/synthetic --quantilereg
+
+--------------------------------------------------------------------------
+"""
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "functions"))
+
+import ensemble_runner
+
+YEARS = np.arange(ensemble_runner.START_YEAR, 2301)
+
+# valuation scenarios of the damage functions
+AGE_ADJUSTMENTS = ["mt", "vly", "vsl"]
+VSL_VALUES = ["epa"]
+HETEROGENEITIES = ["popavg", "scaled"]
+
+# quantiles of the quantile regression damage functions
+PCTILES = np.round(np.arange(0.05, 1.0, 0.05), 2)
+
+
+def damage_coefficients(quantilereg=True, years=YEARS, seed=0):
+    """
+        Parameters:
+        quantilereg (boolean): quantile regression coefficients if true, central coefficients otherwise
+        years (list-like of int): years of the coefficients
+        seed (int): random seed
+
+        Returns:
+        DataFrame: coefficients with the columns of the damage function coefficients CSVs, age_adjustment,
+        vsl_value, heterogeneity, year, (pctile,) cons, beta1, beta2, anomalymin, anomalymax
+    """
+    rng = np.random.RandomState(seed)
+    levels = [AGE_ADJUSTMENTS, VSL_VALUES, HETEROGENEITIES, list(years)]
+    names = ["age_adjustment", "vsl_value", "heterogeneity", "year"]
+    if quantilereg:
+        levels.append(list(PCTILES))
+        names.append("pctile")
+    index = pd.MultiIndex.from_product(levels, names=names)
+
+    # damages in billion $ per degree, increasing with the quantile of the quantile regressions
+    shift = index.get_level_values("pctile").values - 0.5 if quantilereg else 0.0
+    trend = (index.get_level_values("year").values - years[0]) / (years[-1] - years[0])
+    df = pd.DataFrame(
+        {
+            "cons": rng.normal(0, 10, len(index)),
+            "beta1": (1 + trend) * (5 + 10 * shift) + rng.normal(0, 1, len(index)),
+            "beta2": (1 + trend) * (1 + 2 * shift) + rng.normal(0, 0.2, len(index)),
+            "anomalymin": 0.0,
+            "anomalymax": 11.0,
+        },
+        index=index,
+    )
+    return df.reset_index()
+
+
+def write_damage_coefficients(folder, quantilereg=True, slug=ensemble_runner.DAMAGE_SLUG, ssp="SSP3", seed=0):
+    """
+        Parameters:
+        folder (str): folder of the CSV, read by ensemble_runner.load_damage_spec(folder, quantilereg)
+        quantilereg (boolean): see damage_coefficients()
+        slug (str): damage function name
+        ssp (str): SSP of the file name
+        seed (int): random seed
+
+        Returns:
+        str: path of the CSV
+    """
+    os.makedirs(folder, exist_ok=True)
+    if quantilereg:
+        path = "{}/mortality_damage_coefficients_{}_quantilereg_{}.csv".format(folder, slug, ssp)
+    else:
+        path = "{}/mortality_damage_coefficients_{}_{}.csv".format(folder, slug, ssp)
+    damage_coefficients(quantilereg, seed=seed).to_csv(path, index=False)
+    return path
+
+
+def damage_spec(quantilereg=True, seed=0):
+    """
+        Returns:
+        DataFrame: synthetic damage function specifications, as returned by ensemble_runner.load_damage_spec()
+    """
+    df = damage_coefficients(quantilereg, seed=seed)
+    index = ["age_adjustment", "vsl_value", "heterogeneity", "year"] + (["pctile"] if quantilereg else [])
+    if not quantilereg:
+        df.insert(0, "SSP", "SSP3")
+        index = ["SSP"] + index
+    df = df.set_index(index)
+    df.columns.names = ["coefficient"]
+    return df.unstack("year")
+
+
+def climate_parameters(n_simulations, seed=0):
+    """
+        Parameters:
+        n_simulations (int): number of parameter sets
+        seed (int): random seed
+
+        Returns:
+        np.array: (simulation x 4) tcr, ecs, d2, tau4 climate parameters, as lcp.get_parameters()
+    """
+    rng = np.random.RandomState(seed)
+    tcr = rng.uniform(1.0, 2.5, n_simulations)
+    # ecs above tcr
+    ecs = tcr + rng.lognormal(0.4, 0.4, n_simulations)
+    d2 = rng.uniform(2.0, 8.0, n_simulations)
+    tau4 = rng.uniform(3.0, 6.0, n_simulations)
+    return np.stack([tcr, ecs, d2, tau4], axis=1)
+
+
+def temperature_anomalies(simulations, years=np.arange(ensemble_runner.START_YEAR, 2501), seed=0):
+    """
+        Parameters:
+        simulations (list-like of int): simulation indices
+        years (list-like of int): years of the anomalies
+        seed (int): random seed
+
+        Returns:
+        DataArray: (simulation x pulse x rcp x year) temperature anomalies, as
+        ensemble_runner.temperature_anomalies_block()
+    """
+    rng = np.random.RandomState(seed)
+    n = len(simulations)
+    t = (np.asarray(years) - years[0]) / 100.0
+    # warming paths by rcp, scaled by a climate sensitivity per simulation, and the response to the pulse
+    warming = np.stack([1.5 * t / (1 + 0.5 * t), 4.0 * t / (1 + 0.2 * t)])
+    control = rng.uniform(0.5, 1.5, (n, 1, 1)) * warming[None]
+    pulse = control + 0.002 * (np.asarray(years) >= ensemble_runner.PULSE_YEAR)
+    return xr.DataArray(
+        np.stack([control, pulse], axis=1),
+        dims=["simulation", "pulse", "rcp", "year"],
+        coords=[list(simulations), ["rcp", "pulse"], ensemble_runner.RCPS, list(years)],
+    )
+
+
+def damages(simulations, quantilereg=True, seed=0):
+    """
+        Parameters:
+        simulations (list-like of int): simulation indices
+        quantilereg (boolean): see damage_coefficients()
+        seed (int): random seed
+
+        Returns:
+        Dataset: 'mortrate' marginal damages, with the layout of the intermediate files of ensemble_runner.py
+    """
+    rng = np.random.RandomState(seed)
+    spec = damage_spec(quantilereg, seed)
+    n_years = len(spec.columns.unique(level="year"))
+    values = rng.lognormal(-6, 1, (len(simulations), len(spec), len(ensemble_runner.RCPS), n_years))
+    return ensemble_runner.damages_dataset(values, np.asarray(simulations), spec)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("folder", help="folder of the synthetic damage function coefficients CSV")
+    parser.add_argument("--quantilereg", action="store_true", help="quantile regression coefficients; central coefficients otherwise")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    print(write_damage_coefficients(args.folder, args.quantilereg, seed=args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+--------------------------------------------------------------------------
+Evaluation of the polynomial damage functions.
+
+The damage functions are polynomials of the temperature anomaly, whose
+coefficients ('cons', 'beta1', 'beta2', ...) vary by year and
+valuation scenario. `FAIR_pulse.ipynb` evaluated them as
+`(coeffs * temps ** powers).sum('coeff')`, allocating the power of the
+temperature anomalies of each coefficient, broadcast against all the
+dimensions of the coefficients. Here they are evaluated with the
+Horner scheme: the damages are accumulated in place in a single output
+array, with one multiplication and one addition per degree.
+--------------------------------------------------------------------------
+"""
+import numpy as np
+import xarray as xr
+
+
+def coefficient_powers(coeff_names):
+    """
+        Parameters:
+        coeff_names (list of str): damage function coefficient names, 'cons' and 'beta1', 'beta2', ...
+
+        Returns:
+        list of int: power of the temperature anomaly multiplied by each coefficient
+    """
+    return [0 if c == "cons" else int(c.replace("beta", "")) for c in coeff_names]
+
+
+def horner(coeffs, x, out=None):
+    """
+        Evaluates sum_k coeffs[k] * x ** k in place, in a single output array.
+
+        Parameters:
+        coeffs (list of np.array or None): coefficients of each power of `x`, in increasing order, broadcastable
+            against `x`. None for the powers without a coefficient
+        x (np.array): values at which the polynomial is evaluated
+        out (np.array or None): output array, of the broadcast shape of `x` and the coefficients
+
+        Returns:
+        np.array: value of the polynomial
+    """
+    coeffs = list(coeffs)
+    while coeffs and coeffs[-1] is None:
+        coeffs.pop()
+    shape = np.broadcast(x, *[c for c in coeffs if c is not None]).shape if coeffs else np.shape(x)
+    if out is None:
+        out = np.empty(shape, dtype=np.result_type(x, *[c for c in coeffs if c is not None] or [float]))
+    if not coeffs:
+        out[...] = 0
+        return out
+
+    out[...] = coeffs[-1]
+    for c in reversed(coeffs[:-1]):
+        np.multiply(out, x, out=out)
+        if c is not None:
+            np.add(out, c, out=out)
+    return out
+
+
+def extend_coefficients(coeffs, years=None, hold_fixed_after=None):
+    """
+        Parameters:
+        coeffs (Dataset or DataArray): damage function coefficients with a 'year' dimension
+        years (list-like of int or None): if not None -> years to which the coefficients are reindexed
+        hold_fixed_after (int or None): if not None -> coefficients of the years after it are those of that year,
+            as with `hold_2100_damages_fixed` in FAIR_pulse.ipynb
+
+        Returns:
+        Dataset or DataArray: coefficients, with their dimensions in the same order
+    """
+    if years is not None:
+        coeffs = coeffs.reindex(year=list(years))
+    if hold_fixed_after is not None:
+        coeffs = coeffs.where(coeffs.year <= hold_fixed_after, coeffs.sel(year=hold_fixed_after, drop=True))
+    return coeffs
+
+
+def evaluate(coeffs, temperatures, dim="coeff"):
+    """
+        Evaluates the damage functions at the temperature anomalies, with the Horner scheme.
+
+        Parameters:
+        coeffs (Dataset or DataArray): damage function coefficients, one variable per coefficient or along `dim`,
+            as `coeffs_all_years` in FAIR_pulse.ipynb
+        temperatures (DataArray): temperature anomalies, with any dimensions. The years (or any other coordinate)
+            common to `coeffs` and `temperatures` are evaluated
+        dim (str): coefficient dimension of `coeffs`, if a DataArray
+
+        Returns:
+        DataArray: damages, with the dimensions of `temperatures` followed by those of `coeffs` other than `dim`
+    """
+    if isinstance(coeffs, xr.Dataset):
+        coeffs = coeffs.to_array(dim)
+
+    powers = coefficient_powers(coeffs[dim].values)
+    by_power = [None] * (max(powers) + 1)
+    for i, p in enumerate(powers):
+        by_power[p] = coeffs.isel({dim: i}, drop=True)
+
+    aligned = xr.align(temperatures, *[c for c in by_power if c is not None], join="inner")
+    aligned = xr.broadcast(*aligned)
+    temperatures = aligned[0]
+    terms = iter(aligned[1:])
+    by_power = [None if c is None else next(terms).transpose(*temperatures.dims) for c in by_power]
+
+    if temperatures.chunks is not None:
+        # dask arrays can't be updated in place
+        damages = by_power[-1]
+        for c in reversed(by_power[:-1]):
+            damages = damages * temperatures if c is None else damages * temperatures + c
+        return damages
+
+    values = horner([None if c is None else c.values for c in by_power], temperatures.values)
+    return xr.DataArray(values, dims=temperatures.dims, coords=temperatures.coords)
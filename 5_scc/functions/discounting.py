@@ -0,0 +1,208 @@
+"""
+--------------------------------------------------------------------------
+Constant rate discounting of marginal damages time series.
+
+`full_uncertainty_ensemble.ipynb` discounted the damages of all the
+simulations for each discount rate, concatenated the discounted time
+series along a `discrate` dimension, and summed them over years. For
+quantile regression damages, this intermediate array is tens of GB.
+
+Here the SCC of all the discount rates is computed at once, as a
+contraction of the damages with a (discrate x year) matrix of discount
+factors. With dask backed damages, the contraction is computed by
+chunks of simulations, and the discounted time series are never
+materialized. They are only computed, one discount rate at a time, when
+their quantiles are requested.
+
+For SCC curves over dense grids of constant discount rates, the damages
+from the pulse year are kept as a contiguous (stream x year) matrix, and
+the SCCs of all rates are one matrix product of it with the
+(year x discrate) matrix of the powers of 1 / (1 + r). Dask backed
+damages are not loaded: the product is computed for each chunk of
+simulations, with all the years in a chunk.
+--------------------------------------------------------------------------
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+import weighted_quantiles
+
+PULSE_YEAR = 2020
+
+# NOTE: as of 7/13/2020, adding in 1.5% and 2% discount rates
+DISCOUNT_RATES = [0.01, 0.015, 0.02, 0.025, 0.03, 0.05]
+
+
+def discount_factors(years, rates=DISCOUNT_RATES, pulse_year=PULSE_YEAR):
+    """
+        Parameters:
+        years (array-like of int): years of the damages
+        rates (list-like of double): constant discount rates, as fractions
+        pulse_year (int): year to which damages are discounted
+
+        Returns:
+        DataArray: (discrate x year) discount factors 1 / (1 + r) ** (year - pulse_year)
+    """
+    years = np.asarray(years)
+    rates = pd.Index(list(rates), name="discrate")
+    return xr.DataArray(
+        1.0 / (1.0 + rates.values[:, None]) ** (years[None, :] - pulse_year),
+        dims=["discrate", "year"],
+        coords=[rates, years],
+    )
+
+
+def _damages(ds, var):
+    return ds[var] if isinstance(ds, xr.Dataset) else ds
+
+
+def compute_scc(ds, var="mortrate", rates=DISCOUNT_RATES, pulse_year=PULSE_YEAR, chunks=None):
+    """
+        Sums the discounted damages over years, for all discount rates at once. Missing damages are skipped, as
+        by the sum over years of full_uncertainty_ensemble.ipynb.
+
+        Parameters:
+        ds (Dataset or DataArray): marginal damages time series with a 'year' dimension, numpy or dask backed
+        var (str): damages variable of `ds`, if a Dataset
+        rates (list-like of double): constant discount rates, as fractions
+        pulse_year (int): year to which damages are discounted
+        chunks (int or None): if not None -> number of simulations per dask chunk of the contraction
+
+        Returns:
+        Dataset: 'scc' variable with a 'discrate' dimension in place of 'year'
+    """
+    damages = _damages(ds, var)
+    if chunks is not None:
+        damages = damages.chunk({"simulation": chunks, "year": -1})
+
+    factors = discount_factors(damages.year.values, rates, pulse_year)
+    # xr.dot propagates missing values, unlike .sum(dim='year')
+    return xr.dot(damages.fillna(0), factors, dims="year").to_dataset(name="scc")
+
+
+def discounted_timeseries(ds, rate, var="mortrate", pulse_year=PULSE_YEAR):
+    """
+        Parameters:
+        ds (Dataset or DataArray): marginal damages time series with a 'year' dimension
+        rate (double): constant discount rate, as a fraction
+        var (str): damages variable of `ds`, if a Dataset
+        pulse_year (int): year to which damages are discounted
+
+        Returns:
+        DataArray: 'discounted_{var}' damages discounted at `rate`
+    """
+    damages = _damages(ds, var)
+    discounted = damages * discount_factors(damages.year.values, [rate], pulse_year).isel(discrate=0, drop=True)
+    return discounted.rename("discounted_{}".format(var))
+
+
+def discounted_timeseries_quantiles(ds, quantile, var="mortrate", rates=DISCOUNT_RATES, pulse_year=PULSE_YEAR):
+    """
+        Quantiles of the discounted damages time series. The discounted time series of one discount rate
+        are computed at a time.
+
+        Parameters:
+        ds (Dataset or DataArray): marginal damages time series with a 'year' dimension
+        quantile (callable): function computing the quantiles of the Dataset of a 'discounted_{var}' variable,
+            e.g. lambda ds: ds.quantile(qs, dim='simulation')
+        var (str): damages variable of `ds`, if a Dataset
+        rates (list-like of double): constant discount rates, as fractions
+        pulse_year (int): year to which damages are discounted
+
+        Returns:
+        Dataset or DataArray: quantiles with a 'discrate' dimension, as returned by `quantile`
+    """
+    return xr.concat(
+        [quantile(discounted_timeseries(ds, r, var, pulse_year).to_dataset()) for r in rates],
+        dim=pd.Index(list(rates), name="discrate"),
+    )
+
+
+def damage_streams(ds, var="mortrate", pulse_year=PULSE_YEAR, chunks=None):
+    """
+        Marginal damages from the pulse year, with 'year' as the last, contiguous dimension. Marginal damages of the
+        years before the pulse are zero, and missing damages are skipped, as in compute_scc().
+
+        Numpy backed damages are loaded, so that they must fit in memory, with their SCCs for all the rates of the
+        grid. Dask backed damages stay so, with all the years in each chunk, and scc_curve() computes their SCCs by
+        chunks.
+
+        Parameters:
+        ds (Dataset or DataArray): marginal damages time series with a 'year' dimension
+        var (str): damages variable of `ds`, if a Dataset
+        pulse_year (int): year of the pulse
+        chunks (int or None): if not None -> number of simulations per dask chunk
+
+        Returns:
+        DataArray: damage streams, numpy backed unless `ds` is dask backed or `chunks` is given
+    """
+    damages = _damages(ds, var).sel(year=slice(pulse_year, None)).fillna(0)
+    if chunks is not None:
+        damages = damages.chunk({"simulation": chunks})
+    dims = [d for d in damages.dims if d != "year"] + ["year"]
+    damages = damages.transpose(*dims)
+    if damages.chunks is not None:
+        return damages.chunk({"year": -1})
+    return damages.copy(data=np.ascontiguousarray(damages.values))
+
+
+def _scc_matmul(streams, factors):
+    return np.ascontiguousarray(streams).reshape(-1, streams.shape[-1]).dot(factors).reshape(
+        streams.shape[:-1] + (factors.shape[-1],)
+    )
+
+
+def scc_curve(streams, rates, pulse_year=PULSE_YEAR):
+    """
+        SCCs of all the damage streams for a grid of constant discount rates, as one matrix product, or one per chunk
+        of dask backed streams.
+
+        Parameters:
+        streams (DataArray): damage streams, as returned by damage_streams()
+        rates (list-like of double): constant discount rates, as fractions, e.g. np.arange(0.005, 0.07, 0.0005)
+        pulse_year (int): year to which damages are discounted
+
+        Returns:
+        DataArray: 'scc' with the dimensions of `streams` other than 'year', and a last 'discrate' dimension
+    """
+    factors = discount_factors(streams.year.values, rates, pulse_year)
+    streams = streams.transpose(..., "year")
+    dims = list(streams.dims[:-1]) + ["discrate"]
+    coords = dict({d: streams[d] for d in streams.dims[:-1] if d in streams.coords}, discrate=factors.discrate)
+
+    if streams.chunks is not None:
+        data = streams.data.rechunk({streams.ndim - 1: -1})
+        scc = data.map_blocks(
+            _scc_matmul,
+            factors.values.T,
+            chunks=data.chunks[:-1] + ((len(factors.discrate),),),
+            dtype=np.result_type(data.dtype, factors.dtype),
+        )
+    else:
+        scc = _scc_matmul(streams.values, factors.values.T)
+    return xr.DataArray(scc, dims=dims, coords=coords, name="scc")
+
+
+def scc_curve_quantiles(scc, quantiles, dim="simulation", weight_dim="pctile"):
+    """
+        Parameters:
+        scc (DataArray): SCCs, as returned by scc_curve()
+        quantiles (list-like of double): quantiles to compute, between 0-1
+        dim (str): simulation dimension
+        weight_dim (str): quantile regression dimension. If in `scc`, the quantiles are weighted by the quantile
+            regression weights, as quantile_weight_quantilereg() in full_uncertainty_ensemble.ipynb
+
+        Returns:
+        DataArray: quantiles of the SCCs across simulations, for each discount rate
+    """
+    if weight_dim in scc.dims:
+        return weighted_quantiles.weighted_quantile_xr(
+            scc,
+            quantiles,
+            weights=weighted_quantiles.get_weights(scc[weight_dim].values),
+            dim=dim,
+            weight_dim=weight_dim,
+        )
+    if scc.chunks is not None:
+        scc = scc.chunk({dim: -1})
+    return scc.quantile(quantiles, dim=dim)
@@ -0,0 +1,580 @@
+"""
+--------------------------------------------------------------------------
+Local, resumable runner for the climate and full uncertainty ensemble.
+
+Runs the `compute_and_save_damages_block` workflow of
+`full_uncertainty_ensemble.ipynb` on a local process pool or a dask
+LocalCluster, instead of a kubernetes cluster:
+
+- the climate parameter sets are split into blocks sized to a memory
+  budget per worker, and only a bounded number of blocks is in flight,
+- each block is written to a temporary file and then moved to its
+  intermediate file name, so that a file on disk is always complete,
+- blocks covered by existing intermediate files are skipped, so an
+  interrupted run is resumed by running the same command again,
+- by default, only the climate draws accepted by the filter mask of the
+  climate parameters version are run. The post-processing drops the
+  rejected draws anyway, with `.where(lcp.get_filter_mask(), drop=True)`.
+  Outputs keep the original `simulation` index of the draws.
+
+FAIR is run with the vectorized kernel of `fair_ensemble.py`. The
+intermediate files have the layout read by the post-processing section
+of the notebook.
+
+Usage, from the 5_scc folder:
+
+    python functions/ensemble_runner.py --quantilereg --workers 8
+    python functions/ensemble_runner.py --quantilereg --status
+
+--------------------------------------------------------------------------
+"""
+import os
+import re
+import glob
+import argparse
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import xarray as xr
+import load_climate_parameters as lcp
+import load_fair
+import fair_ensemble
+import scc_sweep
+import instrumentation
+
+REFERENCE_YEAR = 1765
+
+# year in which damages start being calculated (determined by first year in damages coefs file)
+START_YEAR = 2015
+
+PULSE_YEAR = 2020
+
+# in Gt C = 1e9 ton C
+PULSE_AMT = 1.0
+
+MAGNITUDE_OF_DAMAGES = 1e9  # magnitude of damage function values
+
+# base period of the temperature anomalies (inclusive)
+BASE_PERIOD = [2001, 2010]
+
+RCPS = ["rcp45", "rcp85"]
+
+# first year of the saved climate model outputs
+CLIMATE_START_YEAR = 2000
+
+DAMAGE_SLUG = "quadratic_IGIA_MC_global_poly4_uclip_sharecombo"
+
+# index columns in the damage function specification csv's
+CENTRAL_INDEX_COLS = [0, 1, 2, 3]
+QR_INDEX_COLS = [0, 1, 2, 3, 4]
+
+# memory budget of one block, in bytes
+MEMORY_PER_WORKER = 2 * 1024 ** 3
+
+# largest block, so that a failed block doesn't lose much work
+MAX_BLOCK_SIZE = 1000
+
+
+def load_damage_spec(input_dir, quantilereg=True, slug=DAMAGE_SLUG, ssp="SSP3"):
+    """
+        Reads the damage function coefficients, as get_central_damage_parameters() and
+        get_quantilereg_damage_parameters() in full_uncertainty_ensemble.ipynb.
+
+        Parameters:
+        input_dir (str): folder of the damage function coefficients, `DB/4_damage_function/`
+        quantilereg (boolean): if true -> quantile regression damage functions (full uncertainty), else central damage functions (climate-only uncertainty)
+        slug (str): damage function name
+        ssp (str): socioeconomic scenario
+
+        Returns:
+        DataFrame: one row per damage function specification, with (coefficient, year) columns
+    """
+    if quantilereg:
+        damage_path = "{}/mortality_damage_coefficients_{}_quantilereg_{}.csv".format(input_dir, slug, ssp)
+        damage_params = pd.read_csv(damage_path, index_col=QR_INDEX_COLS)
+    else:
+        damage_path = "{}/mortality_damage_coefficients_{}_{}.csv".format(input_dir, slug, ssp)
+        damage_params = pd.concat(
+            {ssp: pd.read_csv(damage_path, index_col=CENTRAL_INDEX_COLS)}, axis=0, names=["SSP"]
+        )
+
+    damage_params.columns.names = ["coefficient"]
+    return damage_params.unstack("year")
+
+
+def output_template(output_dir, quantilereg=True, return_model_vars=False, slug=DAMAGE_SLUG):
+    """
+        Parameters:
+        output_dir (str): folder of the intermediate results, `DB/5_scc/global_scc/quadratic/uncertainty/`
+        quantilereg (boolean): full uncertainty if true, climate-only uncertainty otherwise
+        return_model_vars (boolean): if true -> files of climate model outputs, else files of damages
+        slug (str): damage function name
+
+        Returns:
+        str: intermediate file path with `{start}` and `{stop}` fields for the simulation range
+    """
+    prefix, uncertainty = ("quantilereg", "fulluncertainty") if quantilereg else ("climateonly", "climateuncertainty")
+    varname = "climate" if return_model_vars else "mortrate"
+    return os.path.join(
+        output_dir,
+        "intermediate_{}_results".format(uncertainty),
+        "{}_mortality_damage_coefficients_{}_{}_raw_{{start}}-{{stop}}.nc".format(prefix, slug, varname),
+    )
+
+
+def _pulse_runs(climate_params):
+    """
+        Returns the control and pulse FAIR runs of RCPS for a block of climate parameters.
+    """
+    return fair_ensemble.run_fair_ensemble(
+        climate_params,
+        scenarios={rcp: load_fair.RCP_SCENARIOS[rcp] for rcp in RCPS},
+        pulses={"rcp": None, "pulse": (PULSE_YEAR, PULSE_AMT)},
+    )
+
+
+def temperature_anomalies_block(climate_params):
+    """
+        Parameters:
+        climate_params (np.array): (simulation x 4) tcr, ecs, d2, tau4 parameters, with an optional fifth aeroscale column
+
+        Returns:
+        DataArray: (simulation x pulse x rcp x year) temperature anomalies of the control ('rcp') and pulse ('pulse')
+        runs, relative to BASE_PERIOD, from START_YEAR
+    """
+    temperatures = _pulse_runs(climate_params).temperature
+    temperatures = temperatures - temperatures.sel(year=slice(*BASE_PERIOD)).mean(dim="year")
+    return temperatures.sel(year=slice(START_YEAR, None)).transpose("simulation", "pulse", "rcp", "year")
+
+
+def marginal_damages(temperatures, damage_spec):
+    """
+        Parameters:
+        temperatures (DataArray): (simulation x pulse x rcp x year) temperature anomalies, as returned by
+            temperature_anomalies_block(), for at least the years of `damage_spec`
+        damage_spec (DataFrame): damage function coefficients, as returned by load_damage_spec()
+
+        Returns:
+        np.array: (simulation x scenario x rcp x year) marginal damages in $ / ton CO2, for the years of `damage_spec`
+    """
+    # the coefficient files also have the range of the anomalies used in the damage function estimation
+    coeff_names = [c for c in damage_spec.columns.unique(level="coefficient") if c == "cons" or c.startswith("beta")]
+    years = damage_spec[coeff_names[0]].columns.values.astype(int)
+    coeffs = np.stack([damage_spec[c].values for c in coeff_names])
+    powers = scc_sweep.damage_polynomial_powers(coeff_names).values
+
+    with instrumentation.stage("damage_evaluation", simulations=temperatures.sizes["simulation"]):
+        # (simulation x pulse x rcp x year) -> (simulation x coefficient x rcp x year) powers of the pulse minus control anomalies
+        temperatures = temperatures.sel(pulse=["rcp", "pulse"], year=years).values
+        marginal_powers = (
+            temperatures[:, None, 1] ** powers[None, :, None, None] - temperatures[:, None, 0] ** powers[None, :, None, None]
+        )
+
+        conversion = MAGNITUDE_OF_DAMAGES * scc_sweep.GTC_TO_TCO2 / PULSE_AMT
+        return conversion * np.einsum("csy,ncry->nsry", coeffs, marginal_powers)
+
+
+def produce_mortality_estimate_from_parameter_block(climate_params, damage_spec):
+    """
+        Estimates the time series of marginal mortality damages of the pulse, as the function of the same name
+        in full_uncertainty_ensemble.ipynb, for all parameter sets of the block at once.
+
+        Parameters:
+        climate_params (np.array): (simulation x 4) tcr, ecs, d2, tau4 parameters, with an optional fifth aeroscale column
+        damage_spec (DataFrame): damage function coefficients, as returned by load_damage_spec()
+
+        Returns:
+        np.array: (simulation x scenario x rcp x year) marginal damages in $ / ton CO2, for the years of `damage_spec`
+    """
+    return marginal_damages(temperature_anomalies_block(climate_params), damage_spec)
+
+
+def produce_scc_pulse_climate_response_block(climate_params):
+    """
+        Parameters:
+        climate_params (np.array): (simulation x 4) climate parameters, see produce_mortality_estimate_from_parameter_block()
+
+        Returns:
+        np.array: (simulation x variable x rcp x year) pulse minus control CO2 concentrations, total forcing and
+        temperatures, from CLIMATE_START_YEAR
+    """
+    runs = _pulse_runs(climate_params).sel(year=slice(CLIMATE_START_YEAR, None))
+    response = runs.sel(pulse="pulse") - runs.sel(pulse="rcp")
+    return np.stack([response[v].values for v in ["concentration", "forcing", "temperature"]], axis=1)
+
+
+def _write_atomic(ds, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with instrumentation.stage("io_write", simulations=ds.sizes.get("simulation", 0)):
+            ds.to_netcdf(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def damages_dataset(damages, simulations, damage_spec):
+    """
+        Parameters:
+        damages (np.array): (simulation x scenario x rcp x year) marginal damages, as returned by marginal_damages()
+        simulations (np.array): simulation indices of the rows of `damages`
+        damage_spec (DataFrame): damage function coefficients, as returned by load_damage_spec()
+
+        Returns:
+        Dataset: 'mortrate' damages, with the levels of the damage function specifications as dimensions
+    """
+    return (
+        xr.DataArray(
+            damages,
+            dims=["simulation", "scenario", "rcp", "year"],
+            coords=[
+                simulations,
+                damage_spec.index,
+                RCPS,
+                damage_spec.columns.unique(level="year").values.astype(int),
+            ],
+        )
+        .to_dataset(name="mortrate")
+        .unstack("scenario")
+    )
+
+
+def compute_and_save_damages_block(
+    start, stop, climate_params, damage_spec, template, return_model_vars=False, simulations=None
+):
+    """
+        Computes damages, or climate model outputs, for a block of climate parameters and saves them to disk.
+        Does nothing if the file of the block already exists.
+
+        Parameters:
+        start, stop (int): simulation range of the block
+        climate_params (np.array): simulation x 4 climate parameters of the block
+        damage_spec (DataFrame): damage function coefficients, as returned by load_damage_spec()
+        template (str): intermediate file path, as returned by output_template()
+        return_model_vars (boolean): If True, save climate model (FaIR) output to disk. If False, save damages (mortality rate) to disk
+        simulations (np.array or None): simulation indices of the rows of `climate_params`, within [start, stop).
+            Defaults to all the simulations of the range.
+
+        Returns:
+        str: path of the intermediate file
+    """
+    path = template.format(start=start, stop=stop)
+    if os.path.isfile(path):
+        return path
+
+    simulations = np.arange(start, stop) if simulations is None else simulations
+
+    if return_model_vars:
+        ds = xr.DataArray(
+            produce_scc_pulse_climate_response_block(climate_params),
+            dims=["simulation", "variable", "rcp", "year"],
+            coords=[
+                simulations,
+                ["concentration", "total_forcing", "temperature"],
+                RCPS,
+                load_fair.RCP_SCENARIOS[RCPS[0]][CLIMATE_START_YEAR - REFERENCE_YEAR :, 0].astype(int),
+            ],
+        ).to_dataset(name="output")
+    else:
+        ds = damages_dataset(produce_mortality_estimate_from_parameter_block(climate_params, damage_spec), simulations, damage_spec)
+
+    _write_atomic(ds, path)
+    return path
+
+
+def completed_ranges(template):
+    """
+        Parameters:
+        template (str): intermediate file path, as returned by output_template()
+
+        Returns:
+        list of (int, int): sorted simulation ranges of the existing intermediate files
+    """
+    pattern = re.compile(re.escape(os.path.basename(template)).replace(r"\{start\}", r"(\d+)").replace(r"\{stop\}", r"(\d+)") + "$")
+    ranges = []
+    for path in glob.glob(template.format(start="*", stop="*")):
+        match = pattern.match(os.path.basename(path))
+        if match:
+            ranges.append((int(match.group(1)), int(match.group(2))))
+    return sorted(ranges)
+
+
+def block_size_for_memory(n_scenarios, return_model_vars=False, memory_per_worker=MEMORY_PER_WORKER):
+    """
+        Parameters:
+        n_scenarios (int): number of damage function specifications
+        return_model_vars (boolean): see compute_and_save_damages_block()
+        memory_per_worker (int): memory budget of one block, in bytes
+
+        Returns:
+        int: number of simulations of a block that fits in `memory_per_worker`
+    """
+    n_years = len(load_fair.RCP_SCENARIOS[RCPS[0]])
+    # FAIR outputs of the control and pulse runs, and their copies in the Dataset and anomalies
+    per_simulation = 3 * 3 * 2 * len(RCPS) * n_years
+    if not return_model_vars:
+        # powers of the anomalies, and the damages and their copy in the output Dataset
+        per_simulation += 3 * len(RCPS) * n_years + 2 * n_scenarios * len(RCPS) * n_years
+    return int(max(1, min(MAX_BLOCK_SIZE, memory_per_worker // (8 * per_simulation))))
+
+
+def resolve_mask(version, n_simulations):
+    """
+        Parameters:
+        version (str): climate parameters version, see lcp.get_filter_mask()
+        n_simulations (int): number of unfiltered climate parameter sets
+
+        Returns:
+        np.array: (simulation,) boolean mask of the accepted climate draws
+    """
+    mask = np.asarray(lcp.get_filter_registry(version).mask)
+    if mask.shape != (n_simulations,):
+        raise ValueError(
+            "filter mask of climate version {} has shape {}, expected ({},)".format(version, mask.shape, n_simulations)
+        )
+    return mask
+
+
+def plan_blocks(start, stop, block_size, done=(), mask=None):
+    """
+        Splits the simulations of [start, stop) into blocks of at most `block_size` simulations, leaving out the
+        simulations of `done` and those rejected by `mask`.
+
+        Parameters:
+        start, stop (int): simulation range to run
+        block_size (int): maximum number of simulations of a block
+        done (list of (int, int)): ranges already computed, as returned by completed_ranges()
+        mask (np.array or None): (simulation,) boolean mask of the simulations to run, for all the simulations. If None, all of them
+
+        Returns:
+        list of np.array: simulation indices of the blocks to run. The range of a block, from its first simulation to
+        its last one, doesn't overlap `done`
+    """
+    todo = np.ones(stop - start, dtype=bool)
+    for a, b in done:
+        todo[max(a, start) - start : max(min(b, stop) - start, 0)] = False
+
+    # contiguous runs of simulations not done, whose accepted simulations are cut into blocks
+    edges = np.flatnonzero(np.diff(np.concatenate([[False], todo, [False]]).astype(int)))
+    blocks = []
+    for a, b in zip(edges[::2] + start, edges[1::2] + start):
+        simulations = np.arange(a, b)
+        if mask is not None:
+            simulations = simulations[mask[a:b]]
+        blocks.extend(np.split(simulations, np.arange(block_size, len(simulations), block_size)))
+    return [block for block in blocks if len(block)]
+
+
+def run_blocks(
+    function,
+    blocks,
+    climate_params,
+    n_workers=None,
+    memory_per_worker=MEMORY_PER_WORKER,
+    scheduler="processes",
+    progress=True,
+    **kwargs
+):
+    """
+        Runs function(first, last + 1, climate_params[block], simulations=block, **kwargs) for each block of
+        simulations, keeping a bounded number of blocks in flight. The instrumentation records of the blocks are merged
+        into those of this process.
+
+        Parameters:
+        function (callable): block function returning the path of the file it writes, as compute_and_save_damages_block()
+        blocks (list of np.array): simulation indices of the blocks, as returned by plan_blocks()
+        climate_params (np.array): (simulation x 4) climate parameters, as lcp.get_parameters(filtered=False)
+        n_workers (int or None): number of worker processes, defaults to the number of CPUs
+        memory_per_worker (int): memory budget of one block, in bytes
+        scheduler (str): "processes" for a local process pool, or "dask" for a dask LocalCluster
+        progress (boolean): if true -> show a progress bar
+        kwargs: passed to `function`
+
+        Returns:
+        list of str: paths of the files written
+    """
+    n_workers = n_workers or os.cpu_count()
+
+    if scheduler == "processes":
+        executor = concurrent.futures.ProcessPoolExecutor(n_workers)
+        client = None
+    elif scheduler == "dask":
+        import dask.distributed as dd
+
+        client = dd.Client(dd.LocalCluster(n_workers=n_workers, threads_per_worker=1, memory_limit=memory_per_worker))
+        executor = client.get_executor(pure=False)
+    else:
+        raise ValueError("unknown scheduler {}".format(scheduler))
+
+    if progress:
+        import tqdm
+
+        bar = tqdm.tqdm(total=sum(len(block) for block in blocks), unit="simulation")
+
+    # keep a bounded number of blocks in flight, so that memory doesn't grow with the number of blocks
+    paths = []
+    failed = []
+    pending = {}
+    blocks = iter(blocks)
+    try:
+        while True:
+            for simulations in blocks:
+                a, b = simulations[0], simulations[-1] + 1
+                future = executor.submit(
+                    instrumentation.collected,
+                    function,
+                    a,
+                    b,
+                    climate_params[simulations],
+                    simulations=simulations,
+                    **kwargs
+                )
+                pending[future] = (a, b, len(simulations))
+                if len(pending) >= 2 * n_workers:
+                    break
+            if not pending:
+                break
+
+            finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                a, b, n = pending.pop(future)
+                try:
+                    path, records = future.result()
+                    paths.append(path)
+                    instrumentation.merge(records)
+                except Exception as e:
+                    print("block {}-{} failed: {!r}".format(a, b, e))
+                    failed.append((a, b))
+                if progress:
+                    bar.update(n)
+    finally:
+        executor.shutdown(wait=False)
+        if client is not None:
+            client.close()
+        if progress:
+            bar.close()
+
+    if failed:
+        raise RuntimeError(
+            "{} blocks failed: {}. Run again to resume.".format(len(failed), ", ".join("{}-{}".format(a, b) for a, b in failed))
+        )
+    return sorted(paths)
+
+
+def run_ensemble(
+    climate_params,
+    damage_spec,
+    template,
+    return_model_vars=False,
+    start=0,
+    stop=None,
+    mask=None,
+    block_size=None,
+    n_workers=None,
+    memory_per_worker=MEMORY_PER_WORKER,
+    scheduler="processes",
+    progress=True,
+):
+    """
+        Runs compute_and_save_damages_block() over all the blocks of [start, stop) that don't have an intermediate file yet.
+        Simulations rejected by `mask` are not run.
+
+        Parameters:
+        climate_params (np.array): (simulation x 4) climate parameters, as lcp.get_parameters(filtered=False)
+        damage_spec (DataFrame): damage function coefficients, as returned by load_damage_spec()
+        template (str): intermediate file path, as returned by output_template()
+        return_model_vars (boolean): see compute_and_save_damages_block()
+        start, stop (int): simulation range to run, defaults to all the simulations
+        mask (np.array or None): (simulation,) boolean mask of the climate draws to run, as returned by resolve_mask(). If None, all of them
+        block_size (int or None): number of simulations per block. If None, the largest block fitting in `memory_per_worker`
+        n_workers (int or None): number of worker processes, defaults to the number of CPUs
+        memory_per_worker (int): memory budget of one block, in bytes
+        scheduler (str): "processes" for a local process pool, or "dask" for a dask LocalCluster
+        progress (boolean): if true -> show a progress bar
+
+        Returns:
+        list of str: paths of the intermediate files written or found
+    """
+    stop = len(climate_params) if stop is None else min(stop, len(climate_params))
+    if block_size is None:
+        block_size = block_size_for_memory(len(damage_spec), return_model_vars, memory_per_worker)
+
+    done = completed_ranges(template)
+    blocks = plan_blocks(start, stop, block_size, done, mask)
+    paths = [template.format(start=a, stop=b) for a, b in done if a < stop and b > start]
+    n_todo = (stop - start) if mask is None else int(mask[start:stop].sum())
+    print(
+        "{} blocks to run, {} of {} simulations already done".format(
+            len(blocks), n_todo - sum(len(block) for block in blocks), n_todo
+        )
+    )
+    if not blocks:
+        return paths
+
+    paths += run_blocks(
+        compute_and_save_damages_block,
+        blocks,
+        climate_params,
+        n_workers=n_workers,
+        memory_per_worker=memory_per_worker,
+        scheduler=scheduler,
+        progress=progress,
+        damage_spec=damage_spec,
+        template=template,
+        return_model_vars=return_model_vars,
+    )
+    return sorted(paths)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--quantilereg", action="store_true", help="full uncertainty (quantile regression damage functions); climate-only uncertainty otherwise")
+    parser.add_argument("--model-vars", action="store_true", help="save the climate model outputs instead of the damages")
+    parser.add_argument("--input-dir", default="{}/4_damage_function/".format(os.getenv("DB")), help="damage function coefficients folder")
+    parser.add_argument("--output-dir", default="{}/5_scc/global_scc/quadratic/uncertainty/".format(os.getenv("DB")), help="intermediate results folder")
+    parser.add_argument("--climate-version", default=lcp.CURRENT_VERSION)
+    parser.add_argument("--start", type=int, default=0, help="first simulation")
+    parser.add_argument("--stop", type=int, default=None, help="end of the simulation range, defaults to all simulations")
+    parser.add_argument("--block-size", type=int, default=None, help="simulations per block, sized to --memory-per-worker by default")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--memory-per-worker", type=float, default=MEMORY_PER_WORKER / 1024 ** 3, help="memory budget of a worker, in GB")
+    parser.add_argument("--scheduler", choices=["processes", "dask"], default="processes")
+    parser.add_argument("--all-draws", action="store_true", help="also run the climate draws rejected by the filter mask of --climate-version")
+    parser.add_argument("--status", action="store_true", help="only report the simulations already done")
+    parser.add_argument("--report", default=None, help="JSON file of the time and memory of the stages of the run")
+    args = parser.parse_args(argv)
+
+    template = output_template(args.output_dir, args.quantilereg, args.model_vars)
+    climate_params = lcp.get_parameters(filtered=False, version=args.climate_version)
+    mask = None if args.all_draws else resolve_mask(args.climate_version, len(climate_params))
+
+    if args.status:
+        stop = len(climate_params) if args.stop is None else args.stop
+        missing = plan_blocks(args.start, stop, len(climate_params), completed_ranges(template), mask)
+        n_todo = (stop - args.start) if mask is None else int(mask[args.start : stop].sum())
+        print("{}: {} of {} simulations missing".format(template, sum(len(block) for block in missing), n_todo))
+        return
+
+    with instrumentation.stage("run"):
+        run_ensemble(
+            climate_params,
+            load_damage_spec(args.input_dir, args.quantilereg),
+            template,
+            return_model_vars=args.model_vars,
+            start=args.start,
+            stop=args.stop,
+            mask=mask,
+            block_size=args.block_size,
+            n_workers=args.workers,
+            memory_per_worker=int(args.memory_per_worker * 1024 ** 3),
+            scheduler=args.scheduler,
+        )
+
+    if args.report is not None:
+        instrumentation.report(args.report, **vars(args))
+        print(instrumentation.summary())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+--------------------------------------------------------------------------
+Zarr store of the damages of the climate and full uncertainty ensemble.
+
+`ensemble_runner.py` writes one intermediate netCDF file per block of
+simulations, which the post-processing opens with
+`xr.open_mfdataset(..., concat_dim='simulation')` and rechunks before
+reducing over simulations. Here the damages of all the simulations are
+written to a single zarr store instead:
+
+- the store is created with the full (simulation x rcp x year x
+  valuation scenario) shape, chunked by blocks of simulations, for each
+  rcp and valuation scenario, with all the years (and quantile
+  regression quantiles) in a chunk. The post-processing reads it with
+  `open_store()`, already chunked for reductions over simulations, once
+  all the chunks holding accepted simulations are written,
+- each block of the ensemble is the accepted simulations of one chunk of
+  simulations, so blocks are written in parallel without sharing a
+  chunk. Rejected simulations are missing values,
+- a chunk is marked as done once written, so an interrupted run is
+  resumed by running the same command again.
+
+This requires `zarr`, which isn't part of the `mortalityverse`
+environment; `ensemble_runner.py` writes the netCDF files without it.
+
+Usage, from the 5_scc folder:
+
+    python functions/ensemble_store.py --quantilereg --workers 8
+    python functions/ensemble_store.py --quantilereg --status
+
+--------------------------------------------------------------------------
+"""
+import os
+import argparse
+import numpy as np
+import xarray as xr
+import load_climate_parameters as lcp
+import ensemble_runner
+import instrumentation
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def _require_zarr():
+    if zarr is None:
+        raise ImportError("the ensemble store requires zarr, use ensemble_runner.py to write netCDF files instead")
+
+
+def store_path(output_dir, quantilereg=True, slug=ensemble_runner.DAMAGE_SLUG):
+    """
+        Parameters:
+        output_dir (str): folder of the intermediate results, `DB/5_scc/global_scc/quadratic/uncertainty/`
+        quantilereg (boolean): full uncertainty if true, climate-only uncertainty otherwise
+        slug (str): damage function name
+
+        Returns:
+        str: path of the zarr store, next to the intermediate netCDF files
+    """
+    return ensemble_runner.output_template(output_dir, quantilereg, slug=slug).replace("_raw_{start}-{stop}.nc", ".zarr")
+
+
+def create_store(path, damage_spec, n_simulations, chunk_size):
+    """
+        Creates an empty store, with missing damages for all simulations. Only the coordinates and metadata are written.
+
+        Parameters:
+        path (str): zarr store path, as returned by store_path()
+        damage_spec (DataFrame): damage function coefficients, as returned by ensemble_runner.load_damage_spec()
+        n_simulations (int): number of climate parameter sets, filtered or not
+        chunk_size (int): number of simulations per chunk, and per block of the ensemble
+    """
+    _require_zarr()
+    import dask.array as dda
+
+    n_years = len(damage_spec.columns.unique(level="year"))
+    example = ensemble_runner.damages_dataset(
+        np.zeros((1, len(damage_spec), len(ensemble_runner.RCPS), n_years)), np.arange(1), damage_spec
+    ).mortrate
+
+    # simulation-contiguous chunks, for each rcp and valuation scenario
+    chunks = tuple(
+        chunk_size if d == "simulation" else (example.sizes[d] if d in ("year", "pctile") else 1) for d in example.dims
+    )
+    mortrate = xr.DataArray(
+        dda.full((n_simulations,) + example.shape[1:], np.nan, chunks=chunks),
+        dims=example.dims,
+        coords=dict(example.drop_vars("simulation").coords, simulation=np.arange(n_simulations)),
+    )
+    n_chunks = -(-n_simulations // chunk_size)
+    ds = xr.Dataset(
+        {"mortrate": mortrate, "chunk_done": xr.DataArray(np.zeros(n_chunks, dtype=np.int8), dims=["simulation_chunk"])},
+        attrs={"chunk_size": chunk_size},
+    )
+    ds.to_zarr(
+        path,
+        mode="w-",
+        compute=False,
+        encoding={"mortrate": {"chunks": chunks}, "chunk_done": {"chunks": (1,)}},
+    )
+
+
+def completed_chunks(path):
+    """
+        Parameters:
+        path (str): zarr store path
+
+        Returns:
+        np.array: indices of the chunks of simulations already written
+    """
+    _require_zarr()
+    return np.flatnonzero(zarr.open_group(path, mode="r")["chunk_done"][:])
+
+
+def plan_store_blocks(path, mask=None):
+    """
+        Parameters:
+        path (str): zarr store path
+        mask (np.array or None): (simulation,) boolean mask of the simulations to run. If None, all of them
+
+        Returns:
+        list of np.array: simulation indices of the blocks to run, the accepted simulations of each chunk not written yet
+    """
+    _require_zarr()
+    group = zarr.open_group(path, mode="r")
+    chunk_size = group.attrs["chunk_size"]
+    n_simulations = group["mortrate"].shape[0]
+    done = set(completed_chunks(path))
+
+    blocks = []
+    for k in range(-(-n_simulations // chunk_size)):
+        if k in done:
+            continue
+        simulations = np.arange(k * chunk_size, min((k + 1) * chunk_size, n_simulations))
+        if mask is not None:
+            simulations = simulations[mask[simulations]]
+        if len(simulations):
+            blocks.append(simulations)
+    return blocks
+
+
+def compute_and_store_damages_block(start, stop, climate_params, damage_spec, path, simulations=None):
+    """
+        Computes the damages of a block of climate parameters, within one chunk of simulations, and writes the chunk to
+        the store. Does nothing if the chunk is already written.
+
+        Parameters:
+        start, stop (int): simulation range of the block
+        climate_params (np.array): simulation x 4 climate parameters of the block
+        damage_spec (DataFrame): damage function coefficients, as returned by ensemble_runner.load_damage_spec()
+        path (str): zarr store path
+        simulations (np.array or None): simulation indices of the rows of `climate_params`, within [start, stop).
+            Defaults to all the simulations of the range.
+
+        Returns:
+        str: path of the store
+    """
+    _require_zarr()
+    group = zarr.open_group(path, mode="r+")
+    chunk_size = group.attrs["chunk_size"]
+    k = start // chunk_size
+    if (stop - 1) // chunk_size != k:
+        raise ValueError("block {}-{} is not within a chunk of {} simulations".format(start, stop, chunk_size))
+    if group["chunk_done"][k]:
+        return path
+
+    simulations = np.arange(start, stop) if simulations is None else simulations
+    damages = ensemble_runner.damages_dataset(
+        ensemble_runner.produce_mortality_estimate_from_parameter_block(climate_params, damage_spec),
+        simulations,
+        damage_spec,
+    ).mortrate
+
+    # the whole chunk is written, with missing values for the simulations not run
+    with xr.open_zarr(path) as store:
+        layout = store.mortrate
+        lo, hi = k * chunk_size, min((k + 1) * chunk_size, layout.sizes["simulation"])
+        chunk = damages.reindex(
+            {d: (np.arange(lo, hi) if d == "simulation" else layout[d].values) for d in layout.dims}
+        ).transpose(*layout.dims)
+
+    with instrumentation.stage("io_write", simulations=len(simulations)):
+        group["mortrate"][lo:hi] = chunk.values
+        group["chunk_done"][k] = 1
+    return path
+
+
+def run_store(
+    climate_params,
+    damage_spec,
+    path,
+    mask=None,
+    chunk_size=None,
+    n_workers=None,
+    memory_per_worker=ensemble_runner.MEMORY_PER_WORKER,
+    scheduler="processes",
+    progress=True,
+):
+    """
+        Creates the store if needed, and runs compute_and_store_damages_block() over all the chunks not written yet.
+        Simulations rejected by `mask` are not run.
+
+        Parameters:
+        climate_params (np.array): (simulation x 4) climate parameters, as lcp.get_parameters(filtered=False)
+        damage_spec (DataFrame): damage function coefficients, as returned by ensemble_runner.load_damage_spec()
+        path (str): zarr store path, as returned by store_path()
+        mask (np.array or None): (simulation,) boolean mask of the climate draws to run. If None, all of them
+        chunk_size (int or None): simulations per chunk of a new store. If None, the largest block fitting in `memory_per_worker`
+        n_workers, memory_per_worker, scheduler, progress: see ensemble_runner.run_ensemble()
+
+        Returns:
+        str: path of the store
+    """
+    if not os.path.exists(path):
+        if chunk_size is None:
+            chunk_size = ensemble_runner.block_size_for_memory(len(damage_spec), False, memory_per_worker)
+        create_store(path, damage_spec, len(climate_params), chunk_size)
+
+    blocks = plan_store_blocks(path, mask)
+    print("{} blocks to run".format(len(blocks)))
+    if blocks:
+        ensemble_runner.run_blocks(
+            compute_and_store_damages_block,
+            blocks,
+            climate_params,
+            n_workers=n_workers,
+            memory_per_worker=memory_per_worker,
+            scheduler=scheduler,
+            progress=progress,
+            damage_spec=damage_spec,
+            path=path,
+        )
+    return path
+
+
+def is_complete(path, mask=None):
+    """
+        Parameters:
+        path (str): zarr store path
+        mask (np.array or None): (simulation,) boolean mask of the simulations needed. If None, all of them
+
+        Returns:
+        boolean: whether the store exists and all the chunks holding simulations of `mask` are written
+    """
+    return os.path.exists(path) and not plan_store_blocks(path, mask)
+
+
+def open_store(path, mask=None):
+    """
+        Parameters:
+        path (str): zarr store path
+        mask (np.array or None): (simulation,) boolean mask of the simulations needed. If None, all of them
+
+        Returns:
+        Dataset: dask backed 'mortrate' damages of all the simulations, chunked as the store
+
+        Raises:
+        RuntimeError: if a chunk holding simulations of `mask` is not written yet, since its damages would be
+            missing values
+    """
+    _require_zarr()
+    missing = plan_store_blocks(path, mask)
+    if missing:
+        raise RuntimeError(
+            "{}: {} chunks of simulations are not written yet. Run ensemble_store.py again to complete them.".format(
+                path, len(missing)
+            )
+        )
+    return xr.open_zarr(path).drop_vars("chunk_done")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("--quantilereg", action="store_true", help="full uncertainty (quantile regression damage functions); climate-only uncertainty otherwise")
+    parser.add_argument("--input-dir", default="{}/4_damage_function/".format(os.getenv("DB")), help="damage function coefficients folder")
+    parser.add_argument("--output-dir", default="{}/5_scc/global_scc/quadratic/uncertainty/".format(os.getenv("DB")), help="intermediate results folder")
+    parser.add_argument("--climate-version", default=lcp.CURRENT_VERSION)
+    parser.add_argument("--chunk-size", type=int, default=None, help="simulations per chunk of a new store, sized to --memory-per-worker by default")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--memory-per-worker", type=float, default=ensemble_runner.MEMORY_PER_WORKER / 1024 ** 3, help="memory budget of a worker, in GB")
+    parser.add_argument("--scheduler", choices=["processes", "dask"], default="processes")
+    parser.add_argument("--all-draws", action="store_true", help="also run the climate draws rejected by the filter mask of --climate-version")
+    parser.add_argument("--status", action="store_true", help="only report the chunks already written")
+    parser.add_argument("--report", default=None, help="JSON file of the time and memory of the stages of the run")
+    args = parser.parse_args(argv)
+
+    path = store_path(args.output_dir, args.quantilereg)
+    climate_params = lcp.get_parameters(filtered=False, version=args.climate_version)
+    mask = None if args.all_draws else ensemble_runner.resolve_mask(args.climate_version, len(climate_params))
+
+    if args.status:
+        if not os.path.exists(path):
+            print("{}: not created yet".format(path))
+        else:
+            print("{}: {} chunks missing".format(path, len(plan_store_blocks(path, mask))))
+        return
+
+    with instrumentation.stage("run"):
+        run_store(
+            climate_params,
+            ensemble_runner.load_damage_spec(args.input_dir, args.quantilereg),
+            path,
+            mask=mask,
+            chunk_size=args.chunk_size,
+            n_workers=args.workers,
+            memory_per_worker=int(args.memory_per_worker * 1024 ** 3),
+            scheduler=args.scheduler,
+        )
+
+    if args.report is not None:
+        instrumentation.report(args.report, **vars(args))
+        print(instrumentation.summary())
+
+
+if __name__ == "__main__":
+    main()
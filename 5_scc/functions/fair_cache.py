@@ -0,0 +1,149 @@
+"""
+--------------------------------------------------------------------------
+On-disk cache of FAIR outputs.
+
+FAIR runs only depend on the climate parameters version, the emissions
+and pulse configuration and the FAIR version, so SCC reruns that only
+change the damage functions, valuation or discounting settings can reuse
+them. Outputs are stored as netCDF files named after a hash of these
+inputs, in the folder given by the FAIR_CACHE_DIR environment variable,
+or ~/.cache/carleton_mortality_2022/fair by default.
+
+The least recently used files are removed when there are more than
+MAX_ENTRIES of them. Set the FAIR_CACHE environment variable to 0 (or
+pass use_cache=False) to bypass the cache.
+--------------------------------------------------------------------------
+"""
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import xarray as xr
+
+CACHE_DIR = os.getenv(
+    "FAIR_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "carleton_mortality_2022", "fair"),
+)
+
+MAX_ENTRIES = 64
+
+
+def cache_enabled(use_cache=True):
+    """
+        Parameters:
+        use_cache (boolean): caller switch
+
+        Returns:
+        boolean: False if `use_cache` is False or the FAIR_CACHE environment variable disables the cache
+    """
+    return use_cache and os.getenv("FAIR_CACHE", "1").lower() not in ("0", "false", "off", "no")
+
+
+def emissions_hash(scenarios):
+    """
+        Parameters:
+        scenarios (dict): scenario name -> emissions array
+
+        Returns:
+        str: hash of the scenario names and emissions values
+    """
+    h = hashlib.sha1()
+    for name in sorted(scenarios):
+        h.update(name.encode())
+        h.update(np.ascontiguousarray(scenarios[name], dtype=float).tobytes())
+    return h.hexdigest()
+
+
+def cache_key(inputs):
+    """
+        Parameters:
+        inputs (dict): json serializable description of everything the cached output depends on
+
+        Returns:
+        str: hash of `inputs`
+    """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def cache_path(key, cache_dir=None):
+    return os.path.join(cache_dir or CACHE_DIR, "{}.nc".format(key))
+
+
+def load(key, cache_dir=None):
+    """
+        Parameters:
+        key (str): as returned by cache_key()
+        cache_dir (string): cache folder, defaults to CACHE_DIR
+
+        Returns:
+        Dataset or None if `key` is not in the cache
+    """
+    path = cache_path(key, cache_dir)
+    try:
+        with xr.open_dataset(path) as ds:
+            ds = ds.load()
+    except (OSError, ValueError):
+        return None
+    # the modification time records the last use, for eviction
+    os.utime(path)
+    return ds
+
+
+def save(key, ds, cache_dir=None, max_entries=MAX_ENTRIES):
+    """
+        Writes `ds` to the cache and evicts the least recently used entries above `max_entries`.
+        The file is written to a temporary name and then moved, so that concurrent readers never see a partial file.
+
+        Parameters:
+        key (str): as returned by cache_key()
+        ds (Dataset): FAIR outputs
+        cache_dir (string): cache folder, defaults to CACHE_DIR
+        max_entries (int): maximum number of cached files
+    """
+    path = cache_path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    ds.to_netcdf(tmp)
+    os.replace(tmp, path)
+    evict(cache_dir, max_entries)
+
+
+def evict(cache_dir=None, max_entries=MAX_ENTRIES):
+    """
+        Removes the least recently used cached files above `max_entries`.
+    """
+    paths = sorted(glob.glob(cache_path("*", cache_dir)), key=os.path.getmtime, reverse=True)
+    for path in paths[max_entries:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def cached(inputs, compute, use_cache=True, cache_dir=None, max_entries=MAX_ENTRIES):
+    """
+        Returns the cached output for `inputs`, or computes and caches it.
+
+        Parameters:
+        inputs (dict): json serializable description of everything the output depends on, see cache_key()
+        compute (callable): function without arguments returning the output Dataset
+        use_cache (boolean): if false -> always compute, and don't write to the cache. See also cache_enabled()
+        cache_dir (string): cache folder, defaults to CACHE_DIR
+        max_entries (int): maximum number of cached files
+
+        Returns:
+        Dataset
+    """
+    if not cache_enabled(use_cache):
+        return compute()
+
+    key = cache_key(inputs)
+    ds = load(key, cache_dir)
+    if ds is None:
+        ds = compute()
+        try:
+            save(key, ds, cache_dir, max_entries)
+        except OSError:
+            pass
+    return ds
@@ -0,0 +1,279 @@
+"""
+--------------------------------------------------------------------------
+Vectorized FAIR 1.3.2 over climate parameter sets.
+
+The ensemble SCC runs `fair.forward.fair_scm` once per (tcr, ecs, d2,
+tau4) parameter set, each run being a Python loop over years. Here, all
+the parameter sets are stepped together, with the state of each year
+held in arrays along a simulation axis.
+
+In multi-gas mode with the defaults used in this project, only the CO2
+carbon cycle (including the iIRF time scale adjustment), the CO2 and N2O
+forcing, the tropospheric ozone temperature feedback and the thermal
+response depend on the climate parameters. These follow the equations
+of `fair_scm`. The concentrations of the other gases and the other
+forcing agents don't depend on the climate parameters and are taken from
+one `fair_scm` run of the same emissions.
+
+`check_against_fair_scm()` compares the kernel with `fair_scm` for a
+sample of parameter sets, and `test_fair_ensemble.py` for the RCP4.5 and
+RCP8.5 control and pulse runs.
+
+FAIR 1.3.2 assigns arrays to array elements in `fair_scm`, which numpy 2
+refuses ("setting an array element with a sequence"): both `fair_scm`
+and this kernel need numpy < 2, see FAIR_SCM_SUPPORTED.
+--------------------------------------------------------------------------
+"""
+import numpy as np
+import xarray as xr
+import fair
+from fair.constants import molwt
+from fair.constants.general import M_ATMOS
+from fair.forcing import ozone_tr
+from pkg_resources import parse_version
+import load_fair
+import instrumentation
+
+FAIR_SCM_SUPPORTED = parse_version(np.__version__) < parse_version("2")
+
+# fair_scm defaults
+A = np.array([0.2173, 0.2240, 0.2824, 0.2763])
+R0, RC, RT = 35.0, 0.019, 4.165
+F2X = 3.71
+IIRF_MAX = 97.0
+TCR_DBL = 69.661
+C_PI = np.array([278.0, 722.0, 273.0])
+EFFICACY = np.array([1.0] * 9 + [3.0] + [1.0] * 3)
+AEROSOL_INDEX = 8
+
+# Conversion between ppm CO2 and GtC emissions
+PPM_GTC = M_ATMOS / 1e18 * molwt.C / molwt.AIR
+
+
+def _as_parameter_arrays(climate_params):
+    """
+        Splits a (simulation x 4 or 5) array of tcr, ecs, d2, tau4 and, optionally, aeroscale parameters into (simulation,) arrays.
+    """
+    climate_params = np.atleast_2d(np.asarray(climate_params, dtype=float))
+    tcr, ecs, d2, tau4 = climate_params[:, :4].T
+    if climate_params.shape[1] > 4:
+        aeroscale = climate_params[:, 4]
+    else:
+        aeroscale = np.ones(len(climate_params))
+    return tcr, ecs, d2, tau4, aeroscale
+
+
+def _etminan_co2_n2o(C_co2, C_ch4, C_n2o):
+    """
+        CO2 and N2O forcing of fair.forcing.ghg.etminan(), vectorized over CO2 concentrations (ppm).
+    """
+    Cbar = 0.5 * (C_co2 + C_PI[0])
+    Mbar = 0.5 * (C_ch4 + C_PI[1])
+    Nbar = 0.5 * (C_n2o + C_PI[2])
+
+    F2x_etminan = (-2.4e-7 * C_PI[0] ** 2 + 7.2e-4 * C_PI[0] - 2.1e-4 * C_PI[2] + 5.36) * np.log(2)
+    scaleCO2 = F2X / F2x_etminan
+
+    F_co2 = (
+        (-2.4e-7 * (C_co2 - C_PI[0]) ** 2 + 7.2e-4 * np.fabs(C_co2 - C_PI[0]) - 2.1e-4 * Nbar + 5.36)
+        * np.log(C_co2 / C_PI[0])
+        * scaleCO2
+    )
+    F_n2o = (-8.0e-6 * Cbar + 4.2e-6 * Nbar - 4.9e-6 * Mbar + 0.117) * (np.sqrt(C_n2o) - np.sqrt(C_PI[2]))
+    return F_co2, F_n2o
+
+
+def _ozone_temperature_feedback(T, a=0.03189267, b=1.34966941, c=-0.03214807):
+    """
+        Temperature feedback of fair.forcing.ozone_tr.stevenson(), vectorized over temperatures.
+    """
+    return np.where(T <= 0, 0.0, a * np.exp(-b * np.maximum(T, 0)) + c)
+
+
+def _time_scale_factor(iirf, a_tau, tau, alpha, rtol=1e-10, maxiter=50):
+    """
+        Solves alpha * sum(a * tau * (1 - exp(-100 / (tau * alpha)))) = iirf for alpha with Newton's method,
+        as fair_scm does with scipy.optimize.root for each run (ref eq. (7) of Millar et al ACP (2017)).
+
+        The left hand side is increasing and concave in alpha, so Newton steps from above the root can overshoot
+        far below it where the curve is flat. Steps are bounded to a division of alpha by 10, after which the
+        iterations increase monotonically to the root. Iterations stop on the relative residual: near the iIRF cap the
+        curve is flat and alpha itself is ill-conditioned.
+
+        Parameters:
+        iirf (np.array): (simulation,) target iIRF
+        a_tau (np.array): (simulation x 4) carbon box fractions times time constants
+        tau (np.array): (simulation x 4) carbon box time constants
+        alpha (np.array): (simulation,) starting values
+    """
+    for _ in range(maxiter):
+        e = np.exp(-100.0 / (tau * alpha[:, None]))
+        s = np.sum(a_tau * (1.0 - e), axis=1)
+        g = alpha * s - iirf
+        if np.all(np.abs(g) <= rtol * iirf):
+            break
+        dg = s - np.sum(A * e, axis=1) * 100.0 / alpha
+        alpha = np.maximum(alpha - g / dg, 0.1 * alpha)
+    return alpha
+
+
+def fair_ensemble(emissions, climate_params):
+    """
+        Runs FAIR 1.3.2 in multi-gas mode for many climate parameter sets at once.
+
+        Parameters:
+        emissions (np.array): (nt x 40) FAIR multigas emissions array
+        climate_params (np.array): (simulation x 4) tcr, ecs, d2, tau4 parameters, as returned by
+            load_climate_parameters.get_parameters(), with an optional fifth aerosol forcing scaling column
+
+        Returns:
+        tuple of three (simulation x nt) np.array: CO2 concentrations (ppm), total radiative forcing (W.m-2) and temperature (K),
+        as C[:, 0], np.sum(F, axis=1) and T of fair_scm
+    """
+    tcr, ecs, d2, tau4, aeroscale = _as_parameter_arrays(climate_params)
+    nsim, nt = len(tcr), emissions.shape[0]
+
+    # concentrations and forcing agents that don't depend on the climate parameters
+    C_bg, F_bg, _ = fair.forward.fair_scm(
+        emissions=emissions,
+        tcrecs=np.array([tcr[0], ecs[0]]),
+        tau=np.array(load_fair.FAIR_TAU + [tau4[0]]),
+        d=np.array([load_fair.FAIR_D1, d2[0]]),
+    )
+    C_ch4, C_n2o = C_bg[:, 1], C_bg[:, 2]
+    ozone = ozone_tr.stevenson(emissions, C_ch4, feedback=False, fix_pre1850_RCP=True)
+    other = np.delete(F_bg, [0, 2, 4, AEROSOL_INDEX], axis=1)
+    other_efficacy = np.delete(EFFICACY, [0, 2, 4, AEROSOL_INDEX])
+    F_other = other.sum(axis=1)
+    F_other_eff = (other * other_efficacy).sum(axis=1)
+    F_aero = F_bg[:, AEROSOL_INDEX]
+
+    # thermal response, ref eq. (4) and (5) of Millar et al ACP (2017)
+    d = np.stack([np.full(nsim, load_fair.FAIR_D1), d2], axis=1)
+    k = 1.0 - (d / TCR_DBL) * (1.0 - np.exp(-TCR_DBL / d))
+    q = (1.0 / F2X) * (1.0 / (k[:, 0] - k[:, 1]))[:, None] * np.stack(
+        [tcr - ecs * k[:, 1], ecs * k[:, 0] - tcr], axis=1
+    )
+    tau = np.stack([np.full(nsim, t) for t in load_fair.FAIR_TAU] + [tau4], axis=1)
+    a_tau = A * tau
+
+    C = np.zeros((nsim, nt))
+    F = np.zeros((nsim, nt))
+    T = np.zeros((nsim, nt))
+    C_acc = np.zeros(nsim)
+
+    # Initialise the carbon pools to be correct for first timestep in numerical method
+    R_i = np.tile(A * np.sum(emissions[0, 1:3]) / PPM_GTC, (nsim, 1))
+    C[:, 0] = R_i.sum(axis=1)
+
+    def forcing(t, T_prev):
+        F_co2, F_n2o = _etminan_co2_n2o(C[:, t] + C_PI[0], C_ch4[t], C_n2o[t])
+        common = F_co2 + F_n2o + ozone[t] + _ozone_temperature_feedback(T_prev) + aeroscale * F_aero[t]
+        return common + F_other[t], common + F_other_eff[t]
+
+    F[:, 0], _ = forcing(0, np.zeros(nsim))
+    T_j = (q / d) * F[:, [0]]
+    T[:, 0] = T_j.sum(axis=1)
+
+    alpha = np.full(nsim, 0.16)
+    decay_d = np.exp(-1.0 / d)
+    for t in range(1, nt):
+        iirf = np.minimum(RC * C_acc + RT * T[:, t - 1] + R0, IIRF_MAX)
+        alpha = _time_scale_factor(iirf, a_tau, tau, alpha)
+
+        # CO2 concentrations. Oxidised fossil methane is zero with the default fossilCH4_frac of fair_scm
+        R_i = R_i * np.exp(-1.0 / (tau * alpha[:, None])) + A * np.sum(emissions[t, 1:3]) / PPM_GTC
+        C[:, t] = R_i.sum(axis=1)
+        C_acc = C_acc + 0.5 * np.sum(emissions[t - 1 : t + 1, 1:3]) - (C[:, t] - C[:, t - 1]) * PPM_GTC
+
+        # radiative forcing and temperature
+        F[:, t], F_eff = forcing(t, T[:, t - 1])
+        T_j = T_j * decay_d + q * (1 - decay_d) * F_eff[:, None]
+        T[:, t] = T_j.sum(axis=1)
+
+    return C + C_PI[0], F, T
+
+
+def run_fair_ensemble(climate_params, scenarios=None, pulses=None):
+    """
+        Runs the kernel for every combination of emission scenario and pulse configuration.
+
+        Parameters:
+        climate_params (np.array): (simulation x 4) climate parameters, see fair_ensemble()
+        scenarios (dict): scenario name -> FAIR multigas emissions array. Defaults to load_fair.RCP_SCENARIOS.
+        pulses (dict): pulse name -> (pulse year, pulse amount in Gt C), or None for the scenario without pulse.
+            Defaults to the control runs only, {"rcp": None}.
+
+        Returns:
+        Dataset: as load_fair.run_fair_scenarios(), with an additional leading simulation dimension
+    """
+    scenarios = load_fair.RCP_SCENARIOS if scenarios is None else scenarios
+    pulses = {"rcp": None} if pulses is None else pulses
+    climate_params = np.atleast_2d(climate_params)
+
+    outputs = {"concentration": [], "forcing": [], "temperature": []}
+    with instrumentation.stage("fair_integration", simulations=len(climate_params)):
+        for p, pulse in pulses.items():
+            for s, emissions in scenarios.items():
+                if pulse is not None:
+                    emissions = load_fair.add_pulse(emissions, *pulse)
+                for name, values in zip(outputs, fair_ensemble(emissions, climate_params)):
+                    outputs[name].append(values)
+
+    shape = (len(pulses), len(scenarios), len(climate_params), -1)
+    coords = {
+        "simulation": np.arange(len(climate_params)),
+        "pulse": list(pulses),
+        "rcp": list(scenarios),
+        "year": next(iter(scenarios.values()))[:, 0].astype(int),
+    }
+    return xr.Dataset(
+        {
+            name: (
+                ["simulation", "pulse", "rcp", "year"],
+                np.stack(values).reshape(shape).transpose(2, 0, 1, 3),
+            )
+            for name, values in outputs.items()
+        },
+        coords=coords,
+    )
+
+
+def check_against_fair_scm(climate_params, emissions=None, rtol=1e-7, atol=1e-9):
+    """
+        Compares fair_ensemble() with fair_scm run for each parameter set.
+
+        Parameters:
+        climate_params (np.array): (simulation x 4) climate parameters to check, e.g. a random sample of load_climate_parameters.get_parameters()
+        emissions (np.array): FAIR multigas emissions array, defaults to RCP8.5
+        rtol, atol (double): tolerances, see np.testing.assert_allclose()
+
+        Returns:
+        dict: maximum absolute difference of CO2 concentrations, total forcing and temperature.
+        Raises an AssertionError if they are beyond the tolerances.
+    """
+    emissions = load_fair.RCP_SCENARIOS["rcp85"] if emissions is None else emissions
+    tcr, ecs, d2, tau4, aeroscale = _as_parameter_arrays(climate_params)
+
+    C, F, T = fair_ensemble(emissions, climate_params)
+
+    differences = {"concentration": 0.0, "forcing": 0.0, "temperature": 0.0}
+    for i in range(len(tcr)):
+        scale = np.ones(len(EFFICACY))
+        scale[AEROSOL_INDEX] = aeroscale[i]
+        C_ref, F_ref, T_ref = fair.forward.fair_scm(
+            emissions=emissions,
+            tcrecs=np.array([tcr[i], ecs[i]]),
+            tau=np.array(load_fair.FAIR_TAU + [tau4[i]]),
+            d=np.array([load_fair.FAIR_D1, d2[i]]),
+            scale=scale,
+        )
+        for name, ours, ref in [
+            ("concentration", C[i], C_ref[:, 0]),
+            ("forcing", F[i], F_ref.sum(axis=1)),
+            ("temperature", T[i], T_ref),
+        ]:
+            np.testing.assert_allclose(ours, ref, rtol=rtol, atol=atol, err_msg=name)
+            differences[name] = max(differences[name], np.abs(ours - ref).max())
+
+    return differences
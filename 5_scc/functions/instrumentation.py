@@ -0,0 +1,258 @@
+"""
+--------------------------------------------------------------------------
+Stage-level timing and memory instrumentation of the SCC pipeline.
+
+The stages of the pipeline (reading the climate parameters, FAIR
+integration, damage evaluation, filtering, discounting, quantiles, and
+reading and writing files) are wrapped in `stage()` context managers,
+which add up, per stage and per process:
+
+- the number of calls and of simulations processed,
+- the wall and CPU time,
+- the peak resident memory of the process at the end of the stage, and
+  how much the stage raised it.
+
+The records of the worker processes of `ensemble_runner.run_blocks` and
+`scc_engine.compute_sccs` (process pools or dask workers) are returned
+with the results of their blocks by `collected()`, and merged into the
+records of the main process, so that `report()` gives the totals of a
+run across all processes, and writes them to a JSON file.
+
+Wall times of the stages run by the workers are summed over the
+workers, and nested stages (e.g. FAIR integration within a block) are
+counted in both. Set the SCC_INSTRUMENTATION environment variable to 0
+to disable the records.
+
+Usage:
+
+    with instrumentation.stage("damage_evaluation", simulations=len(block)):
+        ...
+    instrumentation.report("run_report.json", quantilereg=True)
+
+--------------------------------------------------------------------------
+"""
+import os
+import json
+import time
+import socket
+import datetime
+import functools
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where the memory isn't recorded
+    resource = None
+
+# stage name -> aggregated record, for this process
+_STAGES = {}
+
+_FIELDS = ["calls", "simulations", "seconds", "cpu_seconds", "max_rss_mb", "rss_growth_mb", "processes"]
+
+
+def enabled():
+    """
+        Returns:
+        boolean: False if the SCC_INSTRUMENTATION environment variable disables the records
+    """
+    return os.getenv("SCC_INSTRUMENTATION", "1").lower() not in ("0", "false", "off", "no")
+
+
+def _max_rss_mb():
+    if resource is None:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _empty():
+    return dict(calls=0, simulations=0, seconds=0.0, cpu_seconds=0.0, max_rss_mb=None, rss_growth_mb=None, processes=[])
+
+
+def _max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+def _add(record, other):
+    record["calls"] += other["calls"]
+    record["simulations"] += other["simulations"]
+    record["seconds"] += other["seconds"]
+    record["cpu_seconds"] += other["cpu_seconds"]
+    record["max_rss_mb"] = _max(record["max_rss_mb"], other["max_rss_mb"])
+    record["rss_growth_mb"] = _max(record["rss_growth_mb"], other["rss_growth_mb"])
+    record["processes"] = sorted(set(record["processes"]) | set(other["processes"]))
+
+
+@contextlib.contextmanager
+def stage(name, simulations=0):
+    """
+        Records the time and memory of the enclosed code under `name`.
+
+        Parameters:
+        name (str): stage name, e.g. 'fair_integration', 'damage_evaluation', 'discounting', 'io_read'
+        simulations (int): number of simulations processed by the enclosed code
+    """
+    if not enabled():
+        yield
+        return
+
+    rss = _max_rss_mb()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        after = _max_rss_mb()
+        _add(
+            _STAGES.setdefault(name, _empty()),
+            dict(
+                calls=1,
+                simulations=int(simulations),
+                seconds=time.perf_counter() - wall,
+                cpu_seconds=time.process_time() - cpu,
+                max_rss_mb=after,
+                rss_growth_mb=None if rss is None else after - rss,
+                processes=[os.getpid()],
+            ),
+        )
+
+
+def timed(name):
+    """
+        Decorator recording each call of the function as a stage, see stage().
+
+        Parameters:
+        name (str): stage name
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def snapshot():
+    """
+        Returns:
+        dict: stage name -> record, a copy of the records of this process
+    """
+    return {name: dict(record, processes=list(record["processes"])) for name, record in _STAGES.items()}
+
+
+def reset():
+    """
+        Clears the records of this process.
+    """
+    _STAGES.clear()
+
+
+def merge(records):
+    """
+        Adds records of another process to those of this process.
+
+        Parameters:
+        records (dict): stage name -> record, as returned by snapshot()
+    """
+    for name, record in records.items():
+        _add(_STAGES.setdefault(name, _empty()), record)
+
+
+def collected(function, *args, **kwargs):
+    """
+        Runs function(*args, **kwargs) in a worker process and returns its result with the records of the call, to be
+        passed to merge() by the main process. The records of the worker are left as they were.
+
+        Returns:
+        (object, dict): result of `function`, and stage name -> record of the call
+    """
+    previous = snapshot()
+    reset()
+    try:
+        result = function(*args, **kwargs)
+        return result, snapshot()
+    finally:
+        reset()
+        merge(previous)
+
+
+def merged(results):
+    """
+        Merges the records of results of collected(), e.g. from `executor.map(collected, ...)`, as they come.
+
+        Parameters:
+        results (iterable of (object, dict)): results of collected()
+
+        Returns:
+        generator: results of the functions
+    """
+    for result, records in results:
+        merge(records)
+        yield result
+
+
+def report(path=None, **metadata):
+    """
+        Parameters:
+        path (str or None): if not None -> JSON file the report is written to
+        metadata: run settings added to the report, e.g. quantilereg=True, workers=8
+
+        Returns:
+        dict: report of the run, with one entry per stage sorted by decreasing time, with the number of calls,
+        simulations, wall and CPU seconds, simulations per second, peak resident memory of the processes in MB and
+        the number of processes that ran it
+    """
+    stages = []
+    for name, record in sorted(_STAGES.items(), key=lambda item: -item[1]["seconds"]):
+        entry = dict(stage=name)
+        entry.update({k: record[k] for k in _FIELDS if k != "processes"})
+        entry["simulations_per_second"] = (
+            record["simulations"] / record["seconds"] if record["simulations"] and record["seconds"] else None
+        )
+        entry["processes"] = len(record["processes"])
+        stages.append(entry)
+
+    result = dict(
+        created=datetime.datetime.now().isoformat(),
+        host=socket.gethostname(),
+        pid=os.getpid(),
+        metadata=metadata,
+        stages=stages,
+    )
+    if path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(result, f, indent=1, default=str)
+    return result
+
+
+def summary(run_report=None):
+    """
+        Parameters:
+        run_report (dict or None): as returned by report(). Defaults to the report of the records of this process
+
+        Returns:
+        str: one line per stage, with its time, throughput and peak memory
+    """
+    run_report = report() if run_report is None else run_report
+    lines = []
+    for s in run_report["stages"]:
+        lines.append(
+            "{:20s} {:>7d} calls {:>10.2f} s {:>10.2f} cpu s {:>12s} simulations/s peak memory {} MB".format(
+                s["stage"],
+                s["calls"],
+                s["seconds"],
+                s["cpu_seconds"],
+                "-" if s["simulations_per_second"] is None else "{:.0f}".format(s["simulations_per_second"]),
+                "-" if s["max_rss_mb"] is None else "{:.0f}".format(s["max_rss_mb"]),
+            )
+        )
+    return "\n".join(lines)
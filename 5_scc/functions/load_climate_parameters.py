@@ -1,71 +1,302 @@
 import pandas as pd
 import xarray as xr
+import numpy as np
 import os
+import json
+import collections
 
 from pkg_resources import parse_version
+import instrumentation
 
 CURRENT_VERSION = '2.1'
 
 # TODO: add a version history and descriptions
 
-def get_filter_mask(version=CURRENT_VERSION):
-    '''
-    Parameters
-    ----------
-    version : str, int, float, Version, optional
-        climate parameters version number
-    '''
-    version = parse_version(str(version))
-    
-    os.getcwd() 
+# The parameters and filter masks of each version are read from their netCDF files once, and stored separately as
+# .npy files in this folder, so that the filter mask is read without the parameters. They are then memory-mapped, so that processes (e.g. dask workers) share them without reopening
+# the netCDF files. Set the CLIMATE_PARAMETERS_CACHE environment variable to 0 to keep them in memory only.
+CACHE_DIR = os.getenv(
+    'CLIMATE_PARAMETERS_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'carleton_mortality_2022', 'climate_parameters'))
+
+ClimateParameters = collections.namedtuple(
+    'ClimateParameters', ['version', 'names', 'simulation', 'values', 'mask', 'mask_name', 'accepted'])
+ClimateParameters.__doc__ = '''
+Climate parameters and filter mask of a version, as returned by get_registry()
+
+Attributes
+----------
+version : str
+    climate parameters version number
+names : list of str
+    parameter names, including 'rwf'
+simulation : np.array
+    simulation coordinates
+values : np.array
+    (simulation x parameter) unfiltered parameters, memory-mapped, in the order of the simulations of the mask. None
+    if the version has a filter mask only
+mask : np.array
+    (simulation,) boolean filter mask, memory-mapped
+mask_name : str
+    name of the filter mask DataArray
+accepted : np.array
+    indices of the simulations accepted by the filter mask, memory-mapped
+'''
+
+FilterMask = collections.namedtuple('FilterMask', ['version', 'simulation', 'mask', 'mask_name', 'accepted'])
+FilterMask.__doc__ = '''
+Filter mask of a version, as returned by get_filter_registry(), with the attributes of ClimateParameters
+'''
+
+# version -> ClimateParameters, and ('mask', version) -> FilterMask
+_REGISTRY = {}
+
+
+def _path(*parts):
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'climate', 'parameters', *parts)
+
+
+def _filter_files(version):
     if (version == parse_version('3.0')):
-        filters_fp = (
-            '{}/climate/parameters/latinhypercube/parameter_filters_truncate_ecs_v3.0.nc'.format(os.path.dirname(os.path.realpath(__file__)))) 
+        return [_path('latinhypercube', 'parameter_filters_truncate_ecs_v3.0.nc')]
+    elif (version == parse_version('2.2')):
+        return [_path('parameter_filters_rwf_tau4_iptcriteria_v2.1_newiptemissions.nc'),
+                _path('parameter_filters_truncate_ecs_postipt_v2.1.nc')]
+    elif (version == parse_version('2.1')) or (version == parse_version('2.0')):
+        return [_path('parameter_filters_rwf_tau4_iptcriteria_v2.1_newiptemissions.nc')]
+    else:
+        raise NotImplementedError('{} is not a valid climate version number'.format(version))
+
+
+def _parameters_files(version):
+    # These files are part of the git repo
+    if (version == parse_version("3.0")):
+        return [_path('latinhypercube', 'climate_parameters_truncated_latin_hypercube_n3000_seed2070.nc')]
+    elif (version == parse_version('2.1')) or (version == parse_version('2.0')):
+        return [_path('original_parameter_samples_with_rwf_v2_2019-02-01-22-50-59.nc')]
+    else:
+        return []
+
+
+def _read_filter_mask(version):
+    filters_fp = _filter_files(version)
 
-        with xr.open_dataset(filters_fp) as filters_ds:
+    if (version == parse_version('3.0')):
+        with xr.open_dataset(filters_fp[0]) as filters_ds:
 #             import warnings
 #             warnings.warn("v3.0 climate parameters do not require additional filters by default.")
 #             the_mask = (filters_ds.ipt_time_to_dT_lt_0_passing_mask)
             the_mask = (filters_ds.truncate_at_ecs990symmetric_passing_mask)
-            return the_mask
-    
+            return the_mask.load()
+
     elif (version == parse_version('2.2')):
         # Note, this is v2.1 climate parameters and default masks *with the additional ECS 1-99 truncation mask*
         # There exists another use of v2.2 in our climate data, not implemented in this file (phew).
         #   That other v2.2 is specific to integration and is *unused*. It is a version of the v2.1 climate params
         #   run with FaIR 1.6.0 on CMIP6 emissions pathways using the CIL FAIR fork.
-        filters_fp = (
-            '{}/climate/parameters/parameter_filters_rwf_tau4_iptcriteria_v2.1_newiptemissions.nc'.format(os.path.dirname(os.path.realpath(__file__)))) 
-
-        ecs_fp = (
-            '{}/climate/parameters/parameter_filters_truncate_ecs_postipt_v2.1.nc'.format(os.path.dirname(os.path.realpath(__file__)))) 
-        
-        with xr.open_dataset(filters_fp) as filters_ds:
+        with xr.open_dataset(filters_fp[0]) as filters_ds:
             #print(filters_ds)
-            
-            with xr.open_dataset(ecs_fp) as ecs_ds:
-                
+
+            with xr.open_dataset(filters_fp[1]) as ecs_ds:
+
                 the_mask = (filters_ds.rwf_mask
                                  & filters_ds.tau4_mask
                                  & filters_ds.ipt_time_to_dT_lt_0_passing_mask)
                 ecsmask = ecs_ds.truncate_at_ecs990symmetric_passing_mask
-                return (the_mask & ecsmask)
-    
-    elif (version == parse_version('2.1')) or (version == parse_version('2.0')):
-        
-        filters_fp = (
-            '{}/climate/parameters/parameter_filters_rwf_tau4_iptcriteria_v2.1_newiptemissions.nc'.format(os.path.dirname(os.path.realpath(__file__)))) 
+                return (the_mask & ecsmask).load()
 
-        with xr.open_dataset(filters_fp) as filters_ds:
+    else:
+        with xr.open_dataset(filters_fp[0]) as filters_ds:
             #print(filters_ds)
             the_mask = (filters_ds.rwf_mask
                              & filters_ds.tau4_mask
                              & filters_ds.ipt_time_to_dT_lt_0_passing_mask)
-            return the_mask
-    elif (version == parse_version('1.0')):
+            return the_mask.load()
+
+
+def _read_parameters(version):
+    params_fp = _parameters_files(version)
+    if not params_fp:
+        return None
+
+    with xr.open_dataset(params_fp[0]) as params_ds:
+        return params_ds.load()
+
+
+def _cache_key(version, files):
+    return [str(version)] + [[f, os.path.getsize(f), os.path.getmtime(f)] for f in files]
+
+
+def _cache_enabled():
+    return os.getenv('CLIMATE_PARAMETERS_CACHE', '1').lower() not in ('0', 'false', 'off', 'no')
+
+
+def _save_npy(path, array):
+    tmp = '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def _save_arrays(folder, arrays, meta):
+    os.makedirs(folder, exist_ok=True)
+    for name, array in arrays.items():
+        _save_npy(os.path.join(folder, '{}.npy'.format(name)), array)
+    # written last: the cache is complete when its meta.json exists
+    tmp = os.path.join(folder, 'meta.json.{}.tmp'.format(os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(dict(meta, arrays=list(arrays)), f)
+    os.replace(tmp, os.path.join(folder, 'meta.json'))
+
+
+def _load_arrays(folder, key):
+    try:
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['key'] != json.loads(json.dumps(key)):
+            return None
+        arrays = {name: np.load(os.path.join(folder, '{}.npy'.format(name)), mmap_mode='r') for name in meta['arrays']}
+    except (OSError, ValueError, KeyError):
+        return None
+    return arrays, meta
+
+
+def _cached_arrays(version, kind, files, build):
+    '''
+    Arrays built from netCDF files, memory-mapped from the .npy files of CACHE_DIR/{version}/{kind} when they are up
+    to date with these files
+
+    Parameters
+    ----------
+    version : Version
+        climate parameters version number
+    kind : str
+        'mask' or 'parameters'
+    files : list of str
+        netCDF files the arrays are built from
+    build : callable
+        returns the arrays, as a dict name -> np.array, and a dict of metadata
+
+    Returns
+    -------
+    (dict, dict)
+        arrays and metadata
+    '''
+    key = _cache_key(version, files)
+    folder = os.path.join(CACHE_DIR, str(version), kind)
+    if _cache_enabled():
+        loaded = _load_arrays(folder, key)
+        if loaded is not None:
+            return loaded
+
+    with instrumentation.stage('climate_parameters'):
+        arrays, meta = build()
+    meta['key'] = key
+
+    if _cache_enabled():
+        try:
+            _save_arrays(folder, arrays, meta)
+        except OSError:
+            pass
+        else:
+            loaded = _load_arrays(folder, key)
+            if loaded is not None:
+                return loaded
+    return arrays, meta
+
+
+def _build_mask(version):
+    mask = _read_filter_mask(version)
+    arrays = {
+        'mask': np.asarray(mask.values, dtype=bool),
+        'simulation': mask['simulation'].values,
+    }
+    arrays['accepted'] = np.flatnonzero(arrays['mask'])
+    return arrays, dict(mask_name=mask.name)
+
+
+def _build_parameters(version):
+    params_ds = _read_parameters(version)
+    arrays = {
+        'simulation': params_ds['simulation'].values,
+        'values': np.ascontiguousarray(params_ds.to_array(dim='parameter').transpose('simulation', 'parameter').values),
+    }
+    return arrays, dict(names=list(params_ds.data_vars))
+
+
+def get_filter_registry(version=CURRENT_VERSION):
+    '''
+    Filter mask of a climate parameters version, read once per process from the filter files only, and memory-mapped
+    from the .npy files of CACHE_DIR when they are up to date with the netCDF files
+
+    Parameters
+    ----------
+    version : str, int, float, Version, optional
+        climate parameters version number, 2.0 or above
+
+    Returns
+    -------
+    FilterMask
+    '''
+    version = parse_version(str(version))
+    if ('mask', version) not in _REGISTRY:
+        arrays, meta = _cached_arrays(version, 'mask', _filter_files(version), lambda: _build_mask(version))
+        _REGISTRY['mask', version] = FilterMask(
+            version=str(version), simulation=arrays['simulation'], mask=arrays['mask'], mask_name=meta['mask_name'],
+            accepted=arrays['accepted'])
+    return _REGISTRY['mask', version]
+
+
+def get_registry(version=CURRENT_VERSION):
+    '''
+    Parameters and filter mask of a climate parameters version, read once per process, and memory-mapped from the
+    .npy files of CACHE_DIR when they are up to date with the netCDF files
+
+    Parameters
+    ----------
+    version : str, int, float, Version, optional
+        climate parameters version number, 2.0 or above
+
+    Returns
+    -------
+    ClimateParameters
+
+    Raises
+    ------
+    ValueError
+        if the simulations of the parameters and of the filter mask differ, since the mask is applied to the
+        parameters by position
+    '''
+    version = parse_version(str(version))
+    if version not in _REGISTRY:
+        mask = get_filter_registry(version)
+        names, values = None, None
+        if _parameters_files(version):
+            arrays, meta = _cached_arrays(
+                version, 'parameters', _parameters_files(version), lambda: _build_parameters(version))
+            if not np.array_equal(arrays['simulation'], mask.simulation):
+                raise ValueError(
+                    'the simulations of the climate parameters and of the filter mask of version {} differ'.format(
+                        version))
+            names, values = meta['names'], arrays['values']
+        _REGISTRY[version] = ClimateParameters(
+            version=mask.version, names=names, simulation=mask.simulation, values=values, mask=mask.mask,
+            mask_name=mask.mask_name, accepted=mask.accepted)
+    return _REGISTRY[version]
+
+
+def get_filter_mask(version=CURRENT_VERSION):
+    '''
+    Parameters
+    ----------
+    version : str, int, float, Version, optional
+        climate parameters version number
+    '''
+    version = parse_version(str(version))
+
+    if (version == parse_version('1.0')):
         # read in old filters:
         filtered_parameter_indices = pd.read_csv(
-            'climate/parameters/filtered_parameter_indices.csv', 
+            'climate/parameters/filtered_parameter_indices.csv',
             index_col=0)
 
         with xr.Dataset(filtered_parameter_indices) as filters_ds:
@@ -73,8 +304,11 @@ def get_filter_mask(version=CURRENT_VERSION):
             the_mask = filters_ds.ipt_dT_lt_0
             return the_mask
     else:
-        raise NotImplementedError('{} is not a valid climate version number'.format(parse_version(version)))
-        
+        registry = get_filter_registry(version)
+        return xr.DataArray(
+            np.asarray(registry.mask), dims=['simulation'], coords={'simulation': np.asarray(registry.simulation)},
+            name=registry.mask_name)
+
 def get_parameters(filtered=True, array=True, version=CURRENT_VERSION, droprwf=True):
     '''
     Parameters
@@ -87,66 +321,46 @@ def get_parameters(filtered=True, array=True, version=CURRENT_VERSION, droprwf=T
         climate parameters version number
     '''
     version = parse_version(str(version))
-    
+
     if (version == parse_version("3.0")):
         print("These parameters are in beta mode") # @@@
-        
-        with xr.open_dataset(
-            # This file is part of the git repo
-            '{}/climate/parameters/latinhypercube/climate_parameters_truncated_latin_hypercube_n3000_seed2070.nc'.format(os.path.dirname(os.path.realpath(__file__)))) as params_ds:
 
-            if droprwf:
-                params_ds = params_ds.drop('rwf')
-
-            if filtered:
-                climate_params = params_ds.where(get_filter_mask(version = version),drop=True).to_array(dim='parameter')
-            else:
-                climate_params = params_ds.to_array(dim='parameter')#.T.values
-                
-            if array:
-                return climate_params.sel(parameter=["tcr","ecs","d2","tau4"]).T.values
-            else:
-                return climate_params
-    
-    elif (version == parse_version('2.1')) or (version == parse_version('2.0')):
+    if (version == parse_version("3.0")) or (version == parse_version('2.1')) or (version == parse_version('2.0')):
 
+        registry = get_registry(version)
 
-        with xr.open_dataset(
-            # This file is part of the git repo
-            '{}/climate/parameters/original_parameter_samples_with_rwf_v2_2019-02-01-22-50-59.nc'.format(os.path.dirname(os.path.realpath(__file__)))) as params_ds:
+        names = [n for n in registry.names if not (droprwf and n == 'rwf')]
+        rows = registry.accepted if filtered else slice(None)
 
-            if droprwf:
-                params_ds = params_ds.drop('rwf')
-                
-            if filtered:
-                climate_params = params_ds.where(get_filter_mask(version = version),drop=True).to_array(dim='parameter')#.T.values
-            else:
-                climate_params = params_ds.to_array(dim='parameter')#.T.values
-                
-            if array:
-                return climate_params.sel(parameter=["tcr","ecs","d2","tau4"]).T.values
-            else:
-                return climate_params
+        if array:
+            columns = [registry.names.index(n) for n in ["tcr","ecs","d2","tau4"]]
+            return np.asarray(registry.values[rows][:, columns])
+        else:
+            columns = [registry.names.index(n) for n in names]
+            return xr.DataArray(
+                np.asarray(registry.values[rows][:, columns]).T,
+                dims=['parameter', 'simulation'],
+                coords={'parameter': names, 'simulation': np.asarray(registry.simulation[rows])})
 
     elif  (version == parse_version('1.0')):
         with xr.open_dataset('{}/climate/parameters/original_parameter_samples.nc'.format(os.path.dirname(os.path.realpath(__file__)))) as params_ds:
-            
+
             if filtered:
                 climate_params = params_ds.where(get_filter_mask(version = version)).to_array(dim='parameter')#.T.values
             else:
                 climate_params = params_ds.to_array(dim='parameter')#.T.values
-            
+
             if array:
                 return climate_params.T.values
             else:
                 return climate_params
     else:
         raise NotImplementedError('{} is not a valid climate version number'.format(parse_version(version)))
-        
+
 def get_median_climate_params(version = CURRENT_VERSION, filtered = True):
     # add a filtered arg b/c latin hypercube (v3) params do not have any additional filters.
-    cp = get_parameters(filtered=True, 
-                        array=False, 
+    cp = get_parameters(filtered=True,
+                        array=False,
                         version = version)
-    
+
     return cp.quantile(0.5,dim='simulation')
@@ -22,12 +22,11 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 from fair.RCPs import rcp3pd, rcp45, rcp6, rcp85
-import matplotlib
-from matplotlib import pyplot as plt
-from matplotlib import cm
-import seaborn as sns
+from joblib import Parallel, delayed
 import sys
 import load_climate_parameters as lcp
+import fair_cache
+import instrumentation
 import copy
 from pkg_resources import parse_version
 
@@ -43,6 +42,169 @@ assert (
     project_fair_vers
 )
 
+# emissions of the four RCP scenarios, by the names used in the outputs
+RCP_SCENARIOS = {
+    "rcp26": rcp3pd.Emissions.emissions,
+    "rcp45": rcp45.Emissions.emissions,
+    "rcp60": rcp6.Emissions.emissions,
+    "rcp85": rcp85.Emissions.emissions,
+}
+
+# carbon cycle time constants and thermal response times that are not sampled in the climate parameters
+FAIR_TAU = [1000000, 394.4, 36.54]
+FAIR_D1 = 239.0
+
+
+def add_pulse(emissions, pulse_year, pulse_amt):
+    """
+        Parameters:
+        emissions (np.array): FAIR multigas emissions array, with years in the first column and fossil CO2 in the second
+        pulse_year (int): year in which pulse will be emitted
+        pulse_amt (double): quantity of pulse emitted in Gt C = 1e9 ton C
+
+        Returns:
+        np.array: a copy of `emissions` with the pulse added to fossil CO2
+    """
+    # The deep_copy on the Emissions object was still allowing the pulse emissions to
+    # accumulate each time the script is executed. Instead, copy the Emissions.emissions array.
+    pulsed = emissions.copy()
+    pulsed[:, 1] = pulsed[:, 1] + np.where(pulsed[:, 0] == pulse_year, pulse_amt, 0)
+    return pulsed
+
+
+def _run_fair(emissions, tcr, ecs, d2, tau4):
+    C, F, T = fair.forward.fair_scm(
+        emissions=emissions,
+        tcrecs=np.array([tcr, ecs]),
+        tau=np.array(FAIR_TAU + [tau4]),
+        d=np.array([FAIR_D1, d2]),
+    )
+    return C[:, 0], np.sum(F, axis=1), T
+
+
+def run_fair_scenarios(climate_params, scenarios=None, pulses=None, n_jobs=-1):
+    """
+        Runs FAIR for every combination of emission scenario and pulse configuration, concurrently.
+
+        Parameters:
+        climate_params (list-like of double): tcr, ecs, d2 and tau4 climate parameters
+        scenarios (dict): scenario name -> FAIR multigas emissions array. Defaults to RCP_SCENARIOS.
+        pulses (dict): pulse name -> (pulse year, pulse amount in Gt C), or None for the scenario without pulse.
+            Defaults to the control runs only, {"rcp": None}.
+        n_jobs (int): number of processes used to run the scenarios, passed to joblib.Parallel
+
+        Returns:
+        Dataset: CO2 concentrations (ppm), total radiative forcing (W.m-2), temperature (K) and fossil CO2 emissions (Gt C)
+        with dimensions (pulse, rcp, year)
+    """
+    scenarios = RCP_SCENARIOS if scenarios is None else scenarios
+    pulses = {"rcp": None} if pulses is None else pulses
+    tcr, ecs, d2, tau4 = climate_params
+
+    runs = []
+    for p, pulse in pulses.items():
+        for s, emissions in scenarios.items():
+            runs.append(emissions if pulse is None else add_pulse(emissions, *pulse))
+
+    with instrumentation.stage("fair_integration", simulations=1):
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_run_fair)(emissions, tcr, ecs, d2, tau4) for emissions in runs
+        )
+
+    shape = (len(pulses), len(scenarios), -1)
+    coords = [list(pulses), list(scenarios), next(iter(scenarios.values()))[:, 0].astype(int)]
+
+    def to_array(values):
+        return xr.DataArray(np.stack(values).reshape(shape), dims=["pulse", "rcp", "year"], coords=coords)
+
+    return xr.Dataset(
+        {
+            "concentration": to_array([r[0] for r in results]),
+            "forcing": to_array([r[1] for r in results]),
+            "temperature": to_array([r[2] for r in results]),
+            "co2_fossil": to_array([e[:, 1] for e in runs]),
+        }
+    )
+
+
+def plot_fair_scenarios(fair_runs, output, plot_all_scenarios=False):
+    """
+        Saves plots of the control runs, of the response to the pulse and of global mean temperatures by scenario.
+
+        Parameters:
+        fair_runs (Dataset): as returned by run_fair_scenarios() with pulses "rcp" and "pulse", and the four RCPs
+        output (string): path to where plots should be saved
+        plot_all_scenarios (boolean): if true -> make fair visualization plots for both rcp45 and rcp85 as well as rcp45, 85, 6, and 3pd
+    """
+    from matplotlib import pyplot as plt
+    import seaborn as sns
+
+    styles = {
+        "rcp45": ("blue", "RCP4.5"),
+        "rcp85": ("black", "RCP8.5"),
+        "rcp26": ("green", "RCP3PD"),
+        "rcp60": ("red", "RCP6"),
+    }
+
+    def panels(runs, rcps, axes):
+        ax1, ax2, ax3, ax4 = axes
+        for rcp in rcps:
+            color, label = styles[rcp]
+            ax1.plot(runs.year, runs.co2_fossil.sel(rcp=rcp), color=color, label=label)
+            ax2.plot(runs.year, runs.concentration.sel(rcp=rcp), color=color)
+            ax3.plot(runs.year, runs.forcing.sel(rcp=rcp), color=color)
+            ax4.plot(runs.year, runs.temperature.sel(rcp=rcp), color=color)
+        ax1.legend()
+        sns.despine()
+
+    for runs, name, title in [
+        (fair_runs.sel(pulse="rcp"), "fair_control", None),
+        (
+            fair_runs.sel(pulse="pulse") - fair_runs.sel(pulse="rcp"),
+            "fair_response_to_impulse",
+            "Marginal effect of CO2 pulse by scenario",
+        ),
+    ]:
+        fig = plt.figure()
+        axes = [fig.add_subplot(221 + i) for i in range(4)]
+        if title:
+            fig.suptitle(title, size=18)
+        axes[0].set_ylabel("Fossil CO$_2$ Emissions (GtC)")
+        axes[1].set_ylabel("CO$_2$ concentrations (ppm)")
+        axes[2].set_ylabel("Total radiative forcing (W.m$^{-2}$)")
+        axes[3].set_ylabel("Temperature anomaly (K)")
+
+        panels(runs, ["rcp45", "rcp85"], axes)
+        fig.savefig("{}/{}_scenarios.pdf".format(output, name))
+
+        if plot_all_scenarios:
+            panels(runs, ["rcp26", "rcp60"], axes)
+            fig.savefig("{}/{}_all_scenarios.pdf".format(output, name))
+
+    # Plot global mean temperatures by scenario
+    fig, ax = plt.subplots(1, 1)
+    colors = ["green", "blue", "red", "black"]
+    styles = ["solid", "dashed"]
+
+    lines = []
+    labels = []
+    for r, rcp in enumerate(fair_runs.rcp.values):
+        for p, pulse in enumerate(fair_runs.pulse.values):
+            labels.append("{}{}".format(rcp, ["", "+"][p]))
+            lines.append(
+                ax.plot(
+                    fair_runs.year,
+                    fair_runs.temperature.sel(rcp=rcp, pulse=pulse),
+                    color=colors[r],
+                    linestyle=styles[p],
+                )[0]
+            )
+
+    plt.legend(lines, labels)
+    ax.set_title("Global mean surface temperature by scenario")
+    sns.despine()
+    fig.savefig("{}/gmst_by_scenarios.pdf".format(output))
+
 
 def temperatures_anomaly(
     PULSE_YEAR,
@@ -51,6 +213,8 @@ def temperatures_anomaly(
     output=None,
     make_plots=False,
     plot_all_scenarios=False,
+    n_jobs=-1,
+    use_cache=True,
 ):
     """
         Parameters:
@@ -58,8 +222,10 @@ def temperatures_anomaly(
         PULSE_AMT (double): quantity of pulse emitted in Gt C = 1e9 ton C
     anomaly_base (list-like of int): start and end year of base period for temp anomalies (inclusive)
         output (string): path to where plots should be saved
-        make_plots (boolean): if true -> make plots visualizing fair
+        make_plots (boolean): if true -> make plots visualizing fair, see plot_fair_scenarios()
         plot_all_scenarios (boolean): if true -> make fair visualization plots for both rcp45 and rcp85 as well as rcp45, 85, 6, and 3pd
+        n_jobs (int): number of processes used to run the eight FAIR scenarios, see run_fair_scenarios()
+        use_cache (boolean): if true -> reuse FAIR runs with the same inputs from the on-disk cache, see fair_cache.py
 
         Returns:
         DataArray: temperature projections under different emission scenarios with PULSE_AMT emitted in PULSE_YEAR
@@ -86,242 +252,32 @@ def temperatures_anomaly(
     else:
         raise NotImplementedError
 
-    tcr, ecs, d2, tau4 = lcp.get_median_climate_params(version=current_version).values
-
-    # Run the RCP emissions scenarios
-    C26, F26, T26 = fair.forward.fair_scm(
-        emissions=rcp3pd.Emissions.emissions,
-        tcrecs=np.array([tcr, ecs]),
-        tau=np.array([1000000, 394.4, 36.54, tau4]),
-        d=np.array([239.0, d2]),
-    )
-    C45, F45, T45 = fair.forward.fair_scm(
-        emissions=rcp45.Emissions.emissions,
-        tcrecs=np.array([tcr, ecs]),
-        tau=np.array([1000000, 394.4, 36.54, tau4]),
-        d=np.array([239.0, d2]),
-    )
-    C60, F60, T60 = fair.forward.fair_scm(
-        emissions=rcp6.Emissions.emissions,
-        tcrecs=np.array([tcr, ecs]),
-        tau=np.array([1000000, 394.4, 36.54, tau4]),
-        d=np.array([239.0, d2]),
-    )
-    C85, F85, T85 = fair.forward.fair_scm(
-        emissions=rcp85.Emissions.emissions,
-        tcrecs=np.array([tcr, ecs]),
-        tau=np.array([1000000, 394.4, 36.54, tau4]),
-        d=np.array([239.0, d2]),
-    )
-
-    if make_plots:
-
-        fig = plt.figure()
-        ax1 = fig.add_subplot(221)
-        ax2 = fig.add_subplot(222)
-        ax3 = fig.add_subplot(223)
-        ax4 = fig.add_subplot(224)
-
-        ax1.set_ylabel("Fossil CO$_2$ Emissions (GtC)")
-        ax2.set_ylabel("CO$_2$ concentrations (ppm)")
-        ax3.set_ylabel("Total radiative forcing (W.m$^{-2}$)")
-        ax4.set_ylabel("Temperature anomaly (K)")
-
-        # rcp45
-        ax1.plot(
-            rcp45.Emissions.year,
-            rcp45.Emissions.co2_fossil,
-            color="blue",
-            label="RCP4.5",
-        )
-        ax2.plot(rcp45.Emissions.year, C45[:, 0], color="blue")
-        ax3.plot(rcp45.Emissions.year, np.sum(F45, axis=1), color="blue")
-        ax4.plot(rcp45.Emissions.year, T45, color="blue")
-
-        # rcp85
-        ax1.plot(
-            rcp85.Emissions.year,
-            rcp85.Emissions.co2_fossil,
-            color="black",
-            label="RCP8.5",
-        )
-        ax2.plot(rcp85.Emissions.year, C85[:, 0], color="black")
-        ax3.plot(rcp85.Emissions.year, np.sum(F85, axis=1), color="black")
-        ax4.plot(rcp85.Emissions.year, T85, color="black")
-
-        sns.despine()
-        ax1.legend()
-        fig.savefig("{}/fair_control_scenarios.pdf".format(output))
-
-        if plot_all_scenarios:
-            # rcp3
-            ax1.plot(
-                rcp3pd.Emissions.year,
-                rcp3pd.Emissions.co2_fossil,
-                color="green",
-                label="RCP3PD",
-            )
-            ax2.plot(rcp3pd.Emissions.year, C26[:, 0], color="green")
-            ax3.plot(rcp3pd.Emissions.year, np.sum(F26, axis=1), color="green")
-            ax4.plot(rcp3pd.Emissions.year, T26, color="green")
-
-            # rcp6
-            ax1.plot(
-                rcp6.Emissions.year,
-                rcp6.Emissions.co2_fossil,
-                color="red",
-                label="RCP6",
-            )
-            ax2.plot(rcp6.Emissions.year, C60[:, 0], color="red")
-            ax3.plot(rcp6.Emissions.year, np.sum(F60, axis=1), color="red")
-            ax4.plot(rcp6.Emissions.year, T60, color="red")
-
-            ax1.legend()
-            sns.despine()
-            fig.savefig("{}/fair_control_all_scenarios.pdf".format(output))
-
-    # Create new emissions scenarios corresponding to each RCP with the additional pulse
-    # The deep_copy on the Emissions object was still allowing the pulse emissions to 
-    # accumulate each time the script is executed. Instead, copy the Emissions.emissions array.
-    
-    pulse, pulse_co2_fossil = {}, {}
-    for scen in [rcp3pd, rcp45, rcp6, rcp85]:
-        rcp = scen.__name__[scen.__name__.rindex(".") + 1 :]
-        # copy the emissions arrays
-        pulse[rcp] = scen.Emissions.emissions.copy()
-        pulse_co2_fossil[rcp] = scen.Emissions.co2_fossil.copy()
-        # add an additional impulse of fossil CO2
-        pulse_co2_fossil[rcp] = pulse_co2_fossil[rcp] + np.where(
-            scen.Emissions.year == PULSE_YEAR, PULSE_AMT, 0
+    pulses = {"rcp": None, "pulse": (PULSE_YEAR, PULSE_AMT)}
+
+    def compute():
+        climate_params = lcp.get_median_climate_params(version=current_version).values
+
+        # Run the RCP emissions scenarios, and the same scenarios with an additional impulse of fossil CO2
+        return run_fair_scenarios(climate_params, pulses=pulses, n_jobs=n_jobs)
+
+    with instrumentation.stage("load_fair"):
+        fair_runs = fair_cache.cached(
+            dict(
+                runs="median_climate_params",
+                climate_version=str(current_version),
+                pulses=pulses,
+                fair_version=fair.__version__,
+                emissions=fair_cache.emissions_hash(RCP_SCENARIOS),
+            ),
+            compute,
+            use_cache=use_cache,
         )
-        # update the emissions array to reflect the pulse
-        pulse[rcp][:, 1] = pulse_co2_fossil[rcp]
 
-    # Run FAIR for each of these new scenarios
-    C26p, F26p, T26p = fair.forward.fair_scm(
-        emissions=pulse["rcp3pd"],
-        tcrecs=np.array([tcr, ecs]),
-        tau=np.array([1000000, 394.4, 36.54, tau4]),
-        d=np.array([239.0, d2]),
-    )
-    C45p, F45p, T45p = fair.forward.fair_scm(
-        emissions=pulse["rcp45"],
-        tcrecs=np.array([tcr, ecs]),
-        tau=np.array([1000000, 394.4, 36.54, tau4]),
-        d=np.array([239.0, d2]),
-    )
-    C60p, F60p, T60p = fair.forward.fair_scm(
-        emissions=pulse["rcp6"],
-        tcrecs=np.array([tcr, ecs]),
-        tau=np.array([1000000, 394.4, 36.54, tau4]),
-        d=np.array([239.0, d2]),
-    )
-    C85p, F85p, T85p = fair.forward.fair_scm(
-        emissions=pulse["rcp85"],
-        tcrecs=np.array([tcr, ecs]),
-        tau=np.array([1000000, 394.4, 36.54, tau4]),
-        d=np.array([239.0, d2]),
-    )
-
-    # plot difference between RCP and RCP+ scenarios
     if make_plots:
+        plot_fair_scenarios(fair_runs, output, plot_all_scenarios=plot_all_scenarios)
 
-        fig = plt.figure()
-        ax1 = fig.add_subplot(221)
-        ax2 = fig.add_subplot(222)
-        ax3 = fig.add_subplot(223)
-        ax4 = fig.add_subplot(224)
-
-        fig.suptitle("Marginal effect of CO2 pulse by scenario", size=18)
-        ax1.set_ylabel("Fossil CO$_2$ Emissions (GtC)")
-        ax2.set_ylabel("CO$_2$ concentrations (ppm)")
-        ax3.set_ylabel("Total radiative forcing (W.m$^{-2}$)")
-        ax4.set_ylabel("Temperature anomaly (K)")
-
-        ax1.plot(
-            rcp45.Emissions.year,
-            (pulse_co2_fossil["rcp45"] - rcp45.Emissions.co2_fossil),
-            color="blue",
-            label="RCP4.5",
-        )
-        ax2.plot(rcp45.Emissions.year, (C45p[:, 0] - C45[:, 0]), color="blue")
-        ax3.plot(rcp45.Emissions.year, np.sum((F45p - F45), axis=1), color="blue")
-        ax4.plot(rcp45.Emissions.year, (T45p - T45), color="blue")
-
-        ax1.plot(
-            rcp85.Emissions.year,
-            (pulse_co2_fossil["rcp85"] - rcp85.Emissions.co2_fossil),
-            color="black",
-            label="RCP8.5",
-        )
-        ax2.plot(rcp85.Emissions.year, (C85p[:, 0] - C85[:, 0]), color="black")
-        ax3.plot(rcp85.Emissions.year, np.sum((F85p - F85), axis=1), color="black")
-        ax4.plot(rcp85.Emissions.year, (T85p - T85), color="black")
-
-        ax1.legend()
-        sns.despine()
-        fig.savefig("{}/fair_response_to_impulse_scenarios.pdf".format(output))
-
-        if plot_all_scenarios:
-            ax1.plot(
-                rcp3pd.Emissions.year,
-                (pulse_co2_fossil["rcp3pd"] - rcp3pd.Emissions.co2_fossil),
-                color="green",
-                label="RCP3PD",
-            )
-            ax2.plot(rcp3pd.Emissions.year, (C26p[:, 0] - C26[:, 0]), color="green")
-            ax3.plot(rcp3pd.Emissions.year, np.sum((F26p - F26), axis=1), color="green")
-            ax4.plot(rcp3pd.Emissions.year, (T26p - T26), color="green")
-
-            ax1.plot(
-                rcp6.Emissions.year,
-                (pulse_co2_fossil["rcp6"] - rcp6.Emissions.co2_fossil),
-                color="red",
-                label="RCP6",
-            )
-            ax2.plot(rcp6.Emissions.year, (C60p[:, 0] - C60[:, 0]), color="red")
-            ax3.plot(rcp6.Emissions.year, np.sum((F60p - F60), axis=1), color="red")
-            ax4.plot(rcp6.Emissions.year, (T60p - T60), color="red")
-
-            ax1.legend()
-            sns.despine()
-            fig.savefig("{}/fair_response_to_impulse_all_scenarios.pdf".format(output))
-
-    # Move temperature projections into xarray
-    fair_temperatures = xr.DataArray(
-        np.stack([np.stack([T26, T45, T60, T85]), np.stack([T26p, T45p, T60p, T85p])]),
-        dims=["pulse", "rcp", "year"],
-        coords=[
-            ["rcp", "pulse"],
-            ["rcp26", "rcp45", "rcp60", "rcp85"],
-            rcp85.Emissions.year,
-        ],
-    )
-
-    # Plot global mean temperatures by scenario
-    if make_plots:
-        fig, ax = plt.subplots(1, 1)
-        colors = ["green", "blue", "red", "black"]
-        styles = ["solid", "dashed"]
-
-        lines = []
-        labels = []
-        for r, rcp in enumerate(fair_temperatures.rcp.values):
-            for p, pulse in enumerate(fair_temperatures.pulse):
-                labels.append("{}{}".format(rcp, ["", "+"][p]))
-                lines.append(
-                    ax.plot(
-                        fair_temperatures.year,
-                        fair_temperatures.sel(rcp=rcp, pulse=pulse),
-                        color=colors[r],
-                        linestyle=styles[p],
-                    )[0]
-                )
-
-        plt.legend(lines, labels)
-        ax.set_title("Global mean surface temperature by scenario")
-        sns.despine()
-        fig.savefig("{}/gmst_by_scenarios.pdf".format(output))
+    fair_temperatures = fair_runs.temperature.copy()
+    fair_temperatures.name = None
 
     # Calculate temperature anomalies
     fair_temperatures_anomaly = fair_temperatures - fair_temperatures.sel(
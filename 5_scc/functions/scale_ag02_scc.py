@@ -12,12 +12,86 @@ values to the original file before saving the new one.
 Inputs:
 fpath: file path where the input file is stored; output is also saved here
 file: specific file that is appended
+
+The conversion is linear in the SCC, so it can also be applied to SCC arrays,
+ensemble netCDFs and quantile tables directly: `rescale_vsl` adds the rescaled
+values along the `vsl_value` coordinate of a DataArray or Dataset (lazily, for
+dask backed data), and `rescale_vsl_table` appends them to a DataFrame. Other
+VSL conventions are passed as ratios to the EPA VSL.
 """
 
 import os
 import sys
 import pandas as pd
 import numpy as np
+import xarray as xr
+
+# Ratio of AG02 VSl to EPA VSL:
+VSL_ADJUST = .2613994
+
+# GDPpc data from Fed (data/3_valuation/inputs/adjustments/fed_income_inflation.csv)
+# GDPpc in 2019 (2005$) (Consistent with EPA VSL)
+GDPPC_2019 = 50286.84
+# GDPpc in 1984 (2005$) (Consistent with AG02 VSL)
+GDPPC_1984 = 28224.61
+
+# Generate adjustment factor for converting denominator in income-scaling ratio
+# to the relevant year for AG02 VSL
+INCOME_ADJUST = GDPPC_2019 / GDPPC_1984
+
+# ratios of the SCC under each VSL convention to the SCC under the EPA VSL
+VSL_CONVENTIONS = {'ag02': INCOME_ADJUST * VSL_ADJUST}
+
+EXCLUDE = ['Unnamed: 0', 'discrate', 'rcp', 'age_adjustment', 'vsl_value',
+	'heterogeneity', 'time_cut']
+
+
+def rescale_vsl(data, ratios=None, source='epa', dim='vsl_value'):
+	"""
+	Parameters:
+	data (DataArray or Dataset): SCCs, damages or their quantiles, with a `dim` coordinate including `source`
+	ratios (dict or None): ratio of the values under each VSL convention to those under `source`. Defaults to VSL_CONVENTIONS
+	source (str): VSL convention that is rescaled
+	dim (str): VSL convention dimension
+
+	Returns:
+	DataArray or Dataset: `data`, with the rescaled values appended along `dim`. Variables of a Dataset without
+	`dim` are passed through unchanged. Dask backed data stays lazy
+	"""
+	if isinstance(data, xr.Dataset):
+		scaled = [var for var in data.data_vars if dim in data[var].dims]
+		rescaled = xr.Dataset({var: rescale_vsl(data[var], ratios, source, dim) for var in scaled}, attrs=data.attrs)
+		return rescaled.assign({var: data[var] for var in data.data_vars if var not in scaled})[list(data.data_vars)]
+
+	ratios = VSL_CONVENTIONS if ratios is None else ratios
+	factors = xr.DataArray(list(ratios.values()), dims=[dim], coords=[list(ratios.keys())])
+	rescaled = (data.sel({dim: source}, drop=True) * factors).transpose(*data.dims)
+	return xr.concat([data, rescaled], dim=dim)
+
+
+def rescale_vsl_table(df, ratios=None, source='epa', exclude=EXCLUDE):
+	"""
+	Parameters:
+	df (DataFrame): SCC table with a 'vsl_value' column, as the SCC CSVs of FAIR_pulse.ipynb
+	ratios (dict or None): ratio of the values under each VSL convention to those under `source`. Defaults to VSL_CONVENTIONS
+	source (str): VSL convention that is rescaled
+	exclude (list of str): columns that are not rescaled
+
+	Returns:
+	DataFrame: `df`, with the rescaled rows appended
+	"""
+	ratios = VSL_CONVENTIONS if ratios is None else ratios
+	include = [x for x in list(df) if x not in exclude and np.issubdtype(df[x].dtype, np.number)]
+	base = df.loc[df.vsl_value == source]
+
+	rescaled = []
+	for name, ratio in ratios.items():
+		df_scaled = base.copy()
+		df_scaled[include] = base[include].values * ratio
+		df_scaled['vsl_value'] = name
+		rescaled.append(df_scaled)
+
+	return pd.concat([df] + rescaled, sort=False)
 
 
 def Ashenfelter_Greenstone(fpath, file):
@@ -32,30 +106,7 @@ def Ashenfelter_Greenstone(fpath, file):
 
 	file_out = file[:-4] + '_ag02.csv'
 
-	exclude = ['Unnamed: 0', 'discrate', 'rcp', 'age_adjustment', 'vsl_value',
-		'heterogeneity', 'time_cut']
-
-	# Ratio of AG02 VSl to EPA VSL:
-	vsl_adjust = .2613994
-
-	# GDPpc data from Fed (data/3_valuation/inputs/adjustments/fed_income_inflation.csv)
-	# GDPpc in 2019 (2005$) (Consistent with EPA VSL)
-	gdppc_2019 = 50286.84
-	# GDPpc in 1984 (2005$) (Consistent with AG02 VSL)
-	gdppc_1984 = 28224.61
-
-	# Generate adjustment factor for converting denominator in income-scaling ratio
-	# to the relevant year for AG02 VSL
-	income_adjust = gdppc_2019 / gdppc_1984
-
-	is_numeric = lambda x: np.issubdtype(x.dtype, np.number)
-	include = [x for x in list(df) if x not in exclude and is_numeric(df[x])]
-	df_ag = df.loc[df.vsl_value=='epa'].copy()
-	for var in include:
-		df_ag[var] = df_ag[var] * income_adjust * vsl_adjust
-	df_ag['vsl_value'] = 'ag02'
-
-	df = df.append(df_ag)
+	df = rescale_vsl_table(df, {'ag02': VSL_CONVENTIONS['ag02']})
 
 	df.to_csv(os.path.join(fpath, file_out), index=False)
 	print("Appended AG SCC")
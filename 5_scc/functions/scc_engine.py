@@ -0,0 +1,230 @@
+"""
+--------------------------------------------------------------------------
+SCC quantiles of all the valuation scenarios, discount rates and RCPs
+in one pass over the intermediate ensemble files.
+
+The post-processing section of `full_uncertainty_ensemble.ipynb`
+selects one valuation scenario (age_adjustment, vsl_value,
+heterogeneity) at a time, and is rerun for each of them. Here each
+intermediate file (a block of simulations) is read once:
+
+1. the simulations rejected by the filter mask of the climate
+   parameters are dropped,
+2. the damages of all the valuation scenarios are discounted and summed
+   to SCCs for all discount rates at once (`discounting.compute_scc`),
+   so that only the SCCs of the block are kept,
+
+and the quantiles of the SCCs of all simulations are then computed for
+every cell at once: weighted by the quantile regression weights for the
+full uncertainty (`weighted_quantiles`), and as `.quantile()` for the
+climate-only uncertainty, as in the notebook.
+
+The result is written as a tidy table, with one row per valuation
+scenario, RCP, discount rate and quantile.
+
+Usage, from the 5_scc folder:
+
+    python functions/scc_engine.py --quantilereg --workers 8
+
+--------------------------------------------------------------------------
+"""
+import os
+import argparse
+import concurrent.futures
+import numpy as np
+import xarray as xr
+import load_climate_parameters as lcp
+import discounting
+import weighted_quantiles
+import ensemble_runner
+import scale_ag02_scc
+import instrumentation
+
+DAMAGES_VERSION = "v2.5.1"
+
+DAMAGE_VARNAME = "mortrate"
+
+QUANTILES = [0.01, 0.05, 0.17, 0.25, 0.5, 0.75, 0.83, 0.95, 0.99]
+
+
+def block_scc(path, mask=None, var=DAMAGE_VARNAME, rates=discounting.DISCOUNT_RATES, pulse_year=discounting.PULSE_YEAR):
+    """
+        Parameters:
+        path (str): intermediate file of a block of simulations
+        mask (np.array or None): (simulation,) boolean filter mask of all the climate draws. If None, all simulations are kept
+        var (str): damages variable
+        rates (list-like of double): constant discount rates, as fractions
+        pulse_year (int): year to which damages are discounted
+
+        Returns:
+        DataArray: 'scc' of the accepted simulations of the block, for all valuation scenarios, RCPs and discount rates
+    """
+    with xr.open_dataset(path) as ds:
+        if mask is not None:
+            with instrumentation.stage("filtering", simulations=ds.sizes["simulation"]):
+                simulations = ds.simulation.values
+                ds = ds.sel(simulation=simulations[mask[simulations]])
+        with instrumentation.stage("io_read", simulations=ds.sizes["simulation"]):
+            ds = ds.load()
+        with instrumentation.stage("discounting", simulations=ds.sizes["simulation"]):
+            return discounting.compute_scc(ds, var=var, rates=rates, pulse_year=pulse_year).scc
+
+
+def compute_sccs(paths, mask=None, rates=discounting.DISCOUNT_RATES, n_workers=1, progress=True):
+    """
+        Parameters:
+        paths (list of str): intermediate files, as returned by ensemble_runner.run_ensemble()
+        mask (np.array or None): see block_scc()
+        rates (list-like of double): constant discount rates, as fractions
+        n_workers (int): number of processes reading the files. If 1, they are read in this process
+        progress (boolean): if true -> show a progress bar
+
+        Returns:
+        DataArray: 'scc' of all the accepted simulations, sorted by simulation
+    """
+    if n_workers > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(n_workers)
+        results = executor.map(
+            instrumentation.collected,
+            [block_scc] * len(paths),
+            paths,
+            [mask] * len(paths),
+            [DAMAGE_VARNAME] * len(paths),
+            [rates] * len(paths),
+        )
+        # the instrumentation records of the workers are merged into those of this process
+        blocks = instrumentation.merged(results)
+    else:
+        executor = None
+        blocks = (block_scc(path, mask, rates=rates) for path in paths)
+
+    if progress:
+        import tqdm
+
+        blocks = tqdm.tqdm(blocks, total=len(paths), unit="file")
+
+    try:
+        blocks = [block for block in blocks if block.sizes["simulation"]]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    with instrumentation.stage("concat", simulations=sum(block.sizes["simulation"] for block in blocks)):
+        return xr.concat(blocks, dim="simulation").sortby("simulation")
+
+
+def scc_quantiles(scc, quantiles=QUANTILES, chunk_size=1000):
+    """
+        Parameters:
+        scc (DataArray): SCCs by simulation, as returned by compute_sccs()
+        quantiles (list-like of double): quantiles to compute, between 0-1
+        chunk_size (int): number of simulations per chunk of the weighted quantiles
+
+        Returns:
+        DataArray: quantiles of the SCCs over simulations, weighted by the quantile regression weights if `scc`
+        has a 'pctile' dimension
+    """
+    with instrumentation.stage("quantiles", simulations=scc.sizes["simulation"]):
+        if "pctile" in scc.dims:
+            return weighted_quantiles.weighted_quantile_xr(
+                scc,
+                quantiles,
+                weights=weighted_quantiles.get_weights(scc.pctile.values),
+                dim="simulation",
+                weight_dim="pctile",
+                chunk_size=chunk_size,
+            )
+        return scc.quantile(quantiles, dim="simulation")
+
+
+def tidy(quantiles):
+    """
+        Parameters:
+        quantiles (DataArray): SCC quantiles, as returned by scc_quantiles()
+
+        Returns:
+        DataFrame: one row per valuation scenario, RCP, discount rate and quantile, with an 'scc' column
+    """
+    return quantiles.rename("scc").to_series().reset_index()
+
+
+def run(
+    paths, mask=None, quantiles=QUANTILES, rates=discounting.DISCOUNT_RATES, n_workers=1, progress=True, vsl_ratios=None
+):
+    """
+        Parameters:
+        paths (list of str): intermediate files
+        mask (np.array or None): see block_scc()
+        quantiles (list-like of double): quantiles to compute, between 0-1
+        rates (list-like of double): constant discount rates, as fractions
+        n_workers (int): see compute_sccs()
+        progress (boolean): if true -> show a progress bar
+        vsl_ratios (dict or None): if not None -> the SCCs under other VSL conventions, as ratios to the EPA VSL SCCs,
+            are appended along 'vsl_value', see scale_ag02_scc.rescale_vsl()
+
+        Returns:
+        (DataFrame, DataArray): tidy SCC quantiles, and SCCs by simulation
+    """
+    scc = compute_sccs(paths, mask, rates, n_workers, progress)
+    quantiles = scc_quantiles(scc, quantiles)
+    if vsl_ratios is not None:
+        # the conversions are linear, so the quantiles of the rescaled SCCs are the rescaled quantiles
+        scc = scale_ag02_scc.rescale_vsl(scc, vsl_ratios)
+        quantiles = scale_ag02_scc.rescale_vsl(quantiles, vsl_ratios)
+    return tidy(quantiles), scc
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2] + " " + __doc__.split("\n")[3])
+    parser.add_argument("--quantilereg", action="store_true", help="full uncertainty (quantile regression damage functions); climate-only uncertainty otherwise")
+    parser.add_argument("--output-dir", default="{}/5_scc/global_scc/quadratic/uncertainty/".format(os.getenv("DB")), help="intermediate results folder")
+    parser.add_argument("--climate-version", default=lcp.CURRENT_VERSION)
+    parser.add_argument("--all-draws", action="store_true", help="keep the climate draws rejected by the filter mask of --climate-version")
+    parser.add_argument("--quantiles", type=float, nargs="+", default=QUANTILES)
+    parser.add_argument("--discount-rates", type=float, nargs="+", default=discounting.DISCOUNT_RATES, help="constant discount rates, as fractions")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes reading the intermediate files")
+    parser.add_argument("--ag02", action="store_true", help="also give the SCCs under the Ashenfelter and Greenstone (2002) VSL")
+    parser.add_argument("--save-simulations", action="store_true", help="also save the SCCs of all simulations to netCDF")
+    parser.add_argument("--report", default=None, help="JSON file of the time and memory of the stages of the run")
+    args = parser.parse_args(argv)
+
+    template = ensemble_runner.output_template(args.output_dir, args.quantilereg)
+    paths = [template.format(start=a, stop=b) for a, b in ensemble_runner.completed_ranges(template)]
+    if not paths:
+        raise IOError("no intermediate files matching {}".format(template.format(start="*", stop="*")))
+
+    mask = None if args.all_draws else np.asarray(lcp.get_filter_registry(args.climate_version).mask)
+    with instrumentation.stage("run"):
+        table, scc = run(
+            paths,
+            mask,
+            args.quantiles,
+            args.discount_rates,
+            args.workers,
+            vsl_ratios=scale_ag02_scc.VSL_CONVENTIONS if args.ag02 else None,
+        )
+
+    uncertainty = "fulluncertainty" if args.quantilereg else "climateuncertainty"
+    prefix = "quantilereg" if args.quantilereg else "climateonly"
+    savedir = os.path.join(args.output_dir, "mortality_damage_coefficients_global_poly4")
+    os.makedirs(savedir, exist_ok=True)
+
+    fp = os.path.join(
+        savedir,
+        "mortality_scc_{}_all-scenarios_summary_quantiles_{}_{}.csv".format(uncertainty, prefix, DAMAGES_VERSION),
+    )
+    table.to_csv(fp, index=False)
+    print("saved SCC quantiles to {}".format(fp))
+
+    if args.save_simulations:
+        fp = os.path.join(savedir, "mortality_scc_{}_all-scenarios_{}.nc".format(uncertainty, DAMAGES_VERSION))
+        scc.to_dataset(name="scc").to_netcdf(fp)
+        print("saved SCCs by simulation to {}".format(fp))
+
+    if args.report is not None:
+        instrumentation.report(args.report, **vars(args))
+        print(instrumentation.summary())
+
+
+if __name__ == "__main__":
+    main()
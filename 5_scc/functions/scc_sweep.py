@@ -0,0 +1,171 @@
+"""
+--------------------------------------------------------------------------
+SCC by emission (pulse) year.
+
+`FAIR_pulse.ipynb` computes the SCC of a pulse emitted in a single year.
+This module computes it for a range of pulse years at once: the control
+FAIR runs are computed once and shared by all pulse years, the pulsed
+runs of all pulse years are run as one batch, and the damages of the
+control runs are computed once. Marginal damages of each pulse year are
+discounted to that year.
+
+The result has a `pulse_year` dimension, in addition to the dimensions
+of the SCC computed in `FAIR_pulse.ipynb`.
+--------------------------------------------------------------------------
+"""
+import pandas as pd
+import xarray as xr
+import fair
+import load_climate_parameters as lcp
+import load_fair
+import fair_cache
+import damage_functions
+
+# [pulse/tCO2] per Gt C of pulse, see CONVERSION in FAIR_pulse.ipynb
+GTC_TO_TCO2 = 1.0 / 1e9 * 12.011 / 44.0098
+
+
+def _cached_runs(climate_version, climate_params, scenarios, pulses, n_jobs, use_cache):
+    def compute():
+        params = climate_params
+        if params is None:
+            params = lcp.get_median_climate_params(version=climate_version).values
+        return load_fair.run_fair_scenarios(params, scenarios=scenarios, pulses=pulses, n_jobs=n_jobs)
+
+    return fair_cache.cached(
+        dict(
+            runs="median_climate_params" if climate_params is None else list(map(float, climate_params)),
+            climate_version=str(climate_version),
+            pulses=pulses,
+            fair_version=fair.__version__,
+            emissions=fair_cache.emissions_hash(scenarios),
+        ),
+        compute,
+        use_cache=use_cache,
+    )
+
+
+def temperatures_anomaly_by_pulse_year(
+    pulse_years,
+    pulse_amt,
+    anomaly_base=[2001, 2011],
+    climate_version=lcp.CURRENT_VERSION,
+    climate_params=None,
+    scenarios=None,
+    n_jobs=-1,
+    use_cache=True,
+):
+    """
+        Parameters:
+        pulse_years (list-like of int): years in which the pulse is emitted
+        pulse_amt (double): quantity of pulse emitted in Gt C = 1e9 ton C
+        anomaly_base (list-like of int): start and end year of base period for temp anomalies (inclusive)
+        climate_version (str): climate parameters version, used for the median climate parameters
+        climate_params (list-like of double or None): tcr, ecs, d2, tau4. If None, the median parameters of `climate_version`
+        scenarios (dict or None): scenario name -> emissions array, defaults to load_fair.RCP_SCENARIOS
+        n_jobs (int): number of processes used to run FAIR, see load_fair.run_fair_scenarios()
+        use_cache (boolean): if true -> reuse FAIR runs from the on-disk cache, see fair_cache.py
+
+        Returns:
+        DataArray: temperature anomalies with dimensions (pulse_year, pulse, rcp, year), pulse being "rcp" for the
+        control runs and "pulse" for the runs with the pulse emitted in `pulse_year`, as in load_fair.temperatures_anomaly()
+        Raises a ValueError if a pulse year is not a year of the emissions of the scenarios.
+    """
+    scenarios = load_fair.RCP_SCENARIOS if scenarios is None else scenarios
+    pulse_years = [int(y) for y in pulse_years]
+    for name, emissions in scenarios.items():
+        # load_fair.add_pulse() adds nothing in a year without emissions, which would give SCCs of zero
+        missing = sorted(set(pulse_years) - set(emissions[:, 0].astype(int)))
+        if missing:
+            raise ValueError(
+                "pulse years {} are not emission years of {} ({}-{})".format(
+                    missing, name, int(emissions[0, 0]), int(emissions[-1, 0])
+                )
+            )
+
+    # the control runs don't depend on the pulse year, and are cached separately so that they are shared across sweeps
+    control = _cached_runs(climate_version, climate_params, scenarios, {"rcp": None}, n_jobs, use_cache)
+    pulsed = _cached_runs(
+        climate_version, climate_params, scenarios, {y: (y, pulse_amt) for y in pulse_years}, n_jobs, use_cache
+    )
+
+    control = control.temperature.sel(pulse="rcp", drop=True)
+    pulsed = pulsed.temperature.rename({"pulse": "pulse_year"})
+    pulsed["pulse_year"] = pulse_years
+
+    temperatures = xr.concat(
+        [control.broadcast_like(pulsed), pulsed], dim=pd.Index(["rcp", "pulse"], name="pulse")
+    ).transpose("pulse_year", "pulse", "rcp", "year")
+
+    temperatures_anomaly = temperatures - temperatures.sel(
+        year=slice(anomaly_base[0], anomaly_base[1])
+    ).mean(dim="year")
+    temperatures_anomaly.name = None
+
+    return temperatures_anomaly
+
+
+def damage_polynomial_powers(coeff_names):
+    """
+        Parameters:
+        coeff_names (list of str): damage function coefficient names, 'cons' and 'beta1', 'beta2', ...
+
+        Returns:
+        DataArray: power of the temperature anomaly multiplied by each coefficient, along a 'coeff' dimension
+    """
+    powers = damage_functions.coefficient_powers(coeff_names)
+    return xr.DataArray(powers, dims=["coeff"], coords=[list(coeff_names)])
+
+
+def damages_from_temperatures(coeffs, temperatures):
+    """
+        Parameters:
+        coeffs (Dataset): damage function coefficients by year, one variable per coefficient, as `coeffs_all_years` in FAIR_pulse.ipynb
+        temperatures (DataArray): temperature anomalies with a 'year' dimension
+
+        Returns:
+        DataArray: damages for the years common to `coeffs` and `temperatures`
+    """
+    return damage_functions.evaluate(coeffs, temperatures)
+
+
+def scc_by_pulse_year(
+    coeffs,
+    pulse_years,
+    pulse_amt=1.0,
+    discrates=[1.0, 1.5, 2.0, 2.5, 3.0, 5.0, 7.0],
+    magnitude_of_damages=1e9,
+    **kwargs
+):
+    """
+        Computes the SCC of a pulse emitted in each of `pulse_years`, discounted to the pulse year.
+
+        Parameters:
+        coeffs (Dataset): damage function coefficients by year, as `coeffs_all_years` in FAIR_pulse.ipynb
+        pulse_years (list-like of int): years in which the pulse is emitted. Damages are summed from the pulse year to the last year of `coeffs`
+        pulse_amt (double): quantity of pulse emitted in Gt C = 1e9 ton C
+        discrates (list-like of double): constant discount rates, in percent
+        magnitude_of_damages (double): magnitude of damage function values
+        kwargs: passed to temperatures_anomaly_by_pulse_year()
+
+        Returns:
+        DataArray: SCC in $/ton CO2 with dimensions (pulse_year, discrate, rcp) and the dimensions of `coeffs` other than 'year'
+    """
+    temperatures = temperatures_anomaly_by_pulse_year(pulse_years, pulse_amt, **kwargs)
+
+    # damages of the control runs are the same for all pulse years
+    control = damages_from_temperatures(coeffs, temperatures.sel(pulse="rcp").isel(pulse_year=0, drop=True))
+    pulsed = damages_from_temperatures(coeffs, temperatures.sel(pulse="pulse"))
+
+    conversion = magnitude_of_damages * GTC_TO_TCO2 / pulse_amt
+    marginal_damages = (pulsed - control) * conversion
+
+    discrates = xr.DataArray(list(discrates), dims=["discrate"], coords=[list(discrates)])
+    years_since_pulse = marginal_damages.year - marginal_damages.pulse_year
+    discount_factors = xr.where(
+        years_since_pulse >= 0, (1 + discrates / 100) ** (-years_since_pulse), 0.0
+    )
+
+    # missing damages are skipped, as by the sum over years of FAIR_pulse.ipynb
+    scc = xr.dot(marginal_damages.fillna(0), discount_factors, dims="year")
+    return scc.transpose("pulse_year", "discrate", "rcp", ...)
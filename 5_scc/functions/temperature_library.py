@@ -0,0 +1,239 @@
+"""
+--------------------------------------------------------------------------
+Library of the temperature anomalies of the climate ensemble.
+
+The temperature anomalies of the control and pulse FAIR runs only depend
+on the climate parameters, but `compute_and_save_damages_block` reruns
+FAIR for each damage function specification (central or quantile
+regression, or new damage coefficients). Here they are computed once
+per climate parameters version, and stored by blocks of simulations:
+
+    python functions/temperature_library.py build --workers 8
+
+The damages of any damage function specification are then an array
+operation over the library, written to the intermediate files of
+`ensemble_runner.py`, with the same simulation blocks:
+
+    python functions/temperature_library.py damages --quantilereg --workers 8
+
+As with `ensemble_runner.py`, blocks are written atomically and existing
+files are skipped, so interrupted runs are resumed by running the same
+command again.
+--------------------------------------------------------------------------
+"""
+import os
+import argparse
+import concurrent.futures
+import numpy as np
+import xarray as xr
+import load_climate_parameters as lcp
+import ensemble_runner
+import instrumentation
+
+
+def library_template(output_dir, climate_version=lcp.CURRENT_VERSION):
+    """
+        Parameters:
+        output_dir (str): folder of the intermediate results, `DB/5_scc/global_scc/quadratic/uncertainty/`
+        climate_version (str): climate parameters version
+
+        Returns:
+        str: library file path with `{start}` and `{stop}` fields for the simulation range
+    """
+    return os.path.join(
+        output_dir,
+        "temperature_library",
+        "fair_temperature_anomalies_climate-v{}_{{start}}-{{stop}}.nc".format(climate_version),
+    )
+
+
+def compute_and_save_temperature_block(start, stop, climate_params, template, simulations=None):
+    """
+        Computes the temperature anomalies of a block of climate parameters and saves them to disk.
+        Does nothing if the file of the block already exists.
+
+        Parameters:
+        start, stop (int): simulation range of the block
+        climate_params (np.array): simulation x 4 climate parameters of the block
+        template (str): library file path, as returned by library_template()
+        simulations (np.array or None): simulation indices of the rows of `climate_params`, within [start, stop).
+            Defaults to all the simulations of the range.
+
+        Returns:
+        str: path of the library file
+    """
+    path = template.format(start=start, stop=stop)
+    if os.path.isfile(path):
+        return path
+
+    simulations = np.arange(start, stop) if simulations is None else simulations
+    ds = (
+        ensemble_runner.temperature_anomalies_block(climate_params)
+        .assign_coords(simulation=simulations)
+        .to_dataset(name="temperature_anomaly")
+    )
+    ensemble_runner._write_atomic(ds, path)
+    return path
+
+
+def build_library(
+    climate_params,
+    template,
+    start=0,
+    stop=None,
+    mask=None,
+    block_size=None,
+    n_workers=None,
+    memory_per_worker=ensemble_runner.MEMORY_PER_WORKER,
+    scheduler="processes",
+    progress=True,
+):
+    """
+        Runs compute_and_save_temperature_block() over all the blocks of [start, stop) that aren't in the library yet.
+        Simulations rejected by `mask` are not run.
+
+        Parameters:
+        climate_params (np.array): (simulation x 4) climate parameters, as lcp.get_parameters(filtered=False)
+        template (str): library file path, as returned by library_template()
+        start, stop, mask, block_size, n_workers, memory_per_worker, scheduler, progress: see ensemble_runner.run_ensemble()
+
+        Returns:
+        list of str: paths of the library files written or found
+    """
+    stop = len(climate_params) if stop is None else min(stop, len(climate_params))
+    if block_size is None:
+        block_size = ensemble_runner.block_size_for_memory(0, True, memory_per_worker)
+
+    done = ensemble_runner.completed_ranges(template)
+    blocks = ensemble_runner.plan_blocks(start, stop, block_size, done, mask)
+    paths = [template.format(start=a, stop=b) for a, b in done if a < stop and b > start]
+    print("{} library blocks to run".format(len(blocks)))
+    if not blocks:
+        return paths
+
+    paths += ensemble_runner.run_blocks(
+        compute_and_save_temperature_block,
+        blocks,
+        climate_params,
+        n_workers=n_workers,
+        memory_per_worker=memory_per_worker,
+        scheduler=scheduler,
+        progress=progress,
+        template=template,
+    )
+    return sorted(paths)
+
+
+def compute_and_save_damages_from_library_block(start, stop, library, damage_spec, template):
+    """
+        Computes the damages of the simulations of a library file and saves them to the intermediate file of the same
+        range. Does nothing if the intermediate file already exists.
+
+        Parameters:
+        start, stop (int): simulation range of the library file
+        library (str): library file path, as returned by library_template()
+        damage_spec (DataFrame): damage function coefficients, as returned by ensemble_runner.load_damage_spec()
+        template (str): intermediate file path, as returned by ensemble_runner.output_template()
+
+        Returns:
+        str: path of the intermediate file
+    """
+    path = template.format(start=start, stop=stop)
+    if os.path.isfile(path):
+        return path
+
+    with instrumentation.stage("io_read", simulations=stop - start):
+        with xr.open_dataset(library.format(start=start, stop=stop)) as ds:
+            temperatures = ds.temperature_anomaly.load()
+
+    damages = ensemble_runner.marginal_damages(temperatures, damage_spec)
+    ensemble_runner._write_atomic(
+        ensemble_runner.damages_dataset(damages, temperatures.simulation.values, damage_spec), path
+    )
+    return path
+
+
+def damages_from_library(library, damage_spec, template, n_workers=None, progress=True):
+    """
+        Runs compute_and_save_damages_from_library_block() for all the files of the library.
+
+        Parameters:
+        library (str): library file path, as returned by library_template()
+        damage_spec (DataFrame): damage function coefficients, as returned by ensemble_runner.load_damage_spec()
+        template (str): intermediate file path, as returned by ensemble_runner.output_template()
+        n_workers (int or None): number of worker processes, defaults to the number of CPUs
+        progress (boolean): if true -> show a progress bar
+
+        Returns:
+        list of str: paths of the intermediate files written or found
+    """
+    ranges = ensemble_runner.completed_ranges(library)
+    if not ranges:
+        raise IOError("no library files matching {}".format(library.format(start="*", stop="*")))
+
+    with concurrent.futures.ProcessPoolExecutor(n_workers or os.cpu_count()) as executor:
+        paths = executor.map(
+            instrumentation.collected,
+            [compute_and_save_damages_from_library_block] * len(ranges),
+            [a for a, _ in ranges],
+            [b for _, b in ranges],
+            [library] * len(ranges),
+            [damage_spec] * len(ranges),
+            [template] * len(ranges),
+        )
+        if progress:
+            import tqdm
+
+            paths = tqdm.tqdm(paths, total=len(ranges), unit="file")
+        return list(instrumentation.merged(paths))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[2])
+    parser.add_argument("stage", choices=["build", "damages"], help="build the library, or compute damages from it")
+    parser.add_argument("--quantilereg", action="store_true", help="damages: full uncertainty (quantile regression damage functions); climate-only uncertainty otherwise")
+    parser.add_argument("--input-dir", default="{}/4_damage_function/".format(os.getenv("DB")), help="damage function coefficients folder")
+    parser.add_argument("--output-dir", default="{}/5_scc/global_scc/quadratic/uncertainty/".format(os.getenv("DB")), help="intermediate results folder")
+    parser.add_argument("--climate-version", default=lcp.CURRENT_VERSION)
+    parser.add_argument("--start", type=int, default=0, help="build: first simulation")
+    parser.add_argument("--stop", type=int, default=None, help="build: end of the simulation range, defaults to all simulations")
+    parser.add_argument("--block-size", type=int, default=None, help="build: simulations per block, sized to --memory-per-worker by default")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, defaults to the number of CPUs")
+    parser.add_argument("--memory-per-worker", type=float, default=ensemble_runner.MEMORY_PER_WORKER / 1024 ** 3, help="build: memory budget of a worker, in GB")
+    parser.add_argument("--scheduler", choices=["processes", "dask"], default="processes")
+    parser.add_argument("--all-draws", action="store_true", help="build: also run the climate draws rejected by the filter mask of --climate-version")
+    parser.add_argument("--report", default=None, help="JSON file of the time and memory of the stages of the run")
+    args = parser.parse_args(argv)
+
+    library = library_template(args.output_dir, args.climate_version)
+
+    with instrumentation.stage("run"):
+        if args.stage == "build":
+            climate_params = lcp.get_parameters(filtered=False, version=args.climate_version)
+            mask = None if args.all_draws else ensemble_runner.resolve_mask(args.climate_version, len(climate_params))
+            build_library(
+                climate_params,
+                library,
+                start=args.start,
+                stop=args.stop,
+                mask=mask,
+                block_size=args.block_size,
+                n_workers=args.workers,
+                memory_per_worker=int(args.memory_per_worker * 1024 ** 3),
+                scheduler=args.scheduler,
+            )
+        else:
+            damages_from_library(
+                library,
+                ensemble_runner.load_damage_spec(args.input_dir, args.quantilereg),
+                ensemble_runner.output_template(args.output_dir, args.quantilereg),
+                n_workers=args.workers,
+            )
+
+    if args.report is not None:
+        instrumentation.report(args.report, **vars(args))
+        print(instrumentation.summary())
+
+
+if __name__ == "__main__":
+    main()
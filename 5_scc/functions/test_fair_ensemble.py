@@ -0,0 +1,89 @@
+"""
+--------------------------------------------------------------------------
+Checks the vectorized FAIR kernel of fair_ensemble.py against
+`fair.forward.fair_scm`, run for each climate parameter set, for the
+RCP4.5 and RCP8.5 control and pulse runs, with and without the aerosol
+forcing scaling.
+
+Usage, from the 5_scc folder:
+
+    python -m pytest functions/test_fair_ensemble.py
+
+--------------------------------------------------------------------------
+"""
+import os
+import sys
+import numpy as np
+import fair
+import pytest
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+import load_fair
+import fair_ensemble
+
+pytestmark = [
+    pytest.mark.skipif(fair.__version__ != load_fair.project_fair_vers, reason="the kernel follows FAIR 1.3.2"),
+    pytest.mark.skipif(not fair_ensemble.FAIR_SCM_SUPPORTED, reason="FAIR 1.3.2 fair_scm requires numpy < 2"),
+]
+
+RTOL = 1e-10
+# the total forcing sums agents of opposite signs, and is close to zero in some early years
+ATOL = 1e-10
+
+SCENARIOS = {name: load_fair.RCP_SCENARIOS[name] for name in ["rcp45", "rcp85"]}
+PULSES = {"rcp": None, "pulse": (2020, 1.0)}
+
+# tcr, ecs, d2, tau4 around the median of the climate parameters, and at the ends of their range
+CLIMATE_PARAMS = np.array(
+    [
+        [1.7, 3.1, 4.0, 4.1],
+        [1.2, 2.0, 2.5, 3.0],
+        [2.5, 5.5, 8.0, 6.0],
+        [1.9, 2.6, 3.2, 4.8],
+    ]
+)
+
+AEROSCALE = np.array([1.0, 0.6, 1.4, 0.9])
+
+
+def _reference(emissions, params):
+    tcr, ecs, d2, tau4 = params[:4]
+    scale = np.ones(len(fair_ensemble.EFFICACY))
+    if len(params) > 4:
+        scale[fair_ensemble.AEROSOL_INDEX] = params[4]
+    C, F, T = fair.forward.fair_scm(
+        emissions=emissions,
+        tcrecs=np.array([tcr, ecs]),
+        tau=np.array(load_fair.FAIR_TAU + [tau4]),
+        d=np.array([load_fair.FAIR_D1, d2]),
+        scale=scale,
+    )
+    return {"concentration": C[:, 0], "forcing": F.sum(axis=1), "temperature": T}
+
+
+@pytest.mark.parametrize("aeroscale", [False, True], ids=["default", "aeroscale"])
+def test_run_fair_ensemble_matches_fair_scm(aeroscale):
+    params = np.column_stack([CLIMATE_PARAMS, AEROSCALE]) if aeroscale else CLIMATE_PARAMS
+    ds = fair_ensemble.run_fair_ensemble(params, scenarios=SCENARIOS, pulses=PULSES)
+
+    for p, pulse in PULSES.items():
+        for s, emissions in SCENARIOS.items():
+            if pulse is not None:
+                emissions = load_fair.add_pulse(emissions, *pulse)
+            for i in range(len(params)):
+                expected = _reference(emissions, params[i])
+                for name, values in expected.items():
+                    np.testing.assert_allclose(
+                        ds[name].sel(pulse=p, rcp=s).isel(simulation=i).values,
+                        values,
+                        rtol=RTOL,
+                        atol=ATOL,
+                        err_msg="{} of {} {} simulation {}".format(name, s, p, i),
+                    )
+
+
+def test_pulse_raises_temperature():
+    ds = fair_ensemble.run_fair_ensemble(CLIMATE_PARAMS, scenarios=SCENARIOS, pulses=PULSES)
+    difference = (ds.temperature.sel(pulse="pulse") - ds.temperature.sel(pulse="rcp")).sel(year=slice(2021, 2300))
+    assert (difference > 0).all()
@@ -0,0 +1,87 @@
+"""
+--------------------------------------------------------------------------
+Checks the chunked weighted quantiles of weighted_quantiles.py against
+the quantiles of the stacked observations (sort, weighted midpoints and
+interpolation, as impactlab_tools.utils.weighting.weighted_quantile),
+with ties, near-ties and chunk sizes that don't divide the number of
+simulations.
+
+Usage, from the 5_scc folder:
+
+    python -m pytest functions/test_weighted_quantiles.py
+
+--------------------------------------------------------------------------
+"""
+import os
+import sys
+import numpy as np
+import xarray as xr
+import pytest
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+import weighted_quantiles
+
+QUANTILES = [0.0, 0.01, 0.05, 0.17, 0.25, 0.5, 0.75, 0.83, 0.95, 0.99, 1.0]
+PCTILES = [0.05, 0.1, 0.25, 0.4, 0.5, 0.6, 0.75, 0.9, 0.95]
+
+
+def _stacked_quantiles(da, quantiles, weights):
+    x = da.transpose("simulation", "pctile", ...).values
+    x = x.reshape((-1,) + x.shape[2:])
+    w = np.tile(weights, da.sizes["simulation"])
+    result = np.empty((len(quantiles),) + x.shape[1:])
+    for cell in np.ndindex(*x.shape[1:]):
+        values = x[(slice(None),) + cell]
+        order = np.argsort(values, kind="stable")
+        midpoints = np.cumsum(w[order]) - 0.5 * w[order]
+        result[(slice(None),) + cell] = np.interp(np.asarray(quantiles) * w.sum(), midpoints, values[order])
+    return result
+
+
+def _ensemble(values):
+    return xr.DataArray(
+        values,
+        dims=["simulation", "pctile", "rcp"],
+        coords={"simulation": np.arange(values.shape[0]), "pctile": PCTILES[: values.shape[1]], "rcp": ["rcp45", "rcp85"]},
+    )
+
+
+def _samples(kind, seed, n_simulations):
+    rng = np.random.RandomState(seed)
+    shape = (n_simulations, len(PCTILES), 2)
+    if kind == "continuous":
+        return rng.lognormal(3, 1, shape)
+    if kind == "ties":
+        return rng.randint(0, 5, shape).astype(float)
+    if kind == "near_ties":
+        return 100 + 1e-12 * rng.randn(*shape)
+    if kind == "constant":
+        return np.full(shape, 7.0)
+    raise ValueError(kind)
+
+
+@pytest.mark.parametrize("kind", ["continuous", "ties", "near_ties", "constant"])
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("n_simulations, chunk_size", [(2000, 1000), (1001, 97), (37, 1000)])
+def test_matches_stacked_quantiles(kind, seed, n_simulations, chunk_size):
+    da = _ensemble(_samples(kind, seed, n_simulations))
+    weights = weighted_quantiles.get_weights(PCTILES)
+
+    result = weighted_quantiles.weighted_quantile_xr(da, QUANTILES, weights=weights, chunk_size=chunk_size)
+
+    assert result.dims == ("quantile", "rcp")
+    # the cumulative weights are summed in another order than in the stacked reference
+    np.testing.assert_allclose(result.values, _stacked_quantiles(da, QUANTILES, weights), rtol=1e-10, atol=0)
+
+
+def test_dask_chunks_match_numpy():
+    pytest.importorskip("dask")
+    da = _ensemble(_samples("ties", 0, 1001))
+    weights = weighted_quantiles.get_weights(PCTILES)
+
+    expected = weighted_quantiles.weighted_quantile_xr(da, QUANTILES, weights=weights, chunk_size=97)
+    result = weighted_quantiles.weighted_quantile_xr(
+        da.chunk({"simulation": 97}), QUANTILES, weights=weights, chunk_size=97
+    )
+    np.testing.assert_array_equal(result.values, expected.values)
@@ -0,0 +1,283 @@
+"""
+--------------------------------------------------------------------------
+Out-of-core weighted quantiles of the quantile regression ensemble.
+
+`full_uncertainty_ensemble.ipynb` computed the quantiles of the full
+uncertainty by stacking the (simulation, pctile) dimensions of the
+damages or SCCs in memory, and calling
+`impactlab_tools.utils.weighting.weighted_quantile_xr` on the stacked
+array, each observation being weighted by the mass of the distribution
+represented by its quantile regression (`get_weights`).
+
+`weighted_quantile_xr` here gives the same quantiles (interpolation
+between the weighted midpoints of the sorted observations) while only
+holding a chunk of simulations in memory at a time:
+
+1. a first pass computes the range of the values of each cell (every
+   combination of the dimensions other than simulation and pctile),
+2. each following pass computes, by chunks of simulations, a weighted
+   histogram of the values in the current bracket of each quantile and
+   cell, and the exact number of observations below the bracket. The
+   bracket is narrowed to the bins around the quantile, with a margin of
+   the largest observation weight,
+3. once a bracket holds few observations, or only ties or near-ties
+   (within a few floating point spacings) that can't be separated, they
+   are gathered, sorted, and the quantile is selected exactly.
+
+The partial results of the chunks are merged by sums, minimums and
+concatenations, so the chunks of dask backed arrays are processed in
+parallel.
+--------------------------------------------------------------------------
+"""
+import numpy as np
+import xarray as xr
+
+
+def get_weights(quantiles):
+    """
+        Compute the weights of each quantile regression.
+        `quantiles` must be between 0-1!
+    """
+    quantiles = np.array(quantiles)
+    # find midpoints between quantiles
+    bounds = np.array([0] + ((quantiles[:-1] + quantiles[1:]) / 2).tolist() + [1])
+    if (bounds > 1).any():
+        raise RuntimeError("quantiles must be between 0-1")
+    weights = np.diff(bounds)
+    return weights
+
+
+def _chunks(da, dim, chunk_size):
+    for start in range(0, da.sizes[dim], chunk_size):
+        yield da.isel({dim: slice(start, start + chunk_size)})
+
+
+def _map_reduce(chunks, func, reducers, *args):
+    """
+        Applies func(values, *args) to the values of each chunk, and merges the tuples of partial results with `reducers`.
+        The chunks of dask backed arrays are computed in parallel.
+    """
+    chunks = list(chunks)
+    if chunks[0].chunks is not None:
+        import dask
+
+        partials = dask.compute(*[dask.delayed(func)(chunk.data, *args) for chunk in chunks])
+    else:
+        partials = [func(chunk.values, *args) for chunk in chunks]
+
+    merged = list(partials[0])
+    for partial in partials[1:]:
+        merged = [reduce(a, b) for reduce, a, b in zip(reducers, merged, partial)]
+    return merged
+
+
+def _observations(values, weights):
+    """
+        (simulation x pctile x cell...) values -> (observation x cell) values and (observation,) weights
+    """
+    n_simulations, n_weights = values.shape[:2]
+    return values.reshape(n_simulations * n_weights, -1), np.tile(weights, n_simulations)
+
+
+def _range_partial(values, weights):
+    x, _ = _observations(values, weights)
+    return x.min(axis=0), x.max(axis=0)
+
+
+def _histogram_partial(values, weights, lo, hi, nbins):
+    x, w = _observations(values, weights)
+    n_quantiles, n_cells = lo.shape
+    offsets = np.arange(n_cells) * nbins
+
+    hist = np.zeros((n_quantiles, n_cells * nbins))
+    count = np.zeros((n_quantiles, n_cells), dtype=np.int64)
+    below = np.zeros((n_quantiles, len(weights), n_cells), dtype=np.int64)
+    inner_min = np.full((n_quantiles, n_cells), np.inf)
+    inner_max = np.full((n_quantiles, n_cells), -np.inf)
+
+    for q in range(n_quantiles):
+        inside = (x >= lo[q]) & (x < hi[q])
+        k = np.clip(np.floor((x - lo[q]) / (hi[q] - lo[q]) * nbins), 0, nbins - 1).astype(np.int64)
+        hist[q] = np.bincount(
+            (offsets + k)[inside], weights=np.broadcast_to(w[:, None], x.shape)[inside], minlength=n_cells * nbins
+        )
+        count[q] = inside.sum(axis=0)
+        below[q] = (x < lo[q]).reshape(-1, len(weights), n_cells).sum(axis=0)
+        inner_min[q] = np.where(inside, x, np.inf).min(axis=0)
+        inner_max[q] = np.where(inside, x, -np.inf).max(axis=0)
+
+    return hist.reshape(n_quantiles, n_cells, nbins), count, below, inner_min, inner_max
+
+
+def _gather_partial(values, weights, lo, hi, max_candidates):
+    x, w = _observations(values, weights)
+    n_quantiles, n_cells = lo.shape
+    n = min(max_candidates, len(x))
+
+    candidates = np.full((n_quantiles, n_cells, max_candidates), np.inf)
+    candidate_weights = np.zeros((n_quantiles, n_cells, max_candidates))
+    below = np.zeros((n_quantiles, len(weights), n_cells), dtype=np.int64)
+
+    for q in range(n_quantiles):
+        inside = (x >= lo[q]) & (x < hi[q])
+        # observations in the bracket first
+        order = np.argsort(~inside, axis=0, kind="stable")[:n]
+        selected = np.take_along_axis(inside, order, axis=0)
+        candidates[q, :, :n] = np.where(selected, np.take_along_axis(x, order, axis=0), np.inf).T
+        candidate_weights[q, :, :n] = np.where(selected, w[order], 0.0).T
+        below[q] = (x < lo[q]).reshape(-1, len(weights), n_cells).sum(axis=0)
+
+    order = np.argsort(candidates, axis=-1, kind="stable")
+    return (np.take_along_axis(candidates, order, axis=-1), np.take_along_axis(candidate_weights, order, axis=-1)), below
+
+
+def _merge_candidates(a, b):
+    """
+        Merges the sorted candidates of two chunks, keeping as many of the smallest values of each bracket as there
+        are in one chunk, which include all the observations of the bracket.
+    """
+    candidates = np.concatenate([a[0], b[0]], axis=-1)
+    candidate_weights = np.concatenate([a[1], b[1]], axis=-1)
+    order = np.argsort(candidates, axis=-1, kind="stable")[..., : a[0].shape[-1]]
+    return np.take_along_axis(candidates, order, axis=-1), np.take_along_axis(candidate_weights, order, axis=-1)
+
+
+def weighted_quantile_xr(
+    da,
+    quantiles,
+    weights=None,
+    dim="simulation",
+    weight_dim="pctile",
+    chunk_size=1000,
+    nbins=64,
+    max_candidates=32,
+    max_passes=50,
+):
+    """
+        Weighted quantiles over the (dim, weight_dim) observations of `da`, computed by chunks of `dim`.
+
+        Gives the quantiles of impactlab_tools.utils.weighting.weighted_quantile_xr() on `da` stacked over
+        (dim, weight_dim), with the weight of each observation given by its `weight_dim` coordinate.
+
+        Parameters:
+        da (DataArray): numpy or dask backed values, without missing values
+        quantiles (list-like of double): quantiles to compute, between 0-1
+        weights (list-like of double or None): weight of each `weight_dim` coordinate, as returned by get_weights().
+            If None, all observations have the same weight
+        dim (str): dimension along which `da` is read by chunks
+        weight_dim (str or None): dimension of the weights, also reduced. If None, only `dim` is reduced
+        chunk_size (int): number of `dim` coordinates per chunk
+        nbins (int): number of histogram bins per quantile and cell in each pass
+        max_candidates (int): number of observations of a bracket below which they are gathered for the exact selection
+        max_passes (int): maximum number of histogram passes
+
+        Returns:
+        DataArray: quantiles with a 'quantile' dimension in place of `dim` and `weight_dim`
+    """
+    if weight_dim is None or weight_dim not in da.dims:
+        da = da.expand_dims("_weight", axis=1)
+        weight_dim = "_weight"
+        weights = [1.0]
+    elif weights is None:
+        weights = np.ones(da.sizes[weight_dim])
+
+    cell_dims = [d for d in da.dims if d not in (dim, weight_dim)]
+    da = da.transpose(dim, weight_dim, *cell_dims)
+    weights = np.asarray(weights, dtype=float)
+    quantiles = np.asarray(quantiles, dtype=float)
+
+    n_cells = int(np.prod([da.sizes[d] for d in cell_dims]))
+    total = da.sizes[dim] * weights.sum()
+    # target position of each quantile, on the cumulative weight axis
+    targets = np.broadcast_to(quantiles[:, None] * total, (len(quantiles), n_cells))
+    # observations i and i+1 around a target have weighted midpoints within w_max of it, and start within 2 w_max
+    margin_lo = targets - 2 * weights.max()
+    margin_hi = targets + weights.max()
+
+    def chunks():
+        return _chunks(da, dim, chunk_size)
+
+    vmin, vmax = _map_reduce(chunks(), _range_partial, [np.minimum, np.maximum], weights)
+    lo = np.broadcast_to(vmin, targets.shape).copy()
+    hi = np.broadcast_to(np.nextafter(vmax, np.inf), targets.shape).copy()
+    result = np.full(targets.shape, np.nan)
+    constant = np.zeros(targets.shape, dtype=bool)
+    previous_count = np.full(targets.shape, np.iinfo(np.int64).max)
+
+    for _ in range(max_passes):
+        hist, count, below, inner_min, inner_max = _map_reduce(
+            chunks(),
+            _histogram_partial,
+            [np.add, np.add, np.add, np.minimum, np.maximum],
+            weights,
+            lo,
+            hi,
+            nbins,
+        )
+
+        # brackets of identical values give the quantile directly
+        constant = constant | (inner_min == inner_max)
+        result = np.where(constant & np.isnan(result), inner_min, result)
+        # brackets whose number of observations stopped decreasing hold ties, and brackets too narrow to be split
+        # into bins of distinct values hold near-ties: both are gathered as they are
+        width = (hi - lo) / nbins
+        splittable = width > np.spacing(np.maximum(np.abs(lo), np.abs(hi)))
+        active = ~constant & (count > max_candidates) & (count < previous_count) & splittable
+        previous_count = count
+        if not active.any():
+            break
+
+        # weight below each bin edge, and the bins around the targets with their margins, widened by one bin
+        # against rounding at the edges
+        below_weight = np.einsum("qpc,p->qc", below, weights)
+        edges = below_weight[..., None] + np.concatenate(
+            [np.zeros(hist.shape[:-1] + (1,)), np.cumsum(hist, axis=-1)], axis=-1
+        )
+        k_lo = np.clip((edges[..., :-1] <= margin_lo[..., None]).sum(axis=-1) - 2, 0, nbins - 1)
+        k_hi = np.clip((edges[..., 1:] < margin_hi[..., None]).sum(axis=-1) + 1, 0, nbins - 1)
+
+        new_lo = np.where(k_lo > 0, lo + width * k_lo, lo)
+        new_hi = np.where(k_hi < nbins - 1, lo + width * (k_hi + 1), hi)
+        # a bracket is never narrowed to nothing by rounding
+        narrowed = active & (new_hi > new_lo)
+        lo = np.where(narrowed, new_lo, lo)
+        hi = np.where(narrowed, new_hi, hi)
+    else:
+        raise RuntimeError("weighted quantiles did not converge in {} passes".format(max_passes))
+
+    # exact selection among the observations of the brackets
+    n_candidates = int(max(count[~constant].max(), 1)) if (~constant).any() else 1
+    (candidates, candidate_weights), below = _map_reduce(
+        chunks(), _gather_partial, [_merge_candidates, np.add], weights, lo, hi, n_candidates
+    )
+
+    below_weight = np.einsum("qpc,p->qc", below, weights)
+    midpoints = below_weight[..., None] + np.cumsum(candidate_weights, axis=-1) - 0.5 * candidate_weights
+    valid = np.isfinite(candidates)
+    midpoints = np.where(valid, midpoints, np.inf)
+
+    n_valid = valid.sum(axis=-1)
+    if (~constant & (n_valid == 0)).any():
+        raise RuntimeError("weighted quantiles: a quantile bracket holds no observations")
+    j = (midpoints <= targets[..., None]).sum(axis=-1)
+    i0 = np.clip(j - 1, 0, np.maximum(n_valid - 1, 0))
+    i1 = np.clip(j, 0, np.maximum(n_valid - 1, 0))
+
+    def take(a, i):
+        return np.take_along_axis(a, i[..., None], axis=-1)[..., 0]
+
+    v0, v1 = take(candidates, i0), take(candidates, i1)
+    c0, c1 = take(midpoints, i0), take(midpoints, i1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        interpolated = np.where(i0 == i1, v0, v0 + (v1 - v0) * (targets - c0) / (c1 - c0))
+    result = np.where(constant, result, interpolated)
+
+    return xr.DataArray(
+        result.reshape((len(quantiles),) + tuple(da.sizes[d] for d in cell_dims)),
+        dims=["quantile"] + cell_dims,
+        coords=dict(
+            {d: da[d] for d in cell_dims if d in da.coords},
+            quantile=quantiles,
+        ),
+        name=da.name,
+    )